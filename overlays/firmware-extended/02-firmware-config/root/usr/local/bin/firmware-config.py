@@ -1,15 +1,51 @@
 #!/usr/bin/env python3
 
 import argparse
+import codecs
+import configparser
+import contextlib
+import ctypes
+import email.message
+import email.parser
+import errno
 import glob
+import gzip
+import hashlib
+import http.client
+import io
 import json
+import mmap
 import os
+import re
+import secrets
+import signal
+import socket
+import stat
+import struct
 import subprocess
+import tarfile
+import tempfile
+import threading
 import time
+import zlib
 import fcntl
 import yaml
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http import HTTPStatus
 from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
-from urllib.parse import urlparse
+from urllib.parse import urlparse, parse_qs, urljoin
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 def deep_merge(base, override):
     """Deep merge override into base, modifying base in place."""
@@ -22,7 +58,7 @@ def deep_merge(base, override):
 
 def load_functions_from_dir(functions_dir):
     """Load and deep merge all YAML files from a directory in sorted order."""
-    config = {'links': {}, 'settings': {}, 'actions': {}, 'status': {}, 'upgrade_url': {}, 'upgrade_upload': {}}
+    config = {'links': {}, 'settings': {}, 'actions': {}, 'status': {}, 'status_sources': {}, 'upgrade_url': {}, 'upgrade_upload': {}, 'logs': {}}
 
     if not os.path.isdir(functions_dir):
         log(f"Functions directory not found: {functions_dir}")
@@ -55,9 +91,2313 @@ def shell_to_cmd(shell, *args):
         cmd.extend(args)
     return cmd
 
+def kill_process_group(process):
+    """Kill a process started with start_new_session=True together with everything it started."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def run_status_cmd(cmd):
+    try:
+        result = subprocess.run(
+            cmd, shell=True, capture_output=True, text=True, timeout=5
+        )
+        return result.stdout.strip() if result.returncode == 0 else None
+    except Exception:
+        return None
+
+def check_condition(cmd):
+    try:
+        result = subprocess.run(cmd, shell=True, capture_output=True, timeout=5)
+        return result.returncode == 0
+    except Exception:
+        return False
+
+# Root of /sys and /proc for the native status providers, overridable for testing
+FS_ROOT = "/"
+
+# Identifies this server process in event ids and version-derived ETags
+INSTANCE_ID = f"{int(time.time()):x}"
+
+# Bodies smaller than this are sent uncompressed
+GZIP_MIN_SIZE = 512
+
+SIOCGIFADDR = 0x8915
+SIOCGIWAP = 0x8B15
+SIOCGIWESSID = 0x8B1B
+
+def fs_path(path):
+    return os.path.join(FS_ROOT, path.lstrip("/"))
+
+def read_text(path):
+    try:
+        with open(fs_path(path), "r") as f:
+            return f.read().strip()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+def provide_file(path):
+    return read_text(path) or None
+
+def provide_exists(path):
+    return os.path.exists(fs_path(path))
+
+def provide_sysfs_net(arg):
+    iface, _, attr = arg.partition("/")
+    return provide_file(f"/sys/class/net/{iface}/{attr}")
+
+def provide_cmdline_slot(_arg):
+    cmdline = read_text("/proc/cmdline") or ""
+    for token in cmdline.split():
+        key, _, value = token.partition("=")
+        if "android" in key and "slot" in key:
+            return "A" if value == "_a" else "B"
+    return None
+
+def _iface_ioctl(request, data):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        return fcntl.ioctl(sock.fileno(), request, data)
+
+def provide_ipv4(iface):
+    try:
+        result = _iface_ioctl(SIOCGIFADDR, struct.pack("256s", iface.encode()[:15]))
+    except OSError as e:
+        if e.errno in (errno.EADDRNOTAVAIL, errno.ENODEV):
+            return None
+        raise
+    return socket.inet_ntoa(result[20:24])
+
+def _wireless_signal(iface):
+    # /proc/net/wireless: "wlan0: 0000   70.  -40.  -256 ..."
+    for line in (read_text("/proc/net/wireless") or "").splitlines():
+        name, sep, fields = line.partition(":")
+        if sep and name.strip() == iface:
+            return str(int(float(fields.split()[2])))
+    return None
+
+def _wireless_essid(iface):
+    buf = bytearray(33)
+    ptr = (ctypes.c_char * len(buf)).from_buffer(buf)
+    req = struct.pack("16sPHH", iface.encode()[:15], ctypes.addressof(ptr), len(buf), 0)
+    result = _iface_ioctl(SIOCGIWESSID, req.ljust(32, b"\0"))
+    length = struct.unpack_from("16sPHH", result)[2]
+    return bytes(buf[:length]).rstrip(b"\0").decode("utf-8", errors="replace") or None
+
+def _wireless_bssid(iface):
+    result = _iface_ioctl(SIOCGIWAP, struct.pack("16s", iface.encode()[:15]).ljust(32, b"\0"))
+    # union iwreq_data holds a struct sockaddr, the MAC is in sa_data
+    mac = result[18:24]
+    if mac in (b"\0" * 6, b"\x44" * 6, b"\xff" * 6):
+        return "Not-Associated"
+    return ":".join(f"{b:02X}" for b in mac)
+
+def provide_wireless(arg):
+    iface, _, field = arg.partition("/")
+    if not os.path.isdir(fs_path(f"/sys/class/net/{iface}/wireless")):
+        return None
+    if field == "signal":
+        return _wireless_signal(iface)
+    elif field == "ssid":
+        return _wireless_essid(iface)
+    elif field == "bssid":
+        return _wireless_bssid(iface)
+    raise ValueError(f"Unknown wireless field: {field}")
+
+STATUS_PROVIDERS = {
+    'file': provide_file,
+    'exists': provide_exists,
+    'sysfs_net': provide_sysfs_net,
+    'cmdline_slot': provide_cmdline_slot,
+    'ipv4': provide_ipv4,
+    'wireless': provide_wireless,
+}
+
+def status_probe(provider, fallback):
+    """Build a probe callable from a provider spec ("name:arg"), falling back to the given callable."""
+    if provider:
+        name, _, arg = provider.partition(":")
+        provider_fn = STATUS_PROVIDERS.get(name)
+        if provider_fn:
+            def probe():
+                try:
+                    return provider_fn(arg)
+                except Exception as e:
+                    if not fallback:
+                        raise
+                    log(f"Status provider {provider} failed ({e}), using fallback")
+                    return fallback()
+            return probe
+        log(f"Unknown status provider: {provider}")
+    return fallback
+
+def compile_extractor(item):
+    """Compile the regex/split field extractor of a status item into a callable, or None."""
+    if 'regex' in item:
+        pattern = re.compile(item['regex'], re.MULTILINE)
+        def extract_regex(text):
+            match = pattern.search(text)
+            if not match:
+                return None
+            return (match.group(1) if pattern.groups else match.group(0)).strip()
+        return extract_regex
+
+    if 'split' in item:
+        split_cfg = item['split']
+        match = split_cfg.get('match')
+        sep = split_cfg.get('sep')
+        field = split_cfg.get('field', 0)
+        def extract_split(text):
+            for line in text.splitlines():
+                if match and match not in line:
+                    continue
+                fields = line.split(sep)
+                if -len(fields) <= field < len(fields):
+                    return fields[field].strip()
+                return None
+            return None
+        return extract_split
+
+    return None
+
+class StatusRefresher:
+    """Keeps an in-memory snapshot of the status probes, refreshing each on its own TTL.
+
+    Every distinct shell command (item cmd, if_cmd or a named entry of
+    status_sources) is a single source that runs at most once per refresh,
+    however many items read from it. A command that only backs provider
+    fallbacks runs on demand, when a provider fails, and is shared the same way.
+    """
+
+    def __init__(self, status_config, pool, deadline=3.0, default_ttl=30, idle_timeout=60, sources_config=None):
+        self.status_config = status_config
+        self.pool = pool
+        self.deadline = deadline
+        self.idle_timeout = idle_timeout
+        self.cond = threading.Condition()
+        self.version = 0
+        self.last_access = 0
+        self.sources = {}
+        self.sources_config = sources_config or {}
+        self.section_if = {}
+        self.items = {}
+
+        for section_key, section_cfg in status_config.items():
+            section_ttl = section_cfg.get('ttl', default_ttl)
+            if_ttl = section_cfg.get('if_ttl', section_ttl)
+            if_cmd = section_cfg.get('if_cmd')
+            if section_cfg.get('if_provider'):
+                fallback = (lambda cmd=if_cmd: check_condition(cmd)) if if_cmd else None
+                source_key = ('if', section_key)
+                self._add_source(source_key, status_probe(section_cfg['if_provider'], fallback), if_ttl, section_key)
+                self.section_if[section_key] = source_key
+            elif if_cmd:
+                source_key = ('if_cmd', if_cmd)
+                self._add_source(source_key, lambda cmd=if_cmd: check_condition(cmd), if_ttl, section_key)
+                self.section_if[section_key] = source_key
+
+            for idx, item in enumerate(section_cfg.get('items', [])):
+                ttl = item.get('ttl', section_ttl)
+                extractor = compile_extractor(item)
+                source_cmd = self._source_cmd(item)
+                source_ttl = self.sources_config.get(item.get('source'), {}).get('ttl', ttl)
+                if item.get('provider'):
+                    fallback = None
+                    if source_cmd:
+                        cmd_key = ('cmd', source_cmd)
+                        self._add_source(cmd_key, lambda cmd=source_cmd: run_status_cmd(cmd), source_ttl, section_key,
+                                         on_demand=True)
+                        fallback = lambda key=cmd_key, extract=extractor: self._extract(self._fetch_source(key), extract)
+                    source_key = ('provider', section_key, idx)
+                    self._add_source(source_key, status_probe(item['provider'], fallback), ttl, section_key)
+                    self.items[(section_key, idx)] = (source_key, None)
+                elif source_cmd:
+                    source_key = ('cmd', source_cmd)
+                    self._add_source(source_key, lambda cmd=source_cmd: run_status_cmd(cmd), source_ttl, section_key)
+                    self.items[(section_key, idx)] = (source_key, extractor)
+
+    def _source_cmd(self, item):
+        if 'source' in item:
+            source_cfg = self.sources_config.get(item['source'])
+            if not source_cfg:
+                log(f"Unknown status source: {item['source']}")
+                return None
+            return source_cfg['cmd']
+        return item.get('cmd')
+
+    def _add_source(self, key, fn, ttl, section_key, on_demand=False):
+        source = self.sources.get(key)
+        if source is None:
+            source = {'fn': fn, 'ttl': ttl, 'value': None, 'updated': None, 'running': False, 'sections': set(),
+                      'on_demand': on_demand, 'lock': threading.Lock()}
+            self.sources[key] = source
+        source['ttl'] = min(source['ttl'], ttl)
+        source['sections'].add(section_key)
+        # Any item reading the command directly keeps it on the refresh schedule
+        source['on_demand'] = source['on_demand'] and on_demand
+
+    @staticmethod
+    def _extract(value, extractor):
+        if value is None or extractor is None:
+            return value
+        try:
+            return extractor(value)
+        except Exception:
+            return None
+
+    def start(self):
+        threading.Thread(target=self._run, name="status-refresher", daemon=True).start()
+
+    def _section_disabled(self, section_key):
+        # if_cmd results are cached like any other source, so a missing
+        # interface costs one check per if_ttl instead of one per item.
+        source = self.sources.get(self.section_if.get(section_key))
+        return source is not None and source['updated'] is not None and not source['value']
+
+    def _source_needed(self, key, source):
+        if source['on_demand']:
+            return False
+        if key[0] in ('if', 'if_cmd'):
+            return True
+        return not all(self._section_disabled(section_key) for section_key in source['sections'])
+
+    def _due_sources(self, now):
+        due = []
+        for key, source in self.sources.items():
+            if source['running'] or not self._source_needed(key, source):
+                continue
+            if source['updated'] is None or now - source['updated'] >= source['ttl']:
+                due.append(key)
+        return due
+
+    def _next_due_in(self, now):
+        delays = [source['updated'] + source['ttl'] - now
+                  for source in self.sources.values()
+                  if not source['running'] and not source['on_demand'] and source['updated'] is not None]
+        return min([1.0] + [max(0.1, d) for d in delays])
+
+    def _refresh_source(self, key):
+        source = self.sources[key]
+        with source['lock']:
+            try:
+                value = source['fn']()
+            except Exception:
+                value = None
+            with self.cond:
+                self._store(source, value)
+                source['running'] = False
+                self.cond.notify_all()
+
+    def _fetch_source(self, key):
+        """Value of a shared command for a provider fallback, run only if it is older than its TTL."""
+        source = self.sources[key]
+        with source['lock']:
+            with self.cond:
+                if source['updated'] is not None and time.monotonic() - source['updated'] < source['ttl']:
+                    return source['value']
+            value = source['fn']()
+            with self.cond:
+                self._store(source, value)
+            return value
+
+    def _store(self, source, value):
+        # version only moves when a value changes, so it can back ETags;
+        # on-demand sources are only seen through the providers reading them
+        if not source['on_demand'] and (source['updated'] is None or value != source['value']):
+            self.version += 1
+        source['value'] = value
+        source['updated'] = time.monotonic()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                now = time.monotonic()
+                if now - self.last_access > self.idle_timeout:
+                    # Nobody is looking at the status page, stop probing
+                    self.cond.wait()
+                    continue
+                due = self._due_sources(now)
+                for key in due:
+                    self.sources[key]['running'] = True
+            for key in due:
+                self.pool.submit(self._refresh_source, key)
+            with self.cond:
+                self.cond.wait(timeout=self._next_due_in(time.monotonic()))
+
+    def _has_unknown(self):
+        return any(source['updated'] is None and self._source_needed(key, source)
+                   for key, source in self.sources.items())
+
+    def snapshot(self):
+        """Return the current status, waiting up to the deadline only for never-evaluated sources."""
+        return self.versioned_snapshot()[1]
+
+    def versioned_snapshot(self):
+        """Like snapshot(), also returning the version the result was built from."""
+        deadline = time.monotonic() + self.deadline
+        with self.cond:
+            self.last_access = time.monotonic()
+            self.cond.notify_all()
+            while self._has_unknown():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(timeout=remaining)
+            return self.version, self._build(time.monotonic())
+
+    def _build(self, now):
+        result = {}
+        for section_key, section_cfg in self.status_config.items():
+            if self._section_disabled(section_key):
+                continue
+
+            section_items = []
+            has_value = False
+            has_pending = False
+            for idx, item in enumerate(section_cfg.get('items', [])):
+                source_key, extractor = self.items.get((section_key, idx), (None, None))
+                source = self.sources.get(source_key)
+                entry = {'label': item.get('label', ''), 'value': None}
+                if source is not None and source['updated'] is None:
+                    entry['pending'] = True
+                    has_pending = True
+                elif source is not None:
+                    entry['value'] = self._extract(source['value'], extractor)
+                    entry['age'] = round(now - source['updated'], 1)
+                    has_value = has_value or bool(entry['value'])
+                section_items.append(entry)
+
+            if section_key in self.section_if and not has_value and not has_pending:
+                continue
+
+            result[section_key] = {
+                'title': section_cfg.get('title', section_key),
+                'items': section_items
+            }
+
+        return result
+
+# Seconds between "still waiting" lines, below nginx's 60s proxy read timeout
+DEFER_REPORT_INTERVAL = 30
+
+
+def defers_while_printing(*configs):
+    return any(cfg.get("defer_while_printing") or cfg.get("heavy") for cfg in configs if cfg)
+
+
+class PrintStateMonitor:
+    """Caches Moonraker's print_stats so heavy work can wait for an idle printer.
+
+    One thread polls Moonraker (every `interval`, every `busy_interval` while
+    work is waiting) and requests only read the cached state. An unreachable
+    Moonraker or Klipper counts as idle, so nothing waits on a broken printer.
+    """
+
+    BUSY_STATES = ("printing", "paused")
+
+    def __init__(self, url, interval=10, busy_interval=2, timeout=5):
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.interval = interval
+        self.busy_interval = busy_interval
+        self.timeout = timeout
+        self.cond = threading.Condition()
+        self.state = None
+        self.filename = None
+        self.progress = None
+        self.error = None
+        self.updated = 0
+        self.queue = {}
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="print-state", daemon=True)
+        self.thread.start()
+
+    def _fetch(self):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.request("GET", "/printer/objects/query?print_stats=state,filename&virtual_sdcard=progress")
+            resp = conn.getresponse()
+            body = resp.read()
+            if resp.status != 200:
+                raise OSError(f"HTTP {resp.status}")
+            status = json.loads(body)["result"]["status"]
+            return (status["print_stats"].get("state"), status["print_stats"].get("filename"),
+                    status.get("virtual_sdcard", {}).get("progress"))
+        finally:
+            conn.close()
+
+    def _run(self):
+        while True:
+            try:
+                state, filename, progress = self._fetch()
+                error = None
+            except (OSError, ValueError, KeyError, TypeError, http.client.HTTPException) as e:
+                state, filename, progress, error = None, None, None, str(e) or type(e).__name__
+            with self.cond:
+                if state != self.state or error != self.error:
+                    log(f"Printer state: {state or 'unknown'}" + (f" ({error})" if error else ""))
+                self.state, self.filename, self.progress, self.error = state, filename, progress, error
+                self.updated = time.time()
+                self.cond.notify_all()
+                self.cond.wait(self.busy_interval if self.queue else self.interval)
+
+    @property
+    def busy(self):
+        return self.state in self.BUSY_STATES
+
+    def enqueue(self, kind, name):
+        """Register work waiting for the printer, returns its queue id."""
+        entry_id = secrets.token_hex(8)
+        with self.cond:
+            self.queue[entry_id] = {"id": entry_id, "kind": kind, "name": name, "since": time.time()}
+            # Poll faster from now on
+            self.cond.notify_all()
+        return entry_id
+
+    def dequeue(self, entry_id):
+        with self.cond:
+            self.queue.pop(entry_id, None)
+
+    def wait_idle(self, timeout):
+        """Wait up to `timeout` for an idle printer, returns True when it is idle."""
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.busy, timeout)
+
+    def waiting_message(self):
+        progress = f", {self.progress * 100:.0f}% done" if self.progress is not None else ""
+        return f"Printer is {self.state} ({self.filename or 'unknown file'}{progress}), waiting until it is idle...\n"
+
+    def info(self):
+        with self.cond:
+            return {
+                "state": self.state,
+                "busy": self.busy,
+                "filename": self.filename,
+                "progress": self.progress,
+                "error": self.error,
+                "updated": self.updated,
+                "queue": sorted(self.queue.values(), key=lambda entry: entry["since"])
+            }
+
+
+class EventBroker:
+    """Publishes status and setting changes to any number of /api/events clients.
+
+    A single thread follows the StatusRefresher and periodically re-reads the
+    settings, diffs them against the last published state and appends the
+    differences to a bounded history. Clients only read that history, so the
+    probe load is the same for one browser or many.
+    """
+
+    def __init__(self, refresher, settings_fn, settings_interval=10, history=256):
+        self.refresher = refresher
+        self.settings_fn = settings_fn
+        self.settings_interval = settings_interval
+        # Shares the refresher's condition, so new status values wake the
+        # broker thread and update_setting can wake it through notify_all.
+        self.cond = refresher.cond
+        self.last_id = 0
+        self.history = deque(maxlen=history)
+        self.clients = 0
+        self.primed = False
+        self.settings_dirty = False
+        self.status = {}
+        self.settings = {}
+
+    def start(self):
+        threading.Thread(target=self._run, name="events", daemon=True).start()
+
+    def event_id(self, seq):
+        return f"{INSTANCE_ID}-{seq}"
+
+    def parse_event_id(self, event_id):
+        """Sequence number of a Last-Event-ID from this process, None otherwise."""
+        boot, _, seq = (event_id or '').partition('-')
+        if boot != INSTANCE_ID or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def settings_changed(self):
+        with self.cond:
+            self.settings_dirty = True
+            self.cond.notify_all()
+
+    @staticmethod
+    def _status_state(snapshot):
+        state = {}
+        for section_key, section in snapshot.items():
+            items = []
+            for item in section['items']:
+                entry = {'label': item['label'], 'value': item['value']}
+                if item.get('pending'):
+                    entry['pending'] = True
+                items.append(entry)
+            state[section_key] = {'title': section['title'], 'items': items}
+        return state
+
+    @staticmethod
+    def _status_diff(old, new):
+        diff = {}
+        for section_key in old:
+            if section_key not in new:
+                diff[section_key] = None
+        for section_key, section in new.items():
+            old_items = old.get(section_key, {}).get('items', [])
+            changed = {str(idx): item for idx, item in enumerate(section['items'])
+                       if idx >= len(old_items) or old_items[idx] != item}
+            if changed:
+                diff[section_key] = {'title': section['title'], 'items': changed}
+        return diff
+
+    def _publish(self, event, data):
+        # Called with self.cond held
+        self.last_id += 1
+        self.history.append((self.last_id, event, data))
+        self.cond.notify_all()
+
+    def _run(self):
+        next_settings = 0
+        while True:
+            with self.cond:
+                while not self.clients:
+                    self.cond.wait()
+                version = self.refresher.version
+                settings_dirty = self.settings_dirty
+                self.settings_dirty = False
+
+            # snapshot() also marks the refresher as in use, so it keeps
+            # probing while browsers are subscribed.
+            status = self._status_state(self.refresher.snapshot())
+            settings = None
+            now = time.monotonic()
+            if now >= next_settings or settings_dirty:
+                next_settings = now + self.settings_interval
+                try:
+                    settings = self.settings_fn()
+                except Exception as e:
+                    log(f"Events settings error: {e}")
+
+            with self.cond:
+                status_diff = self._status_diff(self.status, status)
+                if status_diff:
+                    self.status = status
+                    self._publish('status', status_diff)
+                if settings is not None:
+                    settings_diff = {k: v for k, v in settings.items() if self.settings.get(k) != v}
+                    if settings_diff:
+                        self.settings.update(settings_diff)
+                        self._publish('settings', settings_diff)
+                if not self.primed:
+                    self.primed = True
+                    self.cond.notify_all()
+
+                timeout = max(0.1, next_settings - time.monotonic())
+                self.cond.wait_for(
+                    lambda: self.refresher.version != version or self.settings_dirty or not self.clients,
+                    timeout=timeout)
+
+    def subscribe(self):
+        with self.cond:
+            self.clients += 1
+            self.cond.notify_all()
+
+    def unsubscribe(self):
+        with self.cond:
+            self.clients -= 1
+            if not self.clients:
+                # Published state goes stale while nobody is subscribed
+                self.primed = False
+
+    def _in_history(self, seq):
+        oldest = self.history[0][0] if self.history else self.last_id + 1
+        return seq is not None and oldest - 1 <= seq <= self.last_id
+
+    def events_after(self, seq, timeout):
+        """Events newer than seq, waiting up to timeout for one to be published.
+
+        Returns a single 'sync' event with the full state when seq is None or
+        no longer covered by the retained history.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.primed, timeout=timeout)
+            if self._in_history(seq):
+                self.cond.wait_for(lambda: self.last_id != seq, timeout=timeout)
+                if self._in_history(seq):
+                    return [entry for entry in self.history if entry[0] > seq]
+            return [(self.last_id, 'sync', {'status': self.status, 'settings': dict(self.settings)})]
+
+class ExtendedConfigReader:
+    """Parsed copies of extended-config.py managed files, re-read only when they change on disk.
+
+    Answers `extended-config.py get <cfg_file> <section> <key> [default]`
+    get_cmd argv lists without starting a Python interpreter per setting.
+    """
+
+    SCRIPT_NAME = "extended-config.py"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+
+    def parse(self, cfg_file):
+        try:
+            st = os.stat(cfg_file)
+            stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            stamp = None
+
+        with self.lock:
+            cached = self.files.get(cfg_file)
+            if cached and cached[0] == stamp:
+                return cached[1]
+
+        cfg = configparser.ConfigParser()
+        cfg.read(cfg_file)
+        with self.lock:
+            self.files[cfg_file] = (stamp, cfg)
+        return cfg
+
+    def get(self, cfg_file, section, key, default=None):
+        """Same lookup as extended-config.py get_value(), returning None where it would fail."""
+        cfg = self.parse(cfg_file)
+        if default is None and not cfg.has_option(section, key):
+            return None
+        return cfg.get(section, key, fallback=default).strip()
+
+    def handles(self, argv):
+        return (isinstance(argv, list) and len(argv) in (5, 6)
+                and os.path.basename(argv[0]) == self.SCRIPT_NAME and argv[1] == 'get')
+
+    def get_argv(self, argv):
+        return self.get(*argv[2:])
+
+class SettingsCache:
+    """Current setting values, valid while the files they depend on are unchanged.
+
+    Settings without depends_on (declared in YAML or implied by an
+    extended-config.py get_cmd) are never cached.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def stamp(paths):
+        result = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                result.append((st.st_ino, st.st_size, st.st_mtime_ns))
+            except OSError:
+                result.append(None)
+        return tuple(result)
+
+    def get(self, key, paths, compute):
+        if not paths:
+            with self.lock:
+                self.uncached += 1
+            return compute()
+
+        # Stamp before computing, so a change during compute() is seen next time
+        stamp = self.stamp(paths)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] == stamp:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        value = compute()
+        with self.lock:
+            self.entries[key] = (value, stamp)
+        return value
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'uncached': self.uncached,
+                'invalidations': self.invalidations
+            }
+
+# Byte substitution applied to UPFILE headers, see tools/upfile/helpers.h
+UPFILE_DATA_MAP = bytes.fromhex(
+    "00a2e90ede64ee12463be779a5805533"
+    "323c0b7ececc5937019b4ec1ab187211"
+    "9c5be58de80d699729d9c5af4a617a63"
+    "39c6bcd092ae7fdd6c073ab991f7c745"
+    "3440b52844e6cb4d3d9e942b60d22f3e"
+    "67d652d3a8d4f81adaec707ca01d064f"
+    "6e2db836f04322bdb4829deba45676e4"
+    "25159871c350497708fb4723aa8a20fc"
+    "f68c85301ec962ba530ff257517b131f"
+    "96c0357387dbb7a3ed905f9adce3e10a"
+    "1b17ea41fe5826cd05c202886a9f9374"
+    "e22a09ac815c1cf38bfa84a1d75dbe75"
+    "38e0a62c2e6686ef5468b6a9f50cf9b3"
+    "bf14b2fdbbd504f4a748f16d6b997d4b"
+    "b0ad2195d1cfc424ca8eb18316df1910"
+    "274c6f313f5a6578c8d803895e8f42ff"
+)
+
+SHA256_RE = re.compile(r'[0-9a-fA-F]{64}')
+
+
+class FirmwareVerifyError(Exception):
+    pass
+
+
+def parse_sha256(value):
+    """Normalise a client supplied SHA-256, returns None when empty."""
+    value = (value or '').strip()
+    if not value:
+        return None
+    if not SHA256_RE.fullmatch(value):
+        raise ValueError("Invalid SHA-256, expected 64 hex digits")
+    return value.lower()
+
+
+def fetch_sha256(download_shell, url, timeout=30):
+    """Fetch a checksum sidecar (sha256sum output or a bare digest) with the download command."""
+    try:
+        result = subprocess.run(shell_to_cmd(download_shell, url), capture_output=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise ValueError(f"Timed out fetching checksum from {url}")
+    if result.returncode != 0:
+        raise ValueError(f"Failed to fetch checksum from {url}")
+    match = SHA256_RE.search(result.stdout[:4096].decode('latin-1'))
+    if not match:
+        raise ValueError(f"No SHA-256 found at {url}")
+    return match.group(0).lower()
+
+
+class RkfwVerifier:
+    """Checks the MD5 a Rockchip update.img carries after its image (rkrom_29xx.h)."""
+
+    HEADER_SIZE = 41
+
+    def __init__(self, size):
+        self.size = size
+        self.head = bytearray()
+        self.md5 = hashlib.md5()
+        self.md5_end = None
+        self.pos = 0
+        self.tail = bytearray()
+
+    def update(self, data):
+        if self.md5_end is None:
+            take = min(len(data), self.HEADER_SIZE - len(self.head))
+            self.head += data[:take]
+            self.md5.update(data[:take])
+            self.pos += take
+            data = data[take:]
+            if len(self.head) < self.HEADER_SIZE:
+                return
+            if self.head[:4] != b"RKFW":
+                raise FirmwareVerifyError("SOC firmware is not a Rockchip RKFW image")
+            image_offset, image_length = struct.unpack_from("<II", self.head, 33)
+            self.md5_end = image_offset + image_length
+            if self.md5_end < self.HEADER_SIZE or self.md5_end + 32 > self.size:
+                raise FirmwareVerifyError("SOC firmware image bounds exceed its entry")
+        if self.pos < self.md5_end:
+            take = min(len(data), self.md5_end - self.pos)
+            self.md5.update(data[:take])
+            self.pos += take
+            data = data[take:]
+        if data and len(self.tail) < 32:
+            self.tail += data[:32 - len(self.tail)]
+
+    def finish(self):
+        if len(self.tail) < 32 or self.tail.decode('latin-1').lower() != self.md5.hexdigest():
+            raise FirmwareVerifyError("SOC firmware MD5 mismatch")
+
+
+class FirmwareVerifier:
+    """Checks an UPFILE firmware image while it streams in.
+
+    Mirrors tools/upfile: header and entry table checksums are verified
+    as soon as the first bytes arrive, every entry's MD5 is compared the
+    moment its last byte is seen and the SOC_FW entry's own RKFW MD5 is
+    checked too. The whole stream is also hashed with SHA-256 for
+    comparison with a client supplied digest. Any mismatch raises
+    FirmwareVerifyError from update(), so a bad image is rejected before
+    the rest of it is written to flash.
+    """
+
+    HEADER_SIZE = 64
+    ENTRY_SIZE = 32
+    MAGIC = 0x4b4d4e53
+    MAX_FILES = 4
+    SOC_FW = 0
+
+    def __init__(self, expected_sha256=None, max_size=None):
+        self.expected_sha256 = expected_sha256
+        self.max_size = max_size
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.head = bytearray()
+        self.files = None
+        self.entries = None
+        self.pending = []
+        self.version = ""
+        self.build_date = ""
+
+    @staticmethod
+    def _checksum(data, field):
+        data = bytearray(data)
+        data[field:field + 2] = b"\0\0"
+        return sum(data) & 0xffff
+
+    def _parse_header(self):
+        header = bytes(self.head[:self.HEADER_SIZE]).translate(UPFILE_DATA_MAP)
+        magic, = struct.unpack_from("<I", header, 0)
+        checksum, = struct.unpack_from(">H", header, 6)
+        if magic != self.MAGIC:
+            raise FirmwareVerifyError("Not a firmware image (bad magic)")
+        if self._checksum(header, 6) != checksum:
+            raise FirmwareVerifyError("Firmware header checksum mismatch")
+        self.files, = struct.unpack_from(">H", header, 46)
+        if not 0 < self.files <= self.MAX_FILES:
+            raise FirmwareVerifyError(f"Invalid firmware file count: {self.files}")
+        self.version = header[8:32].rstrip(b"\0 ").decode('latin-1')
+        self.build_date = header[32:46].rstrip(b"\0 ").decode('latin-1')
+
+    def _parse_entries(self):
+        table_end = self.HEADER_SIZE + self.files * self.ENTRY_SIZE
+        self.entries = []
+        for index in range(self.files):
+            start = self.HEADER_SIZE + index * self.ENTRY_SIZE
+            entry = bytes(self.head[start:start + self.ENTRY_SIZE]).translate(UPFILE_DATA_MAP)
+            file_type, checksum, offset, size = struct.unpack_from(">HHQI", entry, 0)
+            if self._checksum(entry, 2) != checksum:
+                raise FirmwareVerifyError(f"Firmware entry {index} checksum mismatch")
+            if offset < table_end or (self.max_size is not None and offset + size > self.max_size):
+                raise FirmwareVerifyError(f"Firmware entry {index} lies outside the image")
+            self.entries.append({
+                'index': index,
+                'start': offset,
+                'end': offset + size,
+                'md5': hashlib.md5(),
+                'expected_md5': entry[16:32],
+                'rkfw': RkfwVerifier(size) if file_type == self.SOC_FW else None,
+            })
+        ranges = sorted((e['start'], e['end']) for e in self.entries)
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            if start < end:
+                raise FirmwareVerifyError("Firmware entries overlap")
+        self.pending = list(self.entries)
+
+    def update(self, data):
+        data = memoryview(data)
+        start = self.size
+        self.sha256.update(data)
+        self.size += len(data)
+        if self.entries is None:
+            self._update_head(data, start)
+            if self.entries is None:
+                return
+        self._update_entries(data, start)
+
+    def _update_head(self, data, start):
+        # Buffer the header, then the entry table whose length it gives
+        if self.files is None:
+            self.head += data[:self.HEADER_SIZE - start]
+            if len(self.head) < self.HEADER_SIZE:
+                return
+            self._parse_header()
+        table_end = self.HEADER_SIZE + self.files * self.ENTRY_SIZE
+        self.head += data[len(self.head) - start:table_end - start]
+        if len(self.head) >= table_end:
+            self._parse_entries()
+
+    def _update_entries(self, data, start):
+        end = start + len(data)
+        for entry in list(self.pending):
+            lo = max(start, entry['start'])
+            hi = min(end, entry['end'])
+            if lo < hi:
+                piece = data[lo - start:hi - start]
+                entry['md5'].update(piece)
+                if entry['rkfw']:
+                    entry['rkfw'].update(piece)
+            if end >= entry['end']:
+                self.pending.remove(entry)
+                if entry['md5'].digest() != entry['expected_md5']:
+                    raise FirmwareVerifyError(f"Firmware entry {entry['index']} MD5 mismatch")
+                if entry['rkfw']:
+                    entry['rkfw'].finish()
+
+    def finish(self):
+        """Check the image is complete, returns its SHA-256."""
+        if self.entries is None:
+            raise FirmwareVerifyError(f"Firmware image truncated at {self.size} bytes")
+        if self.pending:
+            raise FirmwareVerifyError(f"Firmware image truncated at {self.size} bytes, "
+                                      f"expected at least {max(e['end'] for e in self.pending)}")
+        digest = self.sha256.hexdigest()
+        if self.expected_sha256 and digest != self.expected_sha256:
+            raise FirmwareVerifyError(f"SHA-256 mismatch: got {digest}, expected {self.expected_sha256}")
+        return digest
+
+    def summary(self, digest):
+        matched = " (matches expected)" if self.expected_sha256 else ""
+        return (f"Verified firmware {self.version or '?'} (built {self.build_date or '?'}, {self.files} files)\n"
+                f"SHA-256: {digest}{matched}\n")
+
+
+class VerifiedDownload:
+    """Writes a streamed download to target_path, passing it through an optional FirmwareVerifier."""
+
+    PROGRESS_STEP = 16 * 1024 * 1024
+
+    def __init__(self, target_path, verifier=None):
+        self.target_path = target_path
+        self.verifier = verifier
+        self.size = 0
+        self.reported = 0
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        try:
+            os.unlink(target_path)
+        except FileNotFoundError:
+            pass
+        self.tf = open(target_path, "wb", buffering=0)
+
+    def write(self, data):
+        """Verify and store a chunk, returns a progress line every PROGRESS_STEP bytes."""
+        if self.verifier:
+            self.verifier.update(data)
+        chunk = memoryview(data)
+        while chunk:
+            written = self.tf.write(chunk)
+            chunk = chunk[written:]
+        self.size += len(data)
+        if self.size - self.reported >= self.PROGRESS_STEP:
+            self.reported = self.size
+            return f"Downloaded {self.size // (1024 * 1024)} MiB\n"
+        return None
+
+    def finish(self):
+        """Close the file, returns the verifier's SHA-256 (None without a verifier)."""
+        self.tf.close()
+        return self.verifier.finish() if self.verifier else None
+
+    def abort(self):
+        self.tf.close()
+        try:
+            os.unlink(self.target_path)
+        except Exception:
+            pass
+
+
+def verify_file(path, verifier, block_size=1024 * 1024):
+    """Feed a whole file through a FirmwareVerifier, returns its SHA-256."""
+    buf = memoryview(bytearray(block_size))
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            verifier.update(buf[:n])
+    return verifier.finish()
+
+
+CONTENT_RANGE_RE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+)')
+
+
+def parse_content_range(value, size):
+    """Parse "bytes first-last/size", returns the half open range (first, last + 1)."""
+    match = CONTENT_RANGE_RE.fullmatch((value or '').strip())
+    if not match:
+        raise ValueError("Missing or invalid Content-Range")
+    first, last, total = (int(v) for v in match.groups())
+    if total != size or first > last or last >= size:
+        raise ValueError(f"Content-Range {first}-{last}/{total} does not fit the {size} byte upload")
+    return first, last + 1
+
+
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)')
+
+
+def parse_byte_range(value, size):
+    """Parse a single "bytes=" Range header into a half open (start, end).
+
+    Returns None when there is nothing to honour (no header, several
+    ranges, other units), raises ValueError when the range is unsatisfiable.
+    """
+    match = RANGE_RE.fullmatch((value or '').replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        if int(last) == 0:
+            raise ValueError("Empty suffix range")
+        return max(0, size - int(last)), size
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError("Range starts past the end")
+    return start, min(int(last) + 1, size) if last else size
+
+
+def file_response(st, request_headers, filename):
+    """Plan a file download: returns (status, headers, start, end).
+
+    Validators come from the file stamp. If-None-Match gives 304, a single
+    Range gives 206 (or 416) unless If-Range names an older version.
+    """
+    etag = f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+    last_modified = formatdate(st.st_mtime, usegmt=True)
+    headers = {"Content-Type": "application/octet-stream",
+               "Content-Disposition": f'attachment; filename="{filename}"',
+               "X-Content-Type-Options": "nosniff",
+               "Accept-Ranges": "bytes",
+               "ETag": etag,
+               "Last-Modified": last_modified,
+               "Cache-Control": "no-cache"}
+    if_none_match = request_headers.get("If-None-Match")
+    if if_none_match and (if_none_match.strip() == "*" or
+                          etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))):
+        return 304, headers, 0, 0
+
+    size = st.st_size
+    if_range = request_headers.get("If-Range", "").strip()
+    if if_range and if_range not in (etag, last_modified):
+        return 200, headers, 0, size
+    try:
+        byte_range = parse_byte_range(request_headers.get("Range"), size)
+    except ValueError:
+        headers["Content-Range"] = f"bytes */{size}"
+        return 416, headers, 0, 0
+    if not byte_range:
+        return 200, headers, 0, size
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    return 206, headers, start, end
+
+
+ARCHIVE_FORMATS = {"gzip": (".tar.gz", "application/gzip"),
+                   "zstd": (".tar.zst", "application/zstd"),
+                   "none": (".tar", "application/x-tar")}
+
+
+def archive_options(archive, query):
+    """Compression, level and file name for an action `archive`, `query` may override the first two."""
+    compression = (query.get("compression") or [archive.get("compression", "gzip")])[-1]
+    if compression not in ARCHIVE_FORMATS:
+        raise ValueError(f"Unknown compression: {compression}")
+    if compression == "zstd" and zstandard is None:
+        compression = "gzip"
+    level = int((query.get("level") or [archive.get("level", 6)])[-1])
+    if not (0 <= level <= (19 if compression == "zstd" else 9)):
+        raise ValueError(f"Invalid compression level: {level}")
+    return compression, level, archive.get("name", "logs") + ARCHIVE_FORMATS[compression][0]
+
+
+class TarStream:
+    """Writes a tar archive of files and command output to `write`, compressing on the fly.
+
+    Files are copied in BLOCK_SIZE reads and every member is flushed to
+    `write` once complete. Command output has to be spooled to learn the
+    size the tar header needs: it is kept in memory up to SPOOL_SIZE and
+    spills to a temporary file in /tmp beyond that, so a command may write
+    as much as /tmp has room for. Unreadable paths are listed in errors.txt.
+    """
+
+    BLOCK_SIZE = 256 * 1024
+    FLUSH_SIZE = 64 * 1024
+    SPOOL_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, write, root, compression="gzip", level=6):
+        self.write = write
+        self.root = root
+        self.errors = []
+        self.seen = set()
+        self.buffer = bytearray()
+        if compression == "zstd":
+            self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+            self.flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        elif compression == "gzip":
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            self.flush_mode = zlib.Z_SYNC_FLUSH
+        else:
+            self.compressor = None
+
+    def _emit(self, data):
+        if self.compressor:
+            data = self.compressor.compress(data)
+        self.buffer += data
+        if len(self.buffer) >= self.FLUSH_SIZE:
+            self.write(bytes(self.buffer))
+            self.buffer.clear()
+
+    def flush(self):
+        """Write out the members so far, so a slow next member does not stall the download."""
+        if self.compressor:
+            self.buffer += self.compressor.flush(self.flush_mode)
+        if self.buffer:
+            self.write(bytes(self.buffer))
+            self.buffer.clear()
+
+    def _member(self, name, st, size=0, kind=tarfile.REGTYPE, linkname=""):
+        info = tarfile.TarInfo(f"{self.root}/{name.lstrip('/')}")
+        info.type = kind
+        info.size = size
+        info.linkname = linkname
+        info.mode = stat.S_IMODE(st.st_mode) if st else 0o644
+        info.mtime = int(st.st_mtime) if st else int(time.time())
+        self._emit(info.tobuf(tarfile.GNU_FORMAT, "utf-8", "surrogateescape"))
+
+    def _copy(self, f, size):
+        """Copy exactly `size` bytes of `f`, zero filling if it shrank, then pad the block."""
+        remaining = size
+        while remaining > 0:
+            chunk = f.read(min(self.BLOCK_SIZE, remaining))
+            if not chunk:
+                break
+            self._emit(chunk)
+            remaining -= len(chunk)
+        if remaining:
+            self.errors.append(f"{getattr(f, 'name', '?')}: shrank by {remaining} bytes while archiving")
+            self._emit(bytes(remaining))
+        if size % tarfile.BLOCKSIZE:
+            self._emit(bytes(tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE))
+
+    def _add_spooled(self, name, source, st=None):
+        with tempfile.SpooledTemporaryFile(self.SPOOL_SIZE) as spool:
+            while chunk := source.read(self.BLOCK_SIZE):
+                spool.write(chunk)
+            size = spool.tell()
+            spool.seek(0)
+            self._member(name, st, size)
+            self._copy(spool, size)
+
+    def add_file(self, path):
+        try:
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                self._member(path, st, kind=tarfile.SYMTYPE, linkname=os.readlink(path))
+            elif stat.S_ISREG(st.st_mode):
+                with open(path, "rb") as f:
+                    if st.st_size:
+                        self._member(path, st, st.st_size)
+                        self._copy(f, st.st_size)
+                    else:
+                        # Pseudo files (/proc, /sys) report a zero size
+                        self._add_spooled(path, f, st)
+        except OSError as e:
+            self.errors.append(f"{path}: {e.strerror or e}")
+        self.flush()
+
+    def add_path(self, pattern):
+        paths = sorted(glob.glob(pattern))
+        if not paths:
+            self.errors.append(f"{pattern}: not found")
+        for path in paths:
+            # The same directory is often reachable through a symlinked parent
+            if os.path.realpath(path) in self.seen:
+                continue
+            self.seen.add(os.path.realpath(path))
+            if not os.path.isdir(path) or os.path.islink(path):
+                self.add_file(path)
+                continue
+            for top, dirs, files in os.walk(path, onerror=lambda e: self.errors.append(f"{e.filename}: {e.strerror}")):
+                dirs.sort()
+                self._member(top, os.stat(top), kind=tarfile.DIRTYPE)
+                for name in sorted(files) + [d for d in dirs if os.path.islink(os.path.join(top, d))]:
+                    self.add_file(os.path.join(top, name))
+
+    def add_command(self, name, cmd, timeout=60):
+        try:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+        except OSError as e:
+            self.errors.append(f"{name}: {e.strerror or e}")
+            return
+        # Wrapper scripts leave children holding the pipe, so the whole group goes
+        timer = threading.Timer(timeout, kill_process_group, args=(process,))
+        timer.start()
+        try:
+            with process.stdout:
+                self._add_spooled(f"commands/{name}", process.stdout)
+        finally:
+            timer.cancel()
+            exit_code = process.wait()
+        if exit_code:
+            self.errors.append(f"{name}: exit code {exit_code}")
+        self.flush()
+
+    def finish(self):
+        if self.errors:
+            data = "\n".join(self.errors + [""]).encode()
+            self._member("errors.txt", None, len(data))
+            self._copy(io.BytesIO(data), len(data))
+        self._emit(bytes(2 * tarfile.BLOCKSIZE))
+        if self.compressor:
+            self.buffer += self.compressor.flush()
+        self.write(bytes(self.buffer))
+        self.buffer.clear()
+
+    @classmethod
+    def build(cls, archive, write, compression, level):
+        tar = cls(write, archive.get("name", "logs"), compression, level)
+        # Paths first: the download is under way before a slow command runs
+        for pattern in archive.get("paths") or []:
+            tar.add_path(pattern)
+        for name, cmd in (archive.get("commands") or {}).items():
+            tar.add_command(name, cmd, archive.get("timeout", 60))
+        tar.finish()
+
+
+class LogIndex:
+    """Reads windows of a growing log file through mmap.
+
+    Tail and byte-offset paging only touch the end they need. Line numbers
+    come from a sparse index, the newline count before every BLOCK_SIZE
+    boundary, built lazily as far as a request reaches and extended as the
+    file grows; a new inode or a shorter file (rotation) starts it over.
+    Regex filtering runs over SCAN_SIZE windows, at most MAX_SCAN per request.
+    """
+
+    BLOCK_SIZE = 1024 * 1024
+    SCAN_SIZE = 4 * 1024 * 1024
+    MAX_SCAN = 64 * 1024 * 1024
+    MAX_LINE = 64 * 1024
+    MAX_COUNT = 5000
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.inode = None
+        self.size = 0
+        self.blocks = [0]
+
+    def _sync(self, st):
+        with self.lock:
+            if st.st_ino != self.inode or st.st_size < self.size:
+                self.inode, self.blocks = st.st_ino, [0]
+            self.size = st.st_size
+
+    def _extend(self, mm, size, pos=None, line=None):
+        """Index complete blocks until `pos` is covered or more than `line` newlines are counted."""
+        with self.lock:
+            while (len(self.blocks) * self.BLOCK_SIZE <= size and
+                   (pos is None or len(self.blocks) * self.BLOCK_SIZE <= pos) and
+                   (line is None or self.blocks[-1] <= line)):
+                k = len(self.blocks) - 1
+                self.blocks.append(self.blocks[-1] + mm[k * self.BLOCK_SIZE:(k + 1) * self.BLOCK_SIZE].count(b"\n"))
+            return list(self.blocks)
+
+    def _line_number(self, mm, size, pos):
+        blocks = self._extend(mm, size, pos=pos)
+        k = pos // self.BLOCK_SIZE
+        return blocks[k] + mm[k * self.BLOCK_SIZE:pos].count(b"\n")
+
+    def _line_start(self, mm, size, line):
+        blocks = self._extend(mm, size, line=line)
+        k = bisect_right(blocks, line) - 1
+        pos = k * self.BLOCK_SIZE
+        if blocks[k] == line:
+            return mm.rfind(b"\n", 0, pos) + 1 if pos else 0
+        for _ in range(line - blocks[k]):
+            pos = mm.find(b"\n", pos, size)
+            if pos < 0:
+                return size
+            pos += 1
+        return pos
+
+    def _text(self, mm, start, end):
+        return mm[start:min(end, start + self.MAX_LINE)].decode("utf-8", "replace")
+
+    @staticmethod
+    def _grep(window, pattern):
+        """Yield (start, end) of the lines in `window` matching `pattern`."""
+        pos = 0
+        while pos < len(window) and (match := pattern.search(window, pos)):
+            start = window.rfind(b"\n", 0, match.start()) + 1
+            end = window.find(b"\n", match.start())
+            end = len(window) if end < 0 else end
+            yield start, end
+            pos = end + 1
+
+    def _backward(self, mm, stop, count, pattern):
+        """Spans of the last `count` lines (matching `pattern`) ending at `stop`, and the scan start."""
+        if not pattern:
+            newline = stop
+            for _ in range(count):
+                newline = mm.rfind(b"\n", 0, newline)
+                if newline < 0:
+                    break
+            spans, pos = [], newline + 1
+            while (newline := mm.find(b"\n", pos, stop)) >= 0:
+                spans.append((pos, newline))
+                pos = newline + 1
+            return spans + [(pos, stop)], spans[0][0] if spans else pos
+        spans, hi, scanned = [], stop, 0
+        while hi > 0 and len(spans) < count and scanned < self.MAX_SCAN:
+            lo = max(0, hi - self.SCAN_SIZE)
+            lo = mm.rfind(b"\n", 0, lo) + 1 if lo else 0
+            spans[:0] = [(lo + a, lo + b) for a, b in self._grep(mm[lo:hi], pattern)]
+            scanned += hi - lo
+            hi = lo
+        if len(spans) >= count:
+            spans = spans[-count:]
+            hi = spans[0][0]
+        return spans, hi
+
+    def _forward(self, mm, start, limit, count, pattern):
+        """Spans and line offsets (from `start`) of the first `count` lines matching `pattern`,
+        and where the scan stopped. Only lines ending in a newline before `limit` are read."""
+        spans, pos, line = [], start, 0
+        if not pattern:
+            while len(spans) < count and (newline := mm.find(b"\n", pos, limit)) >= 0:
+                spans.append((pos, newline, line))
+                pos, line = newline + 1, line + 1
+            return spans, pos
+        scanned = 0
+        while pos < limit and scanned < self.MAX_SCAN:
+            hi = mm.rfind(b"\n", pos, min(limit, pos + self.SCAN_SIZE)) + 1 or mm.find(b"\n", pos, limit) + 1
+            if not hi:
+                break
+            window, seen = mm[pos:hi], 0
+            for a, b in self._grep(window, pattern):
+                line += window.count(b"\n", seen, a)
+                seen = a
+                spans.append((pos + a, pos + b, line))
+                if len(spans) == count:
+                    return spans, pos + b + 1
+            line += window.count(b"\n", seen)
+            scanned += hi - pos
+            pos = hi
+        return spans, pos
+
+    def read(self, tail=None, before=None, from_line=None, after=None, count=None, pattern=None):
+        """Query the log: `tail` lines before byte `before`, `count` lines from line `from_line`
+        or complete lines after byte `after`, optionally only those matching `pattern`."""
+        count = min(count or tail or 500, self.MAX_COUNT)
+        with open(self.path, "rb") as f:
+            st = os.fstat(f.fileno())
+            self._sync(st)
+            size = st.st_size
+            if not size:
+                return {"size": 0, "lines": [], "start": 0, "end": 0, "more": False,
+                        **({"total_lines": 0, "line_numbers": [], "next_line": 0} if from_line is not None else {})}
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                # Only complete lines are served: one still being written shows up next time
+                complete = mm.rfind(b"\n") + 1
+                result = {"size": size}
+                if from_line is not None:
+                    start = self._line_start(mm, size, from_line)
+                    spans, stop = self._forward(mm, start, complete, count, pattern)
+                    total = self._line_number(mm, size, complete)
+                    next_line = self._line_number(mm, size, stop)
+                    result.update(total_lines=total, from_line=from_line,
+                                  line_numbers=[from_line + line for _, _, line in spans],
+                                  next_line=next_line, more=next_line < total)
+                elif after is not None:
+                    spans, stop = self._forward(mm, min(after, complete), complete, count, pattern)
+                    result.update(start=min(after, complete), end=stop, more=stop < complete)
+                else:
+                    end = complete if before is None else min(before, complete)
+                    if not end:
+                        return {**result, "lines": [], "start": 0, "end": 0, "more": False}
+                    spans, start = self._backward(mm, end - 1, count, pattern)
+                    result.update(start=start, end=end, more=start > 0)
+                result["lines"] = [self._text(mm, span[0], span[1]) for span in spans]
+            return result
+
+
+class UploadSession:
+    """A resumable upload: byte ranges are written with os.pwrite into a preallocated part file.
+
+    The received ranges are kept merged and saved next to the part file,
+    so a client can ask where to continue after a disconnect, even when
+    the server was restarted in between.
+    """
+
+    def __init__(self, session_id, part_path, size, sha256=None, received=None, updated=None, info=None):
+        self.id = session_id
+        self.part_path = part_path
+        self.meta_path = part_path + ".json"
+        self.size = size
+        self.sha256 = sha256
+        self.received = received or []
+        self.updated = updated or time.time()
+        self.info = info or {}
+        self.header_checked = False
+        self.lock = threading.Lock()
+        self.fd = os.open(part_path, os.O_RDWR)
+        self.writers = 0
+        self.closed = False
+
+    @classmethod
+    def create(cls, session_id, part_path, size, sha256=None, info=None):
+        fd = os.open(part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if size:
+                os.posix_fallocate(fd, 0, size)
+        except OSError:
+            os.close(fd)
+            os.unlink(part_path)
+            raise
+        os.close(fd)
+        session = cls(session_id, part_path, size, sha256, info=info)
+        session.save()
+        return session
+
+    @classmethod
+    def load(cls, meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        return cls(meta['id'], meta_path[:-len(".json")], meta['size'], meta.get('sha256'),
+                   meta.get('received'), meta.get('updated'), meta.get('info'))
+
+    def save(self):
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({'id': self.id, 'size': self.size, 'sha256': self.sha256,
+                       'received': self.received, 'updated': self.updated, 'info': self.info}, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def write(self, offset, data):
+        # Concurrent chunks share the descriptor; close() waits for them
+        with self.lock:
+            if self.closed:
+                raise FileNotFoundError("Upload session was closed")
+            self.writers += 1
+        try:
+            chunk = memoryview(data)
+            while chunk:
+                written = os.pwrite(self.fd, chunk, offset)
+                chunk = chunk[written:]
+                offset += written
+        finally:
+            with self.lock:
+                self.writers -= 1
+                if self.closed and not self.writers:
+                    self._close_fd()
+
+    def add_range(self, start, end):
+        with self.lock:
+            if start >= end or self.closed:
+                return
+            merged = []
+            for first, last in sorted(self.received + [[start, end]]):
+                if merged and first <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], last)
+                else:
+                    merged.append([first, last])
+            self.received = merged
+            self.updated = time.time()
+            self.save()
+
+    @property
+    def offset(self):
+        """Length of the contiguous prefix received so far."""
+        received = self.received
+        return received[0][1] if received and received[0][0] == 0 else 0
+
+    @property
+    def complete(self):
+        return self.offset == self.size
+
+    def head(self, length):
+        return os.pread(self.fd, length, 0)
+
+    def missing(self, chunk_size):
+        """Byte ranges not received yet, split into at most chunk_size pieces."""
+        ranges = []
+        pos = 0
+        for first, last in self.received + [[self.size, self.size]]:
+            for start in range(pos, first, chunk_size):
+                ranges.append((start, min(start + chunk_size, first)))
+            pos = max(pos, last)
+        return ranges
+
+    def state(self):
+        return {'id': self.id, 'size': self.size, 'offset': self.offset,
+                'received': self.received, 'complete': self.complete}
+
+    def _close_fd(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if not self.writers:
+                self._close_fd()
+
+    def remove(self):
+        self.close()
+        for path in (self.part_path, self.meta_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class RangeDownloadUnsupported(Exception):
+    pass
+
+
+class RangeDownloader:
+    """Downloads a URL as concurrent byte ranges into a preallocated file.
+
+    The URL is resolved once: redirects are followed with a one byte range
+    request, which also gives the size and a validator. `connections`
+    workers then fetch CHUNK_SIZE ranges over keep-alive connections with
+    If-Range and write them in place. Progress is kept in an UploadSession
+    beside target_path, so a later run for the same URL and validator only
+    fetches what is still missing.
+    """
+
+    CHUNK_SIZE = 8 * 1024 * 1024
+    BLOCK_SIZE = 256 * 1024
+    HEAD_SIZE = 192
+    MAX_REDIRECTS = 5
+    RETRIES = 5
+
+    def __init__(self, url, target_path, connections=4, timeout=30, ca_file=None):
+        self.url = url
+        self.target_path = target_path
+        self.part_path = target_path + ".part"
+        self.connections = max(1, connections)
+        self.timeout = timeout
+        self.ca_file = ca_file
+        self.final_url = None
+        self.size = None
+        self.validator = None
+        self.done_bytes = 0
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.error = None
+
+    def cancel(self):
+        self.stop.set()
+
+    def _connect(self, parsed):
+        if parsed.scheme == "https":
+            if ssl is None:
+                raise RangeDownloadUnsupported("No TLS support in Python")
+            context = ssl.create_default_context(cafile=self.ca_file)
+            return http.client.HTTPSConnection(parsed.hostname, parsed.port, timeout=self.timeout, context=context)
+        if parsed.scheme == "http":
+            return http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=self.timeout)
+        raise RangeDownloadUnsupported(f"Unsupported URL scheme: {parsed.scheme}")
+
+    @staticmethod
+    def _request_target(parsed):
+        return (parsed.path or "/") + (f"?{parsed.query}" if parsed.query else "")
+
+    def resolve(self):
+        url = self.url
+        for _ in range(self.MAX_REDIRECTS + 1):
+            parsed = urlparse(url)
+            conn = self._connect(parsed)
+            try:
+                try:
+                    conn.request("GET", self._request_target(parsed), headers={"Range": "bytes=0-0"})
+                    resp = conn.getresponse()
+                except OSError as e:
+                    # e.g. no CA certificates; the download command may still manage
+                    if ssl and isinstance(e, ssl.SSLError):
+                        raise RangeDownloadUnsupported(f"TLS failed ({e})")
+                    raise
+                if resp.status in (301, 302, 303, 307, 308) and resp.getheader("Location"):
+                    url = urljoin(url, resp.getheader("Location"))
+                    continue
+                if resp.status == 200:
+                    raise RangeDownloadUnsupported("Server does not support range requests")
+                if resp.status != 206:
+                    raise RuntimeError(f"HTTP {resp.status} {resp.reason}")
+                match = re.fullmatch(r'bytes 0-0/(\d+)', resp.getheader("Content-Range", ""))
+                if not match:
+                    raise RangeDownloadUnsupported("Server did not report the file size")
+                self.final_url = url
+                self.size = int(match.group(1))
+                # If-Range only accepts strong validators
+                etag = resp.getheader("ETag")
+                self.validator = etag if etag and not etag.startswith("W/") else resp.getheader("Last-Modified")
+                return
+            finally:
+                conn.close()
+        raise RuntimeError("Too many redirects")
+
+    def _open_session(self):
+        info = {'url': self.url, 'validator': self.validator}
+        meta_path = self.part_path + ".json"
+        if self.validator and os.path.exists(meta_path):
+            try:
+                session = UploadSession.load(meta_path)
+                if session.size == self.size and session.info == info:
+                    return session
+                session.remove()
+            except (OSError, ValueError, KeyError):
+                pass
+        os.makedirs(os.path.dirname(self.part_path), exist_ok=True)
+        return UploadSession.create("download", self.part_path, self.size, info=info)
+
+    def _worker(self, session, queue):
+        parsed = urlparse(self.final_url)
+        headers = {"If-Range": self.validator} if self.validator else {}
+        buf = memoryview(bytearray(self.BLOCK_SIZE))
+        conn = None
+        try:
+            while not self.stop.is_set():
+                with self.lock:
+                    if not queue:
+                        return
+                    start, end = queue.popleft()
+                pos = start
+                for attempt in range(self.RETRIES + 1):
+                    try:
+                        if conn is None:
+                            conn = self._connect(parsed)
+                        conn.request("GET", self._request_target(parsed),
+                                     headers={"Range": f"bytes={pos}-{end - 1}", **headers})
+                        resp = conn.getresponse()
+                        if resp.status != 206 or not resp.getheader("Content-Range", "").startswith(f"bytes {pos}-{end - 1}/"):
+                            # 200 means If-Range failed: the file changed under us
+                            raise RuntimeError(f"Unexpected range response: HTTP {resp.status} {resp.reason}")
+                        while pos < end and not self.stop.is_set():
+                            n = resp.readinto(buf[:min(len(buf), end - pos)])
+                            if not n:
+                                raise ConnectionError("Connection closed mid-range")
+                            session.write(pos, buf[:n])
+                            pos += n
+                            with self.lock:
+                                self.done_bytes += n
+                        break
+                    except (OSError, http.client.HTTPException):
+                        if conn:
+                            conn.close()
+                            conn = None
+                        if attempt == self.RETRIES or self.stop.is_set():
+                            raise
+                        self.stop.wait(min(2 ** attempt, 30))
+                    finally:
+                        session.add_range(start, pos)
+                        start = pos
+                if pos < end:
+                    return
+        except BaseException as e:
+            if not self.error:
+                self.error = e
+            self.stop.set()
+        finally:
+            if conn:
+                conn.close()
+
+    def _join(self, workers):
+        if any(worker.is_alive() for worker in workers):
+            self.stop.set()
+        for worker in workers:
+            worker.join(self.timeout)
+
+    def _progress_line(self, started, start_bytes):
+        elapsed = time.monotonic() - started
+        rate = (self.done_bytes - start_bytes) / elapsed if elapsed > 0 else 0
+        eta = f"{(self.size - self.done_bytes) / rate:.0f}" if rate else "-"
+        return f"PROGRESS: bytes={self.done_bytes} total={self.size} rate={rate:.0f} eta={eta}\n"
+
+    def download(self, progress=None, head_check=None, interval=1.0):
+        """Fetch everything still missing, returns the size once target_path is complete.
+
+        progress(line) is called from this thread about every interval
+        seconds; head_check(data) gets the first HEAD_SIZE bytes as soon as
+        they are in and may raise to abandon the download.
+        """
+        self.resolve()
+        session = self._open_session()
+        workers = []
+        try:
+            queue = deque(session.missing(self.CHUNK_SIZE))
+            self.done_bytes = self.size - sum(end - start for start, end in queue)
+            start_bytes = self.done_bytes
+            started = time.monotonic()
+            workers = [threading.Thread(target=self._worker, args=(session, queue), daemon=True)
+                       for _ in range(min(self.connections, len(queue)))]
+            for worker in workers:
+                worker.start()
+            head_pending = head_check is not None
+            while any(worker.is_alive() for worker in workers):
+                if self.stop.wait(interval):
+                    break
+                if head_pending and session.offset >= min(self.size, self.HEAD_SIZE):
+                    head_pending = False
+                    head_check(session.head(min(self.size, self.HEAD_SIZE)))
+                if progress and not self.stop.is_set():
+                    progress(self._progress_line(started, start_bytes))
+            self._join(workers)
+            if self.error:
+                raise self.error
+            if self.stop.is_set():
+                raise RuntimeError("Download cancelled")
+            if head_pending:
+                head_check(session.head(min(self.size, self.HEAD_SIZE)))
+        except FirmwareVerifyError:
+            self._join(workers)
+            session.remove()
+            raise
+        except BaseException:
+            # The part file and received ranges stay for the next attempt
+            self._join(workers)
+            session.close()
+            raise
+        session.close()
+        if not session.complete:
+            raise RuntimeError("Download incomplete")
+        os.replace(self.part_path, self.target_path)
+        os.unlink(session.meta_path)
+        return self.size
+
+
+class ActionJob:
+    """One run of an action command.
+
+    Output is appended to a spill file and its last RING_SIZE bytes stay in
+    memory, so any number of readers can follow it and reconnect at a byte
+    offset after the request that started it has gone. The job info is kept
+    next to the spill file so finished jobs survive a server restart.
+    """
+
+    RING_SIZE = 64 * 1024
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, job_id, action, cfg, spill_path):
+        self.id = job_id
+        self.action = action
+        self.label = cfg.get("label", action)
+        self.lock = cfg.get("lock")
+        self.background = bool(cfg.get("background"))
+        self.state = "queued"
+        self.exit_code = None
+        self.started = time.time()
+        self.finished = None
+        self.size = 0
+        self.head_size = 0
+        self.ring = bytearray()
+        self.followers = 0
+        self.spill_path = spill_path
+        self.info_path = os.path.splitext(spill_path)[0] + ".json"
+        self.spill = open(spill_path, "w+b", buffering=0)
+        self.cond = threading.Condition()
+        self._save_info()
+
+    @classmethod
+    def restore(cls, spill_path):
+        """Reload a job from an earlier server run; one that was still running is marked failed."""
+        with open(os.path.splitext(spill_path)[0] + ".json") as f:
+            info = json.load(f)
+        job = cls.__new__(cls)
+        job.id = info["id"]
+        job.action = info["action"]
+        job.label = info["label"]
+        job.lock = None
+        job.background = info["background"]
+        job.state = info["state"] if info["state"] in ("succeeded", "failed") else "failed"
+        job.exit_code = info["exit_code"]
+        job.started = info["started"]
+        job.finished = info["finished"] or os.path.getmtime(spill_path)
+        job.spill_path = spill_path
+        job.info_path = os.path.splitext(spill_path)[0] + ".json"
+        job.spill = open(spill_path, "rb", buffering=0)
+        job.size = os.fstat(job.spill.fileno()).st_size
+        job.head_size = job.size
+        job.ring = bytearray(os.pread(job.spill.fileno(), cls.RING_SIZE, max(0, job.size - cls.RING_SIZE)))
+        job.followers = 0
+        job.cond = threading.Condition()
+        return job
+
+    def _save_info(self):
+        tmp_path = self.info_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.info(), f)
+        os.replace(tmp_path, self.info_path)
+
+    @property
+    def done(self):
+        return self.state in ("succeeded", "failed")
+
+    def append(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self.cond:
+            self.spill.write(data)
+            self.ring += data
+            del self.ring[:-self.RING_SIZE]
+            self.size += len(data)
+            self.cond.notify_all()
+
+    def finish(self, exit_code):
+        with self.cond:
+            self.exit_code = exit_code
+            self.state = "succeeded" if exit_code == 0 else "failed"
+            self.finished = time.time()
+            self.cond.notify_all()
+        self._save_info()
+
+    def read(self, offset, timeout=0):
+        """Up to READ_SIZE bytes from `offset`, waiting up to `timeout` for output; returns (data, done)."""
+        with self.cond:
+            if timeout and offset >= self.size and not self.done:
+                self.cond.wait(timeout)
+            offset = min(offset, self.size)
+            ring_start = self.size - len(self.ring)
+            if offset >= ring_start:
+                data = bytes(self.ring[offset - ring_start:offset - ring_start + self.READ_SIZE])
+            else:
+                data = os.pread(self.spill.fileno(), min(self.READ_SIZE, ring_start - offset), offset)
+            return data, self.done and offset + len(data) >= self.size
+
+    def info(self):
+        return {
+            "id": self.id,
+            "action": self.action,
+            "label": self.label,
+            "state": self.state,
+            "background": self.background,
+            "exit_code": self.exit_code,
+            "started": self.started,
+            "finished": self.finished,
+            "size": self.size
+        }
+
+    def close(self):
+        self.spill.close()
+        for path in (self.spill_path, self.info_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class JobLocked(Exception):
+    def __init__(self, job):
+        super().__init__(f"{job.label} is running (job {job.id})")
+        self.job = job
+
+
+class JobManager:
+    """Runs action commands as jobs that outlive the request that started them.
+
+    A trigger of an action that is already running joins that job, and
+    actions sharing a `lock` name never run at the same time. Actions that
+    defer while printing wait in the "deferred" state for an idle printer. Finished jobs
+    are kept (with their output) until `keep` newer ones have finished, also
+    across restarts of the server, and while anyone still reads their output.
+    A job's command runs in its own session, so a timeout kills its children too.
+    """
+
+    ID_RE = re.compile(r'[0-9a-f]{16}')
+
+    def __init__(self, spill_dir, keep=20, max_running=None, timeout=None, monitor=None):
+        self.spill_dir = spill_dir
+        self.monitor = monitor
+        self.keep = keep
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_running) if max_running else None
+        self.jobs = {}
+        self.lock = threading.Lock()
+        os.makedirs(spill_dir, exist_ok=True)
+        self._restore()
+
+    def _restore(self):
+        paths = sorted(glob.glob(os.path.join(self.spill_dir, "job-*.log")), key=os.path.getmtime)
+        jobs = []
+        for path in paths:
+            try:
+                jobs.append(ActionJob.restore(path))
+            except (OSError, ValueError, KeyError) as e:
+                log(f"Dropping job output {path}: {e}")
+                for stale in (path, os.path.splitext(path)[0] + ".json"):
+                    try:
+                        os.unlink(stale)
+                    except FileNotFoundError:
+                        pass
+        for job in sorted(jobs, key=lambda job: job.finished):
+            self.jobs[job.id] = job
+        self._prune()
+
+    def start(self, action, cfg):
+        """Start `action`, returns (job, created); raises JobLocked if its lock is taken."""
+        with self.lock:
+            for job in self.jobs.values():
+                if job.done:
+                    continue
+                if job.action == action:
+                    return job, False
+                if cfg.get("lock") and job.lock == cfg.get("lock"):
+                    raise JobLocked(job)
+            job_id = secrets.token_hex(8)
+            job = ActionJob(job_id, action, cfg, os.path.join(self.spill_dir, f"job-{job_id}.log"))
+            self.jobs[job_id] = job
+            self._prune()
+        if cfg.get("background") and defers_while_printing(cfg) and self.monitor and self.monitor.busy:
+            job.append(f"=== {action} ===\n{cfg['message']}\n\nSUCCESS: Scheduled to run once the printer is idle\n")
+        elif cfg.get("background"):
+            job.append(f"=== {action} ===\n{cfg['message']}\n\nSUCCESS: Completed successfully\n")
+        else:
+            job.append(f"=== {job.label} ===\n{cfg['message']}\n\n")
+        # What a background action answers with, anything later is only in the job log
+        job.head_size = job.size
+        threading.Thread(target=self._run, args=(job, cfg), name=f"job-{action}", daemon=True).start()
+        return job, True
+
+    def _prune(self):
+        # Jobs whose output is being read are kept on top of `keep`
+        finished = [job for job in self.jobs.values() if job.done and not job.followers]
+        for job in finished[:-self.keep]:
+            self.jobs.pop(job.id).close()
+
+    @contextlib.contextmanager
+    def follow(self, job_id):
+        """Yield the job for reading its output, or None; it is not pruned meanwhile."""
+        with self.lock:
+            job = self.jobs.get(job_id) if self.ID_RE.fullmatch(job_id or '') else None
+            if job:
+                job.followers += 1
+        try:
+            yield job
+        finally:
+            if job:
+                with self.lock:
+                    job.followers -= 1
+                    self._prune()
+
+    def _defer(self, job):
+        monitor = self.monitor
+        if not monitor or not monitor.busy:
+            return
+        job.state = "deferred"
+        entry_id = monitor.enqueue("action", job.action)
+        try:
+            job.append(monitor.waiting_message())
+            while not monitor.wait_idle(DEFER_REPORT_INTERVAL):
+                job.append(monitor.waiting_message())
+            job.append("Printer is idle, continuing.\n")
+        finally:
+            monitor.dequeue(entry_id)
+            job.state = "queued"
+
+    def _run(self, job, cfg):
+        background = cfg.get("background")
+        if defers_while_printing(cfg):
+            self._defer(job)
+        slots = self.slots if not background else None
+        if slots and not slots.acquire(blocking=False):
+            job.append("Waiting for a free process slot...\n")
+            slots.acquire()
+        timer = None
+        try:
+            job.state = "running"
+            process = subprocess.Popen(cfg["cmd"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                       start_new_session=True)
+            if self.timeout and not background:
+                timer = threading.Timer(self.timeout, kill_process_group, args=(process,))
+                timer.start()
+            with process.stdout:
+                while chunk := os.read(process.stdout.fileno(), 64 * 1024):
+                    job.append(chunk)
+            exit_code = process.wait()
+            if timer and not timer.is_alive():
+                job.append(f"\nERROR: Command timed out after {self.timeout:g}s\n")
+            elif exit_code == 0 and not background:
+                job.append(f"\nSUCCESS: Completed successfully (exit code: 0)\n")
+            elif not background:
+                job.append(f"\nERROR: Failed with exit code: {exit_code}\n")
+        except Exception as e:
+            log(f"Action error: {e}")
+            job.append(f"\nError: {e}\n")
+            exit_code = -1
+        finally:
+            if timer:
+                timer.cancel()
+            if slots:
+                slots.release()
+        log(f"Job {job.id} ({job.action}) finished: {exit_code}")
+        job.finish(exit_code)
+
+    def get(self, job_id):
+        if not self.ID_RE.fullmatch(job_id or ''):
+            return None
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return [job.info() for job in self.jobs.values()]
+
+
+class UploadSessionStore:
+    """Resumable upload sessions kept in one directory, at most max_sessions at a time."""
+
+    ID_RE = re.compile(r'[0-9a-f]{16}')
+
+    def __init__(self, directory, ttl=24 * 3600, max_sessions=2):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = None
+        self.lock = threading.Lock()
+
+    def _load(self):
+        # Pick up sessions left behind by a previous run
+        if self.sessions is not None:
+            return
+        self.sessions = {}
+        for meta_path in glob.glob(os.path.join(self.directory, "upload-*.part.json")):
+            try:
+                session = UploadSession.load(meta_path)
+            except (OSError, ValueError, KeyError) as e:
+                log(f"Dropping upload session {meta_path}: {e}")
+                for path in (meta_path, meta_path[:-len(".json")]):
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                continue
+            self.sessions[session.id] = session
+
+    def _expire(self):
+        now = time.time()
+        for session in list(self.sessions.values()):
+            if now - session.updated > self.ttl:
+                log(f"Upload session {session.id} expired")
+                self.sessions.pop(session.id).remove()
+
+    def create(self, size, sha256=None):
+        with self.lock:
+            self._load()
+            self._expire()
+            while len(self.sessions) >= self.max_sessions:
+                oldest = min(self.sessions.values(), key=lambda s: s.updated)
+                self.sessions.pop(oldest.id).remove()
+            os.makedirs(self.directory, exist_ok=True)
+            session_id = secrets.token_hex(8)
+            part_path = os.path.join(self.directory, f"upload-{session_id}.part")
+            session = UploadSession.create(session_id, part_path, size, sha256)
+            self.sessions[session_id] = session
+            return session
+
+    def get(self, session_id):
+        if not self.ID_RE.fullmatch(session_id or ''):
+            return None
+        with self.lock:
+            self._load()
+            return self.sessions.get(session_id)
+
+    def pop(self, session_id):
+        """Take a session out of the store, its part file stays until the caller removes it."""
+        with self.lock:
+            self._load()
+            session = self.sessions.pop(session_id, None)
+        if session:
+            try:
+                os.unlink(session.meta_path)
+            except FileNotFoundError:
+                pass
+        return session
+
+
+class MultipartFileReceiver:
+    """Incremental multipart/form-data parser writing one file field straight to target_path.
+
+    The body is read into a fixed bytearray with readinto() and scanned in
+    place through a memoryview, so the work per byte stays constant however large the
+    upload is. Only a delimiter-sized tail is ever moved. An optional
+    verifier sees the file content before it is written.
+    """
+
+    BUFFER_SIZE = 256 * 1024
+    HEADER_LIMIT = 16 * 1024
+
+    PREAMBLE, DELIMITER, HEADERS, BODY, EPILOGUE = range(5)
+
+    def __init__(self, field_name, target_path, boundary, verifier=None):
+        self.field_name = field_name
+        self.verifier = verifier
+        self.target_path = target_path
+        self.delimiter = b"\r\n--" + boundary.encode("latin-1")
+        self.buf = bytearray(self.BUFFER_SIZE)
+        self.view = memoryview(self.buf)
+        # The first boundary has no preceding CRLF; pretend it does so every
+        # delimiter looks the same to the scanner.
+        self.buf[0:2] = b"\r\n"
+        self.start = 0
+        self.end = 2
+        self.state = self.PREAMBLE
+        self.in_target = False
+        self.found = False
+        self.done = False
+        self.file_size = 0
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        try:
+            os.unlink(target_path)
+        except FileNotFoundError:
+            pass
+        self.tf = open(target_path, "wb", buffering=0)
+        fcntl.flock(self.tf, fcntl.LOCK_EX)
+
+    @staticmethod
+    def boundary(content_type):
+        msg = email.message.Message()
+        msg["Content-Type"] = content_type
+        boundary = msg.get_param("boundary")
+        return boundary if isinstance(boundary, str) and 0 < len(boundary) <= 200 else None
+
+    def space(self, limit=None):
+        """Writable memoryview after the buffered data, for rfile.readinto()."""
+        self._compact()
+        size = len(self.buf) - self.end
+        if limit is not None:
+            size = min(size, limit)
+        return self.view[self.end:self.end + size]
+
+    def commit(self, n):
+        """Account for n bytes read into space(), returns True once the file part has ended."""
+        self.end += n
+        self._process()
+        return self.done
+
+    def _compact(self):
+        if self.start == 0:
+            return
+        pending = self.end - self.start
+        if pending:
+            self.buf[0:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def _write(self, start, end):
+        if not self.in_target or start >= end:
+            return
+        chunk = self.view[start:end]
+        if self.verifier:
+            self.verifier.update(chunk)
+        while chunk:
+            written = self.tf.write(chunk)
+            chunk = chunk[written:]
+        self.file_size += end - start
+
+    def _process(self):
+        while True:
+            if self.state in (self.PREAMBLE, self.BODY):
+                pos = self.buf.find(self.delimiter, self.start, self.end)
+                if pos == -1:
+                    # Everything but a possible partial delimiter is content
+                    keep = min(len(self.delimiter) - 1, self.end - self.start)
+                    if self.state == self.BODY:
+                        self._write(self.start, self.end - keep)
+                    self.start = self.end - keep
+                    return
+                if self.state == self.BODY:
+                    self._write(self.start, pos)
+                    if self.in_target:
+                        self.in_target = False
+                        self.done = True
+                self.start = pos + len(self.delimiter)
+                self.state = self.DELIMITER
+
+            elif self.state == self.DELIMITER:
+                # "--" closes the body, otherwise optional padding then CRLF
+                line_end = self.buf.find(b"\r\n", self.start, self.end)
+                if self.end - self.start >= 2 and self.buf[self.start:self.start + 2] == b"--":
+                    self.state = self.EPILOGUE
+                    continue
+                if line_end == -1:
+                    if self.end - self.start > 1024:
+                        raise ValueError("Malformed multipart boundary line")
+                    return
+                if self.buf[self.start:line_end].strip(b" \t"):
+                    raise ValueError("Malformed multipart boundary line")
+                self.start = line_end + 2
+                self.state = self.HEADERS
+
+            elif self.state == self.HEADERS:
+                # A part without headers starts its content right away
+                if self.buf.startswith(b"\r\n", self.start, self.end):
+                    header_end = self.start
+                else:
+                    header_end = self.buf.find(b"\r\n\r\n", self.start, self.end)
+                    if header_end == -1:
+                        if self.end - self.start > self.HEADER_LIMIT:
+                            raise ValueError("Multipart part headers too large")
+                        return
+                    header_end += 2
+                self._start_part(bytes(self.view[self.start:header_end]))
+                self.start = header_end + 2
+                self.state = self.BODY
+
+            else:
+                # Epilogue: discard whatever follows the closing delimiter
+                self.start = self.end
+                return
+
+    def _start_part(self, header_block):
+        headers = email.parser.BytesHeaderParser().parsebytes(header_block)
+        disposition = email.message.Message()
+        disposition["Content-Disposition"] = headers.get("Content-Disposition", "")
+        name = disposition.get_param("name", header="content-disposition")
+        self.in_target = not self.found and name == self.field_name
+        if self.in_target:
+            self.found = True
+
+    def finish(self):
+        """Close the file, returns (target_path, size) or (None, 0) when the field was not sent."""
+        self.tf.close()
+        if self.done:
+            return self.target_path, self.file_size
+        self.abort()
+        if self.found:
+            raise ValueError("Upload ended before the closing boundary")
+        return None, 0
+
+    def abort(self):
+        self.tf.close()
+        try:
+            os.unlink(self.target_path)
+        except Exception:
+            pass
+
 class FirmwareConfigHandler(SimpleHTTPRequestHandler):
     html_dir = None
-    functions = {'settings': {}, 'links': {}, 'actions': {}, 'status': {}, 'upgrade_url': {}, 'upgrade_upload': {}}
+    functions = {'settings': {}, 'links': {}, 'actions': {}, 'status': {}, 'status_sources': {}, 'upgrade_url': {}, 'upgrade_upload': {}, 'logs': {}}
+    status_refresher = None
+    extended_config = ExtendedConfigReader()
+    settings_cache = SettingsCache()
+    request_pool = None
+    event_broker = None
+    upload_sessions = None
+    jobs = None
+    print_monitor = None
+    log_indexes = {}
+    log_indexes_lock = threading.Lock()
+    events_heartbeat = 15
+    static_gzip = {}
+    static_gzip_lock = threading.Lock()
+    request_slots = None
+    request_timeout = 30
+    protocol_version = "HTTP/1.1"
+    chunked = False
+    holds_slot = False
+    COMPRESSIBLE_TYPES = ('.html', '.js', '.css', '.json', '.svg')
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=self.html_dir, **kwargs)
@@ -65,6 +2405,45 @@ class FirmwareConfigHandler(SimpleHTTPRequestHandler):
     def log_message(self, _format, *_args):
         pass
 
+    def handle_one_request(self):
+        # An idle kept-alive connection waits up to `timeout` for its next request
+        # line, the headers, body and every write then get request_timeout each
+        self.connection.settimeout(self.timeout)
+        try:
+            super().handle_one_request()
+        finally:
+            if self.holds_slot:
+                self.holds_slot = False
+                self.request_slots.release()
+
+    def parse_request(self):
+        self.connection.settimeout(self.request_timeout)
+        if not super().parse_request():
+            return False
+        if self.request_slots is None or urlparse(self.path).path == "/api/events":
+            # Event streams are idle nearly all the time and hold no slot
+            return True
+        if not self.request_slots.acquire(timeout=self.request_timeout):
+            self.close_connection = True
+            self.send_error(503, "Server busy")
+            return False
+        self.holds_slot = True
+        return True
+
+    @contextlib.contextmanager
+    def _slot_released(self):
+        """Give the request slot back while only waiting (for job output or an idle printer)."""
+        if not self.holds_slot:
+            yield
+            return
+        self.holds_slot = False
+        self.request_slots.release()
+        try:
+            yield
+        finally:
+            self.request_slots.acquire()
+            self.holds_slot = True
+
     def do_GET(self):
         path = urlparse(self.path).path
         if path == "/api/status":
@@ -75,16 +2454,51 @@ class FirmwareConfigHandler(SimpleHTTPRequestHandler):
             self.handle_get_links()
         elif path == "/api/actions":
             self.handle_get_actions()
+        elif path == "/api/bootstrap":
+            self.handle_bootstrap()
+        elif path == "/api/events":
+            self.handle_events()
+        elif path == "/api/debug/cache":
+            self.handle_debug_cache()
+        elif path.startswith("/api/upgrade/sessions/"):
+            self.handle_get_upload_session(path[22:])
+        elif path.startswith("/api/action/") and path.endswith("/download"):
+            self.handle_action_download(path[12:].split('/')[0])
+        elif path == "/api/printer":
+            self.handle_get_printer()
+        elif path == "/api/jobs":
+            self.handle_get_jobs()
+        elif path.startswith("/api/jobs/") and path.endswith("/log"):
+            self.handle_job_log(path[10:-4])
+        elif path.startswith("/api/jobs/"):
+            self.handle_get_job(path[10:])
+        elif path == "/api/logs":
+            self.handle_get_logs()
+        elif path.startswith("/api/logs/"):
+            self.handle_get_log(path[10:])
         else:
             super().do_GET()
 
+    def do_HEAD(self):
+        path = urlparse(self.path).path
+        if path.startswith("/api/action/") and path.endswith("/download"):
+            self.handle_action_download(path[12:].split('/')[0], head_only=True)
+        else:
+            super().do_HEAD()
+
     def do_POST(self):
         parsed = urlparse(self.path)
         if parsed.path == "/api/upgrade/url":
             self.handle_upgrade_url()
         elif parsed.path == "/api/upgrade/upload":
             self.handle_upgrade_upload()
+        elif parsed.path == "/api/upgrade/sessions":
+            self.handle_create_upload_session()
+        elif parsed.path.startswith("/api/upgrade/sessions/") and parsed.path.endswith("/finalize"):
+            self._discard_request_body()
+            self.handle_finalize_upload_session(parsed.path[22:-9])
         elif parsed.path.startswith("/api/settings/"):
+            self._discard_request_body()
             path_parts = parsed.path[14:].split('/')
             if len(path_parts) == 2:
                 option = path_parts[0]
@@ -93,6 +2507,7 @@ class FirmwareConfigHandler(SimpleHTTPRequestHandler):
             else:
                 self.send_error(404, "Invalid settings path")
         elif parsed.path.startswith("/api/action/"):
+            self._discard_request_body()
             path_parts = parsed.path[12:].split('/')
             action = path_parts[0] if path_parts else None
             is_download = len(path_parts) > 1 and path_parts[1] == 'download'
@@ -106,21 +2521,69 @@ class FirmwareConfigHandler(SimpleHTTPRequestHandler):
         else:
             self.send_error(404, "Not Found")
 
-    def _start_text_stream(self):
+    def do_PUT(self):
+        path = urlparse(self.path).path
+        if path.startswith("/api/upgrade/sessions/"):
+            self.handle_upload_chunk(path[22:])
+        else:
+            self.close_connection = True
+            self.send_error(404, "Not Found")
+
+    def do_DELETE(self):
+        path = urlparse(self.path).path
+        self._discard_request_body()
+        if path.startswith("/api/upgrade/sessions/"):
+            self.handle_delete_upload_session(path[22:])
+        else:
+            self.send_error(404, "Not Found")
+
+    def _discard_request_body(self):
+        # Leave a kept-alive connection positioned at the next request
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            self.close_connection = True
+            return
+        remaining = int(self.headers.get("Content-Length", 0) or 0)
+        if remaining > 64 * 1024:
+            self.close_connection = True
+            return
+        while remaining > 0:
+            chunk = self.rfile.read(remaining)
+            if not chunk:
+                self.close_connection = True
+                return
+            remaining -= len(chunk)
+
+    def _start_text_stream(self, content_type="text/plain; charset=utf-8", headers=None):
         self.send_response(200)
-        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Type", content_type)
         self.send_header("X-Content-Type-Options", "nosniff")
         self.send_header("Cache-Control", "no-cache")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        # The length is unknown up front: chunked framing keeps HTTP/1.1
+        # connections reusable, HTTP/1.0 clients get a close-delimited body.
+        self.chunked = self.request_version != "HTTP/1.0"
+        if self.chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Connection", "close")
+            self.close_connection = True
         self.end_headers()
 
     def _write_stream_chunk(self, data):
         if isinstance(data, str):
             data = data.encode("utf-8")
+        if not data:
+            return
+        if self.chunked:
+            data = f"{len(data):X}\r\n".encode() + data + b"\r\n"
         self.wfile.write(data)
         self.wfile.flush()
 
     def _finish_text_stream(self):
-        pass
+        if self.chunked:
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
 
     def _stream_command(self, cmd, stop_token=None):
         process = subprocess.Popen(
@@ -144,6 +2607,7 @@ class FirmwareConfigHandler(SimpleHTTPRequestHandler):
                 pass
 
     def handle_action(self, action):
+        stream_started = False
         try:
             cfg = self._get_action_config(action)
             if not cfg:
@@ -152,227 +2616,573 @@ class FirmwareConfigHandler(SimpleHTTPRequestHandler):
 
             log(f"Action: {action}")
 
-            if cfg.get("background"):
+            if cfg.get("archive") and not cfg.get("cmd"):
                 self._start_text_stream()
-                self._write_stream_chunk(f"=== {action} ===\n")
-                self._write_stream_chunk(f"{cfg['message']}\n")
-                subprocess.Popen(cfg["cmd"], start_new_session=True)
-                self._write_stream_chunk(f"\nSUCCESS: Completed successfully\n")
+                stream_started = True
+                self._write_stream_chunk(f"=== {cfg.get('label', action)} ===\n")
+                # The download itself cannot report a wait, so it is queued here
+                if defers_while_printing(cfg):
+                    self._defer_while_printing("action", action)
+                self._write_stream_chunk(f"\nSUCCESS: The archive is collected while it downloads\n")
                 self._finish_text_stream()
             else:
-                self._start_text_stream()
-                self._write_stream_chunk(f"=== {cfg.get('label', action)} ===\n")
-                self._write_stream_chunk(f"{cfg['message']}\n")
-                self._write_stream_chunk(f"\n")
-                exit_code, _ = self._stream_command(cfg["cmd"])
-                if exit_code == 0:
-                    self._write_stream_chunk(f"\nSUCCESS: Completed successfully (exit code: 0)\n")
-                else:
-                    self._write_stream_chunk(f"\nERROR: Failed with exit code: {exit_code}\n")
+                try:
+                    job, created = self.jobs.start(action, cfg)
+                except JobLocked as e:
+                    self.send_error(409, str(e))
+                    return
+                if not created:
+                    log(f"Action {action} joins running job {job.id}")
+                self._start_text_stream(headers={"X-Job-Id": job.id})
+                stream_started = True
+                with self.jobs.follow(job.id) as job:
+                    # Background jobs answer with what they printed on start and keep running
+                    if job:
+                        self._follow_job(job, 0, until=job.head_size if cfg.get("background") else None)
                 self._finish_text_stream()
         except Exception as e:
             log(f"Action error: {e}")
-            self.send_error(500, str(e))
+            try:
+                if stream_started:
+                    self._write_stream_chunk(f"\nError: {e}\n")
+                    self._finish_text_stream()
+                else:
+                    self.send_error(500, str(e))
+            except Exception:
+                pass
 
-    def handle_action_download(self, action):
+    def _defer_while_printing(self, kind, name):
+        """Hold a streamed request until the printer is idle, reporting the wait in the stream."""
+        monitor = self.print_monitor
+        if not monitor or not monitor.busy:
+            return
+        entry_id = monitor.enqueue(kind, name)
+        try:
+            with self._slot_released():
+                self._write_stream_chunk(monitor.waiting_message())
+                while not monitor.wait_idle(DEFER_REPORT_INTERVAL):
+                    self._write_stream_chunk(monitor.waiting_message())
+            self._write_stream_chunk("Printer is idle, continuing.\n")
+        finally:
+            monitor.dequeue(entry_id)
+
+    def _follow_job(self, job, offset, until=None):
+        # The job runs on its own thread, a follower only relays its output
+        with self._slot_released():
+            while until is None or offset < until:
+                data, done = job.read(offset, timeout=self.events_heartbeat)
+                self._write_stream_chunk(data)
+                offset += len(data)
+                if done:
+                    break
+        return offset
+
+    def handle_get_printer(self):
+        if not self.print_monitor:
+            self.send_error(404, "Printer state is not monitored")
+        else:
+            self.send_json(self.print_monitor.info())
+
+    def handle_get_jobs(self):
+        self.send_json(self.jobs.list())
+
+    def handle_get_job(self, job_id):
+        job = self.jobs.get(job_id)
+        if not job:
+            self.send_error(404, f"Unknown job: {job_id}")
+        else:
+            self.send_json(job.info())
+
+    def handle_job_log(self, job_id):
+        with self.jobs.follow(job_id) as job:
+            if not job:
+                self.send_error(404, f"Unknown job: {job_id}")
+            else:
+                self._send_job_log(job)
+
+    def _send_job_log(self, job):
+        try:
+            offset = int(parse_qs(urlparse(self.path).query).get("offset", ["0"])[-1])
+        except ValueError:
+            self.send_error(400, "Invalid offset")
+            return
+        if self._query_flag('follow'):
+            self._start_text_stream(headers={"X-Job-Id": job.id, "X-Job-Offset": str(offset)})
+            self._follow_job(job, offset)
+            self._finish_text_stream()
+            return
+        # One poll: whatever is there from offset, the next offset comes back in a header
+        body = bytearray()
+        done = False
+        while len(body) < 1024 * 1024 and not done:
+            data, done = job.read(offset + len(body))
+            if not data:
+                break
+            body += data
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", len(body))
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("X-Job-State", job.state)
+        self.send_header("X-Job-Next-Offset", str(offset + len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_action_download(self, action, head_only=False):
         try:
             cfg = self._get_action_config(action)
             if not cfg:
                 self.send_error(400, f"Unknown action: {action}")
                 return
 
+            if cfg.get("archive"):
+                # Queued by the action request; a print started since then wins
+                if defers_while_printing(cfg) and self.print_monitor and self.print_monitor.busy:
+                    self.send_error(409, f"Printer is {self.print_monitor.state}, try again when it is idle")
+                    return
+                self._stream_archive(cfg["archive"], head_only)
+                return
+
             download_file = cfg.get("download_file")
 
             if not download_file:
                 self.send_error(404, f"Action {action} does not provide a download file")
                 return
 
-            if not os.path.exists(download_file):
+            try:
+                f = open(download_file, "rb")
+            except FileNotFoundError:
                 self.send_error(404, f"Download file not found: {download_file}")
                 return
 
-            filename = os.path.basename(download_file)
-            self.send_response(200)
-            self.send_header("Content-Type", "application/octet-stream")
-            self.send_header("Content-Disposition", f'attachment; filename="{filename}"')
-            self.send_header("X-Content-Type-Options", "nosniff")
-            self.end_headers()
-
-            with open(download_file, "rb") as f:
-                chunk_size = 64 * 1024
-                while True:
-                    chunk = f.read(chunk_size)
-                    if not chunk:
-                        break
-                    self.wfile.write(chunk)
+            with f:
+                st = os.fstat(f.fileno())
+                status, headers, start, end = file_response(st, self.headers, os.path.basename(download_file))
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", end - start if status in (200, 206) else
+                                 0 if status == 416 else st.st_size)
+                self.end_headers()
+                if head_only or status not in (200, 206):
+                    return
+                # Anything going wrong past this point leaves a short body
+                self.close_connection = True
+                self._send_file_range(f, start, end)
+                self.close_connection = False
         except Exception as e:
             log(f"Action error: {e}")
-            self.send_error(500, str(e))
+            if not self.close_connection:
+                self.send_error(500, str(e))
 
-    def send_json(self, data):
-        response = json.dumps(data, indent=2).encode()
+    def _stream_archive(self, archive, head_only=False):
+        try:
+            compression, level, filename = archive_options(archive, parse_qs(urlparse(self.path).query))
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        self._start_text_stream(ARCHIVE_FORMATS[compression][1],
+                                {"Content-Disposition": f'attachment; filename="{filename}"'})
+        if head_only:
+            return
+        # A failure half way can only be reported by cutting the stream short
+        close_connection, self.close_connection = self.close_connection, True
+        TarStream.build(archive, self._write_stream_chunk, compression, level)
+        self._finish_text_stream()
+        self.close_connection = close_connection
+
+    def _send_file_range(self, f, start, end):
+        sock = getattr(self, "connection", None)
+        if sock is not None:
+            # Zero copy; socket.sendfile copes with the socket timeout
+            self.wfile.flush()
+            sent = sock.sendfile(f, start, end - start)
+            if sent != end - start:
+                raise ConnectionError("File changed while sending")
+            return
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(256 * 1024, remaining))
+            if not chunk:
+                raise ConnectionError("File changed while sending")
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+
+    def _query_flag(self, name):
+        values = parse_qs(urlparse(self.path).query, keep_blank_values=True).get(name)
+        return bool(values) and values[-1] not in ('0', 'false')
+
+    def _accepts_gzip(self):
+        for token in self.headers.get('Accept-Encoding', '').split(','):
+            coding, _, params = token.partition(';')
+            if coding.strip().lower() == 'gzip':
+                params = params.replace(' ', '')
+                try:
+                    return not params.startswith('q=') or float(params[2:]) > 0
+                except ValueError:
+                    return True
+        return False
+
+    def _etag_matches(self, etag):
+        header = self.headers.get('If-None-Match')
+        if not header:
+            return False
+        # Weak comparison, as If-None-Match calls for
+        tags = [tag.strip().removeprefix('W/') for tag in header.split(',')]
+        return '*' in tags or etag.removeprefix('W/') in tags
+
+    def _send_not_modified(self, etag):
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+
+    def send_body(self, body, content_type, etag_basis=None):
+        """Send body with an ETag, answering If-None-Match with 304 and compressing when accepted.
+
+        The ETag is a strong hash of the body itself, or a weak one of
+        etag_basis: a version string known to change whenever the content
+        does, while parts like status ages may differ between equal versions.
+        """
+        use_gzip = len(body) >= GZIP_MIN_SIZE and self._accepts_gzip()
+        digest = hashlib.sha1(etag_basis if etag_basis is not None else body).hexdigest()[:20]
+        etag = f'"{digest}-gz"' if use_gzip else f'"{digest}"'
+        if etag_basis is not None:
+            etag = f"W/{etag}"
+        if self._etag_matches(etag):
+            self._send_not_modified(etag)
+            return
+
+        if use_gzip:
+            body = gzip.compress(body, compresslevel=6, mtime=0)
         self.send_response(200)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Content-Length", len(response))
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", len(body))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        if use_gzip:
+            self.send_header("Content-Encoding", "gzip")
         self.end_headers()
-        self.wfile.write(response)
+        self.wfile.write(body)
+
+    def send_json(self, data, etag_basis=None):
+        if self._query_flag('pretty'):
+            response = json.dumps(data, indent=2).encode()
+            if etag_basis is not None:
+                etag_basis += b":pretty"
+        else:
+            response = json.dumps(data, separators=(',', ':')).encode()
+        self.send_body(response, "application/json", etag_basis)
+
+    def send_head(self):
+        # Static files: strong ETag from the file stamp, gzip from a fresh
+        # .gz sidecar or compressed once in memory. Anything else (directory
+        # redirects, listings, errors) goes through SimpleHTTPRequestHandler.
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and urlparse(self.path).path.endswith('/'):
+            path = os.path.join(path, 'index.html')
+        if not path.endswith(self.COMPRESSIBLE_TYPES) or not os.path.isfile(path):
+            return super().send_head()
 
-    def _run_status_cmd(self, cmd):
         try:
-            result = subprocess.run(
-                cmd, shell=True, capture_output=True, text=True, timeout=5
-            )
-            return result.stdout.strip() if result.returncode == 0 else None
-        except Exception:
+            st = os.stat(path)
+            body = self._static_gzip(path, st) if self._accepts_gzip() else None
+            use_gzip = body is not None
+            if body is None:
+                with open(path, 'rb') as f:
+                    body = f.read()
+        except OSError:
+            self.send_error(404, "File not found")
             return None
 
-    def _check_condition(self, cmd):
-        try:
-            result = subprocess.run(cmd, shell=True, capture_output=True, timeout=5)
-            return result.returncode == 0
-        except Exception:
-            return False
+        digest = f"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
+        etag = f'"{digest}-gz"' if use_gzip else f'"{digest}"'
+        if self._etag_matches(etag):
+            self._send_not_modified(etag)
+            return None
 
-    def handle_status(self):
-        try:
-            status_config = self.functions.get('status', {})
-            result = {}
+        self.send_response(200)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", len(body))
+        self.send_header("Last-Modified", self.date_time_string(st.st_mtime))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        if use_gzip:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        return io.BytesIO(body)
 
-            for section_key, section_cfg in status_config.items():
-                if_cmd = section_cfg.get('if_cmd')
-                if if_cmd and not self._check_condition(if_cmd):
-                    continue
+    def _static_gzip(self, path, st):
+        sidecar = path + ".gz"
+        try:
+            if os.stat(sidecar).st_mtime_ns >= st.st_mtime_ns:
+                with open(sidecar, 'rb') as f:
+                    return f.read()
+        except OSError:
+            pass
 
-                section_items = []
-                has_value = False
-                for item in section_cfg.get('items', []):
-                    value = self._run_status_cmd(item['cmd']) if 'cmd' in item else None
-                    if value:
-                        has_value = True
-                    section_items.append({
-                        'label': item.get('label', ''),
-                        'value': value
-                    })
-
-                if if_cmd and not has_value:
-                    continue
+        stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self.static_gzip_lock:
+            cached = self.static_gzip.get(path)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        with open(path, 'rb') as f:
+            data = gzip.compress(f.read(), compresslevel=9, mtime=0)
+        with self.static_gzip_lock:
+            self.static_gzip[path] = (stamp, data)
+        return data
 
-                result[section_key] = {
-                    'title': section_cfg.get('title', section_key),
-                    'items': section_items
-                }
-
-            self.send_json(result)
+    def handle_status(self):
+        try:
+            version, status = self.status_refresher.versioned_snapshot()
+            self.send_json(status, etag_basis=f"status:{INSTANCE_ID}:{version}".encode())
         except Exception as e:
             log(f"Status error: {e}")
             self.send_error(500, str(e))
 
-    def _get_setting_config(self, setting_key):
-        settings = self.functions.get('settings', {})
+    @classmethod
+    def _get_setting_config(cls, setting_key):
+        settings = cls.functions.get('settings', {})
         for group_key, group_cfg in settings.items():
             items = group_cfg.get('items', {})
             if setting_key in items:
                 return items[setting_key]
         return None
 
+    @classmethod
+    def _get_setting_value(cls, setting_key, config):
+        depends_on = list(config.get("depends_on") or [])
+        if cls.extended_config.handles(config["get_cmd"]):
+            depends_on.append(config["get_cmd"][2])
+        return cls.settings_cache.get(setting_key, depends_on, lambda: cls._read_setting_value(config))
+
+    @classmethod
+    def _read_setting_value(cls, config):
+        get_cmd = config["get_cmd"]
+        try:
+            if cls.extended_config.handles(get_cmd):
+                value = cls.extended_config.get_argv(get_cmd)
+                return value if value is not None else config.get("default", "")
+
+            cmd_result = subprocess.run(
+                get_cmd,
+                capture_output=True,
+                text=True,
+                timeout=5
+            )
+            return cmd_result.stdout.strip() if cmd_result.returncode == 0 else config.get("default", "")
+        except Exception:
+            return config.get("default", "")
+
+    @classmethod
+    def _get_setting_values(cls, setting_keys=None):
+        """Current values of the given settings (all by default), evaluated concurrently."""
+        configs = {}
+        for group_cfg in cls.functions.get('settings', {}).values():
+            for setting_id, config in group_cfg.get('items', {}).items():
+                if setting_keys is None or setting_id in setting_keys:
+                    configs[setting_id] = config
+
+        futures = {setting_id: cls.request_pool.submit(cls._get_setting_value, setting_id, config)
+                   for setting_id, config in configs.items()}
+        return {setting_id: future.result() for setting_id, future in futures.items()}
+
+    def _link_setting_keys(self):
+        return {link_config["condition"]["setting"]
+                for link_config in self.functions.get('links', {}).values()
+                if link_config.get("condition")}
+
+    def _build_settings(self, setting_values):
+        settings = self.functions.get('settings', {})
+        result = {}
+        for group_key, group_cfg in settings.items():
+            group_label = group_cfg.get('label', group_key)
+            items = group_cfg.get('items', {})
+            settings_list = []
+            for setting_id, config in items.items():
+                options_data = {}
+                for opt_key, opt_val in config["options"].items():
+                    opt_info = {"label": opt_val["label"]}
+                    if "confirm" in opt_val:
+                        opt_info["confirm"] = opt_val["confirm"]
+                    options_data[opt_key] = opt_info
+
+                settings_list.append({
+                    "id": setting_id,
+                    "label": config["label"],
+                    "description": config.get("description"),
+                    "help_url": config.get("help_url"),
+                    "current": setting_values.get(setting_id),
+                    "options": options_data
+                })
+            if settings_list:
+                result[group_key] = {
+                    "label": group_label,
+                    "items": settings_list
+                }
+        return result
+
+    def _build_links(self, setting_values):
+        links_list = []
+        for _, link_config in self.functions.get('links', {}).items():
+            condition = link_config.get("condition")
+            if condition is not None and setting_values.get(condition["setting"]) != condition["value"]:
+                continue
+            links_list.append({
+                "url": link_config["url"],
+                "icon": link_config["icon"],
+                "label": link_config["label"]
+            })
+        return links_list
+
+    def _build_actions(self):
+        actions_cfg = self.functions.get('actions', {})
+        result = {}
+        for group_key, group_cfg in actions_cfg.items():
+            group_label = group_cfg.get('label', group_key)
+            items = group_cfg.get('items', {})
+            actions_list = []
+            for action_id, cfg in items.items():
+                actions_list.append({
+                    "id": action_id,
+                    "label": cfg.get("label", action_id),
+                    "description": cfg.get("description"),
+                    "help_url": cfg.get("help_url"),
+                    "confirm": cfg.get("confirm", False),
+                    "background": cfg.get("background", False),
+                    "download_file": cfg.get("download_file"),
+                    "archive": bool(cfg.get("archive"))
+                })
+            if actions_list:
+                result[group_key] = {
+                    "label": group_label,
+                    "items": actions_list
+                }
+        return result
+
     def handle_get_settings(self):
         try:
-            settings = self.functions.get('settings', {})
-            result = {}
-            for group_key, group_cfg in settings.items():
-                group_label = group_cfg.get('label', group_key)
-                items = group_cfg.get('items', {})
-                settings_list = []
-                for setting_id, config in items.items():
-                    try:
-                        cmd_result = subprocess.run(
-                            config["get_cmd"],
-                            capture_output=True,
-                            text=True,
-                            timeout=5
-                        )
-                        current_value = cmd_result.stdout.strip() if cmd_result.returncode == 0 else config.get("default", "")
-                    except Exception:
-                        current_value = config.get("default", "")
-
-                    options_data = {}
-                    for opt_key, opt_val in config["options"].items():
-                        opt_info = {"label": opt_val["label"]}
-                        if "confirm" in opt_val:
-                            opt_info["confirm"] = opt_val["confirm"]
-                        options_data[opt_key] = opt_info
-
-                    settings_list.append({
-                        "id": setting_id,
-                        "label": config["label"],
-                        "description": config.get("description"),
-                        "help_url": config.get("help_url"),
-                        "current": current_value,
-                        "options": options_data
-                    })
-                if settings_list:
-                    result[group_key] = {
-                        "label": group_label,
-                        "items": settings_list
-                    }
-
-            self.send_json(result)
+            self.send_json(self._build_settings(self._get_setting_values()))
         except Exception as e:
             log(f"Get settings error: {e}")
             self.send_error(500, str(e))
 
     def handle_get_links(self):
         try:
-            links = self.functions.get('links', {})
-            settings_cache = {}
-
-            for _, link_config in links.items():
-                condition = link_config.get("condition")
-                if condition:
-                    setting_key = condition["setting"]
-                    if setting_key not in settings_cache:
-                        setting_config = self._get_setting_config(setting_key)
-                        if setting_config:
-                            try:
-                                result = subprocess.run(
-                                    setting_config["get_cmd"],
-                                    capture_output=True,
-                                    text=True,
-                                    timeout=5
-                                )
-                                settings_cache[setting_key] = result.stdout.strip() if result.returncode == 0 else setting_config.get("default", "")
-                            except Exception:
-                                settings_cache[setting_key] = setting_config.get("default", "")
-
-            links_list = []
-            for _, link_config in links.items():
-                condition = link_config.get("condition")
-
-                if condition is None:
-                    links_list.append({
-                        "url": link_config["url"],
-                        "icon": link_config["icon"],
-                        "label": link_config["label"]
-                    })
-                else:
-                    setting_key = condition["setting"]
-                    required_value = condition["value"]
-                    current_value = settings_cache.get(setting_key)
-
-                    if current_value == required_value:
-                        links_list.append({
-                            "url": link_config["url"],
-                            "icon": link_config["icon"],
-                            "label": link_config["label"]
-                        })
-
-            self.send_json(links_list)
+            self.send_json(self._build_links(self._get_setting_values(self._link_setting_keys())))
         except Exception as e:
             log(f"Get links error: {e}")
             self.send_error(500, str(e))
 
-    def _get_action_config(self, action_key):
-        actions = self.functions.get('actions', {})
+    def handle_bootstrap(self):
+        try:
+            # Settings are read once and shared by the settings list and the
+            # link conditions. Only the per-setting reads go to request_pool:
+            # a pool task waiting on other pool tasks deadlocks once every
+            # worker is such a task.
+            setting_values = self._get_setting_values()
+            version, status = self.status_refresher.versioned_snapshot()
+            rest = {
+                'settings': self._build_settings(setting_values),
+                'links': self._build_links(setting_values),
+                'actions': self._build_actions()
+            }
+            # Status ages change on every call, so the ETag follows the
+            # status version rather than the rendered status.
+            etag_basis = f"bootstrap:{INSTANCE_ID}:{version}:".encode() + json.dumps(rest).encode()
+            self.send_json({'status': status, **rest}, etag_basis=etag_basis)
+        except Exception as e:
+            log(f"Bootstrap error: {e}")
+            self.send_error(500, str(e))
+
+    def handle_events(self):
+        broker = self.event_broker
+        seq = broker.parse_event_id(self.headers.get('Last-Event-ID'))
+        broker.subscribe()
+        try:
+            self._start_text_stream("text/event-stream", {'X-Accel-Buffering': 'no'})
+            self._write_stream_chunk("retry: 3000\n\n")
+
+            while True:
+                events = broker.events_after(seq, self.events_heartbeat)
+                if not events:
+                    self._write_stream_chunk(": keepalive\n\n")
+                message = "".join(f"id: {broker.event_id(event_seq)}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+                                  for event_seq, event, data in events)
+                self._write_stream_chunk(message)
+                if events:
+                    seq = events[-1][0]
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            broker.unsubscribe()
+
+    def handle_debug_cache(self):
+        try:
+            self.send_json({
+                'settings': self.settings_cache.stats(),
+                'extended_config_files': len(self.extended_config.files)
+            })
+        except Exception as e:
+            log(f"Debug cache error: {e}")
+            self.send_error(500, str(e))
+
+    def handle_get_logs(self):
+        logs = []
+        for name, cfg in self.functions.get('logs', {}).items():
+            try:
+                st = os.stat(cfg['path'])
+            except OSError:
+                st = None
+            logs.append({
+                "name": name,
+                "label": cfg.get("label", name),
+                "size": st.st_size if st else None,
+                "mtime": int(st.st_mtime) if st else None
+            })
+        self.send_json(logs)
+
+    @classmethod
+    def _log_index(cls, name):
+        cfg = cls.functions.get('logs', {}).get(name)
+        if not cfg:
+            return None
+        with cls.log_indexes_lock:
+            if name not in cls.log_indexes:
+                cls.log_indexes[name] = LogIndex(cfg['path'])
+            return cls.log_indexes[name]
+
+    def handle_get_log(self, name):
+        index = self._log_index(name)
+        if not index:
+            self.send_error(404, f"Unknown log: {name}")
+            return
+        query = parse_qs(urlparse(self.path).query)
+        try:
+            args = {key: int(query[key][-1]) for key in ("tail", "before", "from_line", "after", "count") if key in query}
+            if any(value < 0 for value in args.values()):
+                raise ValueError("negative value")
+            grep = query.get("grep", [""])[-1]
+            flags = re.MULTILINE | (re.IGNORECASE if self._query_flag('icase') else 0)
+            pattern = re.compile(grep.encode(), flags) if grep else None
+        except (ValueError, re.error) as e:
+            self.send_error(400, f"Invalid log query: {e}")
+            return
+        try:
+            self.send_json({"name": name, **index.read(pattern=pattern, **args)})
+        except FileNotFoundError:
+            self.send_error(404, f"Log file not found: {index.path}")
+        except Exception as e:
+            log(f"Log error: {e}")
+            self.send_error(500, str(e))
+
+    @classmethod
+    def _get_action_config(cls, action_key):
+        actions = cls.functions.get('actions', {})
         for group_key, group_cfg in actions.items():
             items = group_cfg.get('items', {})
             if action_key in items:
@@ -381,29 +3191,7 @@ class FirmwareConfigHandler(SimpleHTTPRequestHandler):
 
     def handle_get_actions(self):
         try:
-            actions_cfg = self.functions.get('actions', {})
-            result = {}
-            for group_key, group_cfg in actions_cfg.items():
-                group_label = group_cfg.get('label', group_key)
-                items = group_cfg.get('items', {})
-                actions_list = []
-                for action_id, cfg in items.items():
-                    actions_list.append({
-                        "id": action_id,
-                        "label": cfg.get("label", action_id),
-                        "description": cfg.get("description"),
-                        "help_url": cfg.get("help_url"),
-                        "confirm": cfg.get("confirm", False),
-                        "background": cfg.get("background", False),
-                        "download_file": cfg.get("download_file")
-                    })
-                if actions_list:
-                    result[group_key] = {
-                        "label": group_label,
-                        "items": actions_list
-                    }
-
-            self.send_json(result)
+            self.send_json(self._build_actions())
         except Exception as e:
             log(f"Get actions error: {e}")
             self.send_error(500, str(e))
@@ -432,9 +3220,16 @@ class FirmwareConfigHandler(SimpleHTTPRequestHandler):
             self._write_stream_chunk(f"Time: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
             self._write_stream_chunk(f"{'=' * 40}\n\n")
 
+            if defers_while_printing(config, option_config):
+                self._defer_while_printing("setting", f"{setting_key}={value}")
+
             # Execute the command for this option
             self._write_stream_chunk(f"Applying changes...\n")
-            rc, _ = self._stream_command(option_config["cmd"])
+            try:
+                rc, _ = self._stream_command(option_config["cmd"])
+            finally:
+                self.settings_cache.invalidate()
+                self.event_broker.settings_changed()
 
             self._write_stream_chunk(f"\n{'=' * 40}\n")
             if rc == 0:
@@ -457,70 +3252,127 @@ class FirmwareConfigHandler(SimpleHTTPRequestHandler):
             except Exception:
                 pass
 
-    def stream_multipart_to_file(self, field_name, target_path):
-        content_type = self.headers.get("Content-Type", "")
+    def stream_multipart_to_file(self, field_name, target_path, verifier=None):
         content_length = int(self.headers.get("Content-Length", 0))
-        boundary = None
-        for part in content_type.split(";"):
-            part = part.strip()
-            if part.startswith("boundary="):
-                boundary = part[9:].strip('"')
-                break
+        boundary = MultipartFileReceiver.boundary(self.headers.get("Content-Type", ""))
         if not boundary or content_length == 0:
             return None, 0
-        boundary_bytes = f"--{boundary}".encode()
-        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        receiver = MultipartFileReceiver(field_name, target_path, boundary, verifier)
         try:
-            os.unlink(target_path)
-        except FileNotFoundError:
-            pass
-        tf = open(target_path, "wb")
-        try:
-            fcntl.flock(tf, fcntl.LOCK_EX)
-            in_file_content = False
-            file_size = 0
-            buf = b""
-            chunk_size = 64 * 1024
+            # The whole body goes through the parser, closing boundary
+            # included, so a kept-alive connection stays in sync
             remaining = content_length
             while remaining > 0:
-                read_size = min(chunk_size, remaining)
-                chunk = self.rfile.read(read_size)
-                if not chunk:
+                n = self.rfile.readinto(receiver.space(remaining))
+                if not n:
                     break
-                remaining -= len(chunk)
-                buf += chunk
-                if not in_file_content:
-                    header_end = buf.find(b"\r\n\r\n")
-                    if header_end != -1:
-                        header_part = buf[:header_end]
-                        if field_name.encode() in header_part:
-                            in_file_content = True
-                            buf = buf[header_end + 4:]
-                        else:
-                            buf = buf[header_end + 4:]
-                if in_file_content:
-                    end_pos = buf.find(boundary_bytes)
-                    if end_pos != -1:
-                        data = buf[:end_pos]
-                        if data.endswith(b"\r\n"):
-                            data = data[:-2]
-                        tf.write(data)
-                        file_size += len(data)
-                        break
-                    else:
-                        safe_len = len(buf) - len(boundary_bytes) - 4
-                        if safe_len > 0:
-                            tf.write(buf[:safe_len])
-                            file_size += safe_len
-                            buf = buf[safe_len:]
-            tf.close()
-            return target_path, file_size
+                remaining -= n
+                receiver.commit(n)
+            if remaining > 0:
+                self.close_connection = True
+            return receiver.finish()
         except Exception:
-            tf.close()
-            try:
+            self.close_connection = True
+            receiver.abort()
+            raise
+
+    @classmethod
+    def _expected_sha256(cls, sha256=None, sha256_url=None):
+        """Client supplied SHA-256, or one fetched from a checksum sidecar URL."""
+        expected = parse_sha256(sha256)
+        if expected or not (sha256_url or '').strip():
+            return expected
+        download = cls.functions.get('upgrade_url', {}).get('download')
+        if not download:
+            raise ValueError("Checksum URLs need upgrade_url.download to be configured")
+        return fetch_sha256(download, sha256_url.strip())
+
+    def _download_upgrade(self, cfg, url, expected_sha256):
+        """Check the URL, download it through the verifier, then run the upgrade shell on the file."""
+        if cfg.get('check'):
+            rc, _ = self._stream_command(shell_to_cmd(cfg['check'], url))
+            if rc != 0:
+                return rc, False
+
+        if defers_while_printing(cfg):
+            self._defer_while_printing("upgrade", url)
+        self._write_stream_chunk("Downloading upgrade...\n")
+        verifier = FirmwareVerifier(expected_sha256) if cfg.get('verify') or expected_sha256 else None
+        target_path = cfg.get('download_path', '/tmp/url_upgrade.bin')
+        result = self._parallel_download(cfg, url, target_path, verifier) if cfg.get('parallel') else None
+        if result is None and not cfg.get('download'):
+            self._write_stream_chunk("No download command configured.\n")
+            return 1, False
+        if result is None:
+            result = self._stream_download(cfg, url, target_path, verifier)
+        rc, size, digest = result
+        if rc != 0:
+            return rc, False
+
+        self._write_stream_chunk(f"Download complete: {size} bytes\n")
+        if verifier:
+            self._write_stream_chunk(verifier.summary(digest))
+        return self._stream_command(shell_to_cmd(cfg.get('shell'), target_path),
+                                    stop_token=cfg.get('stop_token'))
+
+    def _parallel_download(self, cfg, url, target_path, verifier):
+        """Download with RangeDownloader, returns (rc, size, digest) or None when ranges cannot be used."""
+        downloader = RangeDownloader(url, target_path, connections=int(cfg['parallel']), ca_file=cfg.get('ca_file'))
+        head_check = None
+        if verifier:
+            head_check = lambda head: FirmwareVerifier(max_size=downloader.size).update(head)
+        try:
+            size = downloader.download(self._write_stream_chunk, head_check)
+            digest = None
+            if verifier:
+                self._write_stream_chunk("Verifying image...\n")
+                digest = verify_file(target_path, verifier)
+            return 0, size, digest
+        except RangeDownloadUnsupported as e:
+            self._write_stream_chunk(f"{e}, downloading as a single stream\n")
+            return None
+        except FirmwareVerifyError as e:
+            if os.path.exists(target_path):
                 os.unlink(target_path)
-            except Exception:
-                pass
+            self._write_stream_chunk(f"Image verification failed: {e}\n")
+            return 1, 0, None
+        except (OSError, RuntimeError, http.client.HTTPException) as e:
+            resume = "The partial download is kept, retry to resume it.\n" if downloader.size else ""
+            self._write_stream_chunk(f"Download failed: {e}\n{resume}")
+            return 1, 0, None
+
+    def _stream_download(self, cfg, url, target_path, verifier):
+        """Pipe the download command through the verifier into target_path, returns (rc, size, digest)."""
+        download = VerifiedDownload(target_path, verifier)
+        process = subprocess.Popen(shell_to_cmd(cfg['download'], url), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            buf = memoryview(bytearray(256 * 1024))
+            while True:
+                n = process.stdout.readinto(buf)
+                if not n:
+                    break
+                progress = download.write(buf[:n])
+                if progress:
+                    self._write_stream_chunk(progress)
+            stderr = process.stderr.read().decode('utf-8', errors='replace').strip()
+            rc = process.wait()
+            if rc != 0:
+                download.abort()
+                self._write_stream_chunk(f"{stderr}\nFailed to download upgrade file.\n")
+                return rc, 0, None
+            return 0, download.size, download.finish()
+        except FirmwareVerifyError as e:
+            # Stop the transfer as soon as the image is known to be bad
+            process.kill()
+            process.wait()
+            download.abort()
+            self._write_stream_chunk(f"Image verification failed: {e}\n")
+            return 1, 0, None
+        except BaseException:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            download.abort()
             raise
 
     def handle_upgrade_url(self):
@@ -551,6 +3403,12 @@ class FirmwareConfigHandler(SimpleHTTPRequestHandler):
                 self.send_error(400, "Missing 'url' parameter")
                 return
 
+            try:
+                expected_sha256 = self._expected_sha256(data.get('sha256'), data.get('sha256_url'))
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+
             log(f"Upgrade from URL: {url}")
             self._start_text_stream()
             stream_started = True
@@ -559,7 +3417,10 @@ class FirmwareConfigHandler(SimpleHTTPRequestHandler):
             self._write_stream_chunk(f"Time: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
             self._write_stream_chunk(f"{'=' * 40}\n\n")
 
-            rc, stopped = self._stream_command(shell_to_cmd(shell_template, url), stop_token=stop_token)
+            if cfg.get('download') or cfg.get('parallel'):
+                rc, stopped = self._download_upgrade(cfg, url, expected_sha256)
+            else:
+                rc, stopped = self._stream_command(shell_to_cmd(shell_template, url), stop_token=stop_token)
             self._write_stream_chunk(f"\n{'=' * 40}\n")
             if rc == 0 or stopped:
                 self._write_stream_chunk("SUCCESS: Completed successfully.\n")
@@ -584,10 +3445,6 @@ class FirmwareConfigHandler(SimpleHTTPRequestHandler):
             return
 
         upload_path = cfg.get('upload_path', '/tmp/upload_file')
-        shell_template = cfg.get('shell')
-        stop_token = cfg.get('stop_token')
-
-        stream_started = False
         file_path = None
         try:
             content_type = self.headers.get("Content-Type", "")
@@ -595,46 +3452,260 @@ class FirmwareConfigHandler(SimpleHTTPRequestHandler):
                 self.send_error(400, "Expected multipart/form-data")
                 return
 
-            file_path, file_size = self.stream_multipart_to_file("file", upload_path)
+            query = parse_qs(urlparse(self.path).query)
+            try:
+                expected_sha256 = self._expected_sha256(query.get('sha256', [''])[0],
+                                                        query.get('sha256_url', [''])[0])
+            except ValueError as e:
+                self.close_connection = True
+                self.send_error(400, str(e))
+                return
+            verifier = None
+            if cfg.get('verify') or expected_sha256:
+                verifier = FirmwareVerifier(expected_sha256, max_size=int(self.headers.get("Content-Length", 0)))
+
+            try:
+                file_path, file_size = self.stream_multipart_to_file("file", upload_path, verifier)
+                digest = verifier.finish() if verifier and file_path else None
+            except FirmwareVerifyError as e:
+                # The rest of the body is not read; the connection is closed
+                if file_path:
+                    os.unlink(file_path)
+                self._reject_upload(e)
+                return
+            except ValueError as e:
+                # Truncated body, the receiver already removed the partial file
+                self.close_connection = True
+                self.send_error(400, str(e))
+                return
             if not file_path:
                 self.send_error(400, "No file in request")
                 return
 
             log(f"Uploaded: {file_path} ({file_size} bytes)")
-            self._start_text_stream()
-            stream_started = True
+            self._run_uploaded_upgrade(cfg, file_path, file_size, verifier.summary(digest) if verifier else None)
+        except Exception as e:
+            log(f"Upgrade upload error: {e}")
+            try:
+                self.send_error(500, str(e))
+            except Exception:
+                pass
+
+    def _reject_upload(self, error):
+        log(f"Upload rejected: {error}")
+        self._start_text_stream()
+        self._write_stream_chunk(f"ERROR: Image verification failed: {error}\n")
+        self._finish_text_stream()
+
+    def _run_uploaded_upgrade(self, cfg, file_path, file_size, verified=None):
+        """Stream the upgrade shell run on an uploaded file, which is removed afterwards."""
+        self._start_text_stream()
+        try:
             self._write_stream_chunk(f"=== Upgrade Started ===\n")
             self._write_stream_chunk(f"File: {file_path}\n")
             self._write_stream_chunk(f"Size: {file_size} bytes\n")
+            if verified:
+                self._write_stream_chunk(verified)
             self._write_stream_chunk(f"Time: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
             self._write_stream_chunk(f"{'=' * 40}\n\n")
 
-            try:
-                rc, stopped = self._stream_command(shell_to_cmd(shell_template, file_path), stop_token=stop_token)
-                self._write_stream_chunk(f"\n{'=' * 40}\n")
-                if rc == 0 or stopped:
-                    self._write_stream_chunk("SUCCESS: Completed successfully.\n")
-                else:
-                    self._write_stream_chunk(f"ERROR: Failed with exit code {rc}\n")
-            except Exception as e:
-                self._write_stream_chunk(f"\nError: {e}\n")
-            finally:
-                try:
-                    os.unlink(file_path)
-                except Exception:
-                    pass
+            if defers_while_printing(cfg):
+                self._defer_while_printing("upgrade", os.path.basename(file_path))
+            rc, stopped = self._stream_command(shell_to_cmd(cfg.get('shell'), file_path),
+                                               stop_token=cfg.get('stop_token'))
+            self._write_stream_chunk(f"\n{'=' * 40}\n")
+            if rc == 0 or stopped:
+                self._write_stream_chunk("SUCCESS: Completed successfully.\n")
+            else:
+                self._write_stream_chunk(f"ERROR: Failed with exit code {rc}\n")
             self._finish_text_stream()
         except Exception as e:
             log(f"Upgrade upload error: {e}")
             try:
-                if stream_started:
-                    self._write_stream_chunk(f"\nError: {e}\n")
-                    self._finish_text_stream()
-                else:
-                    self.send_error(500, str(e))
+                self._write_stream_chunk(f"\nError: {e}\n")
+                self._finish_text_stream()
+            except Exception:
+                pass
+        finally:
+            try:
+                os.unlink(file_path)
             except Exception:
                 pass
 
+    def _upload_session(self, session_id):
+        store = self.upload_sessions
+        session = store.get(session_id) if store else None
+        if not session:
+            self.send_error(404, "Unknown upload session")
+        return session
+
+    def handle_create_upload_session(self):
+        if not self.upload_sessions:
+            self._discard_request_body()
+            self.send_error(404, "Upload upgrade not configured")
+            return
+        try:
+            content_length = int(self.headers.get("Content-Length", 0))
+            data = json.loads(self.rfile.read(content_length) or b"{}")
+            size = int(data.get('size'))
+            sha256 = parse_sha256(data.get('sha256'))
+            if size <= 0:
+                raise ValueError("Upload size must be positive")
+        except (ValueError, TypeError) as e:
+            self.send_error(400, f"Invalid upload session request: {e}")
+            return
+        try:
+            session = self.upload_sessions.create(size, sha256)
+        except OSError as e:
+            self.send_error(507 if e.errno == errno.ENOSPC else 500, f"Cannot allocate upload: {e.strerror}")
+            return
+        log(f"Upload session {session.id} created ({size} bytes)")
+        self.send_json(session.state())
+
+    def handle_upload_chunk(self, session_id):
+        session = self._upload_session(session_id)
+        if not session:
+            self.close_connection = True
+            return
+        try:
+            start, end = parse_content_range(self.headers.get("Content-Range"), session.size)
+            if int(self.headers.get("Content-Length", -1)) != end - start:
+                raise ValueError("Content-Length does not match Content-Range")
+        except ValueError as e:
+            self.close_connection = True
+            self.send_error(400, str(e))
+            return
+
+        # Whatever arrived is kept, so an interrupted chunk resumes where it stopped
+        pos = start
+        buf = memoryview(bytearray(256 * 1024))
+        try:
+            while pos < end:
+                n = self.rfile.readinto(buf[:min(len(buf), end - pos)])
+                if not n:
+                    break
+                session.write(pos, buf[:n])
+                pos += n
+        except FileNotFoundError:
+            # Cancelled, rejected or finalized meanwhile
+            self.close_connection = True
+            self.send_error(404, "Unknown upload session")
+            return
+        finally:
+            session.add_range(start, pos)
+        if pos < end:
+            self.close_connection = True
+            return
+
+        error = self._check_session_header(session)
+        if error:
+            self.send_error(422, f"Image verification failed: {error}")
+            return
+        self.send_json(session.state())
+
+    @classmethod
+    def _check_session_header(cls, session):
+        """Reject a bad firmware image as soon as its header is in, returns the error if any."""
+        if session.header_checked or not cls.functions.get('upgrade_upload', {}).get('verify'):
+            return None
+        length = min(session.size, FirmwareVerifier.HEADER_SIZE + FirmwareVerifier.MAX_FILES * FirmwareVerifier.ENTRY_SIZE)
+        if session.offset < length:
+            return None
+        try:
+            FirmwareVerifier(max_size=session.size).update(session.head(length))
+        except FirmwareVerifyError as e:
+            log(f"Upload session {session.id} rejected: {e}")
+            session = cls.upload_sessions.pop(session.id)
+            if session:
+                session.remove()
+            return e
+        session.header_checked = True
+        return None
+
+    def handle_get_upload_session(self, session_id):
+        session = self._upload_session(session_id)
+        if session:
+            self.send_json(session.state())
+
+    def handle_delete_upload_session(self, session_id):
+        session = self.upload_sessions.pop(session_id) if self.upload_sessions else None
+        if not session:
+            self.send_error(404, "Unknown upload session")
+            return
+        session.remove()
+        log(f"Upload session {session_id} cancelled")
+        self.send_json({'id': session_id, 'deleted': True})
+
+    def handle_finalize_upload_session(self, session_id):
+        cfg = self.functions.get('upgrade_upload', {})
+        session = self._upload_session(session_id)
+        if not session:
+            return
+        if not session.complete:
+            self.send_error(409, f"Upload incomplete: {session.offset} of {session.size} bytes received")
+            return
+        query = parse_qs(urlparse(self.path).query)
+        try:
+            expected_sha256 = self._expected_sha256(query.get('sha256', [''])[0],
+                                                    query.get('sha256_url', [''])[0]) or session.sha256
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        session = self.upload_sessions.pop(session_id)
+        if not session:
+            self.send_error(404, "Unknown upload session")
+            return
+
+        file_path = cfg.get('upload_path', '/tmp/upload_file')
+        session.close()
+        os.replace(session.part_path, file_path)
+        log(f"Uploaded: {file_path} ({session.size} bytes, session {session_id})")
+        verified = None
+        if cfg.get('verify') or expected_sha256:
+            verifier = FirmwareVerifier(expected_sha256)
+            try:
+                verified = verifier.summary(verify_file(file_path, verifier))
+            except FirmwareVerifyError as e:
+                os.unlink(file_path)
+                self._reject_upload(e)
+                return
+        self._run_uploaded_upgrade(cfg, file_path, session.size, verified)
+
+class BoundedThreadingHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer running at most max_connections connection threads.
+
+    A connection over the limit is answered 503 from the accepting thread
+    and closed, so a flood of clients cannot grow the thread count.
+    """
+
+    BUSY_RESPONSE = (b"HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/plain\r\n"
+                     b"Content-Length: 12\r\nRetry-After: 5\r\nConnection: close\r\n\r\nServer busy\n")
+
+    def __init__(self, address, handler, max_connections=32):
+        super().__init__(address, handler)
+        self.connection_slots = threading.BoundedSemaphore(max_connections)
+
+    def process_request(self, request, client_address):
+        if not self.connection_slots.acquire(blocking=False):
+            try:
+                request.settimeout(1)
+                request.sendall(self.BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self.connection_slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.connection_slots.release()
+
 def main():
     script_dir = os.path.dirname(os.path.abspath(__file__))
     local_html_dir = os.path.join(script_dir, "html")
@@ -659,6 +3730,23 @@ def main():
     parser.add_argument("--bind", default="0.0.0.0", help="Bind address")
     parser.add_argument("--html-dir", default=default_html_dir, help="Path to HTML directory")
     parser.add_argument("--functions-dir", default=default_functions_dir, help="Path to directory containing YAML function files (loaded in sorted order)")
+    parser.add_argument("--status-workers", type=int, default=4, help="Number of status probes run concurrently")
+    parser.add_argument("--request-workers", type=int, default=4, help="Number of threads evaluating settings for a request concurrently")
+    parser.add_argument("--events-heartbeat", type=float, default=15, help="Seconds between keepalive comments on idle /api/events streams")
+    parser.add_argument("--events-settings-interval", type=float, default=10, help="Seconds between setting re-reads while /api/events has clients")
+    parser.add_argument("--max-connections", type=int, default=32, help="Client connections served at once, one thread each; more are answered 503")
+    parser.add_argument("--max-requests", type=int, default=8, help="Requests processed concurrently; event streams and waits for job output or an idle printer do not count")
+    parser.add_argument("--request-timeout", type=float, default=30, help="Seconds to receive a request or for a client to accept each write")
+    parser.add_argument("--keepalive-timeout", type=float, default=75, help="Seconds an idle HTTP/1.1 connection is kept open (above nginx's 60s upstream keepalive)")
+    parser.add_argument("--max-processes", type=int, default=2, help="Action commands run concurrently")
+    parser.add_argument("--command-timeout", type=float, default=3600, help="Seconds before an action command is killed")
+    parser.add_argument("--jobs-dir", default="/tmp/firmware-config-jobs", help="Directory for the output spill files of action jobs")
+    parser.add_argument("--moonraker-url", default="http://127.0.0.1:7125", help="Moonraker polled for print_stats to defer heavy work while printing (empty to disable)")
+    parser.add_argument("--print-state-interval", type=float, default=10, help="Seconds between print_stats polls while nothing is deferred")
+    parser.add_argument("--status-deadline", type=float, default=3.0, help="Seconds before /api/status returns partial results")
+    parser.add_argument("--status-ttl", type=float, default=30, help="Default refresh interval of status items without a ttl")
+    parser.add_argument("--fs-root", default="/", help="Root directory used by native status providers to read /sys and /proc")
+    parser.add_argument("--status-idle", type=float, default=60, help="Seconds without /api/status requests before background probing pauses")
     args = parser.parse_args()
 
     if not os.path.isdir(args.functions_dir):
@@ -667,11 +3755,44 @@ def main():
 
     functions = load_functions_from_dir(args.functions_dir)
 
+    global FS_ROOT
+    FS_ROOT = args.fs_root
+
     FirmwareConfigHandler.html_dir = os.fspath(args.html_dir)
     FirmwareConfigHandler.functions = functions
-
-    server = ThreadingHTTPServer((args.bind, args.port), FirmwareConfigHandler)
+    status_pool = ThreadPoolExecutor(max_workers=args.status_workers, thread_name_prefix="status")
+    FirmwareConfigHandler.status_refresher = StatusRefresher(
+        functions.get('status', {}), status_pool,
+        deadline=args.status_deadline, default_ttl=args.status_ttl, idle_timeout=args.status_idle,
+        sources_config=functions.get('status_sources', {}))
+    FirmwareConfigHandler.status_refresher.start()
+    FirmwareConfigHandler.request_pool = ThreadPoolExecutor(max_workers=args.request_workers, thread_name_prefix="request")
+    FirmwareConfigHandler.event_broker = EventBroker(
+        FirmwareConfigHandler.status_refresher,
+        FirmwareConfigHandler._get_setting_values,
+        settings_interval=args.events_settings_interval
+    )
+    FirmwareConfigHandler.event_broker.start()
+    FirmwareConfigHandler.events_heartbeat = args.events_heartbeat
+    upload_cfg = functions.get('upgrade_upload', {})
+    if upload_cfg:
+        FirmwareConfigHandler.upload_sessions = UploadSessionStore(
+            upload_cfg.get('session_dir') or os.path.dirname(upload_cfg.get('upload_path', '/tmp/upload_file')))
+    if args.moonraker_url:
+        FirmwareConfigHandler.print_monitor = PrintStateMonitor(args.moonraker_url, interval=args.print_state_interval)
+        FirmwareConfigHandler.print_monitor.start()
+    FirmwareConfigHandler.jobs = JobManager(
+        args.jobs_dir,
+        max_running=args.max_processes,
+        timeout=args.command_timeout,
+        monitor=FirmwareConfigHandler.print_monitor)
+    FirmwareConfigHandler.timeout = args.keepalive_timeout
+    FirmwareConfigHandler.request_timeout = args.request_timeout
+    FirmwareConfigHandler.request_slots = threading.BoundedSemaphore(args.max_requests)
+
+    server = BoundedThreadingHTTPServer((args.bind, args.port), FirmwareConfigHandler, max_connections=args.max_connections)
     log(f"Firmware Tool Control Server running on http://{args.bind}:{args.port}")
+    log(f"  Limits: {args.max_connections} connections, {args.max_requests} requests, {args.max_processes} action commands")
     log(f"  HTML directory: {args.html_dir}")
     log(f"  Functions dir: {args.functions_dir}")
     log(f"")
@@ -681,10 +3802,22 @@ def main():
     log(f"  GET  /api/settings             - Get current settings")
     log(f"  GET  /api/links                - Get available quick links")
     log(f"  GET  /api/actions              - Get available actions")
+    log(f"  GET  /api/bootstrap            - Status, settings, links and actions in one response")
+    log(f"  GET  /api/events               - Server-sent stream of status and setting changes")
+    log(f"  GET  /api/debug/cache          - Settings cache statistics")
+    log(f"  GET  /api/printer              - Cached print state and work deferred until idle")
+    log(f"  GET  /api/jobs                 - Action jobs, running and recent")
+    log(f"  GET  /api/jobs/<id>/log        - Job output from ?offset=, &follow=1 to stream until it ends")
+    log(f"  GET  /api/logs                 - List viewable logs")
+    log(f"  GET  /api/logs/<name>          - Read a log: tail, before, from_line, count, after, grep")
     log(f"  POST /api/upgrade                   - Upload file or download from URL and install firmware")
+    log(f"  POST /api/upgrade/sessions          - Start a resumable upload ({{\"size\": N}})")
+    log(f"  PUT  /api/upgrade/sessions/<id>     - Upload a byte range (Content-Range)")
+    log(f"  GET  /api/upgrade/sessions/<id>     - Received ranges of a resumable upload")
+    log(f"  POST /api/upgrade/sessions/<id>/finalize - Verify and install a completed upload")
     log(f"  POST /api/settings/<option>/<value> - Update a setting")
     log(f"  POST /api/action/<action>           - Execute action")
-    log(f"  POST /api/action/<action>/download  - Download action result file")
+    log(f"  GET  /api/action/<action>/download  - Download action result file (HEAD, Range)")
     log(f"")
     log(f"Available actions: {', '.join(functions.get('actions', {}).keys())}")
     log(f"Available settings: {', '.join(functions.get('settings', {}).keys())}")
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""TarStream: member order, flushing ahead of slow commands, command output and errors."""
+
+import io
+import os
+import tarfile
+import tempfile
+import time
+import zlib
+
+from common import check, section, finish, load_server
+
+fc = load_server()
+
+
+class Recorder:
+    """Collects what TarStream writes, with the time of each write."""
+
+    def __init__(self):
+        self.writes = []
+
+    def __call__(self, data):
+        self.writes.append((time.monotonic(), data))
+
+    def data(self, before=None):
+        return b"".join(data for at, data in self.writes if before is None or at < before)
+
+
+def members(data):
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        return {member.name: tar.extractfile(member).read() if member.isfile() else None for member in tar}
+
+
+def test_stream(tmp):
+    section("Paths are streamed before slow commands")
+    log_path = os.path.join(tmp, "klippy.log")
+    with open(log_path, "w") as f:
+        f.write("klippy log\n")
+    archive = {
+        "name": "logs",
+        "paths": [log_path, os.path.join(tmp, "missing.log")],
+        "commands": {"slow.txt": ["sh", "-c", "sleep 1; echo done"], "fails.txt": ["sh", "-c", "echo half; exit 3"]},
+    }
+    write = Recorder()
+    start = time.monotonic()
+    fc.TarStream.build(archive, write, "gzip", 6)
+
+    # A sync flushed gzip prefix decompresses to every member completed so far
+    early = zlib.decompressobj(31).decompress(write.data(before=start + 0.5))
+    check("path written before the slow command ends", b"klippy log\n" in early, True)
+    check("slow command output not yet written", b"done" in early, False)
+
+    names = members(write.data())
+    check("log file archived", names.get(f"logs/{log_path.lstrip('/')}"), b"klippy log\n")
+    check("command output archived", names.get("logs/commands/slow.txt"), b"done\n")
+    check("failed command output archived", names.get("logs/commands/fails.txt"), b"half\n")
+    check("errors listed", names.get("logs/errors.txt", b"").decode().splitlines(),
+          [f"{os.path.join(tmp, 'missing.log')}: not found", "fails.txt: exit code 3"])
+
+
+def test_uncompressed(tmp):
+    section("Uncompressed archive")
+    path = os.path.join(tmp, "config.cfg")
+    with open(path, "w") as f:
+        f.write("[printer]\n")
+    write = Recorder()
+    fc.TarStream.build({"name": "cfg", "paths": [path]}, write, None, 0)
+    check("one write per member and the end", len(write.writes), 2)
+    check("file archived", members(write.data()).get(f"cfg/{path.lstrip('/')}"), b"[printer]\n")
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        test_stream(tmp)
+        test_uncompressed(tmp)
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Helpers shared by the firmware-config host tests."""
+
+import importlib.util
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+import urllib.error
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_PATH = os.path.join(TEST_DIR, "..", "root", "usr", "local", "bin", "firmware-config.py")
+
+_passes   = 0
+_failures = 0
+
+
+def check(desc, actual, expected):
+    global _passes, _failures
+    if actual == expected:
+        print(f"  PASS  {desc}")
+        _passes += 1
+    else:
+        print(f"  FAIL  {desc}  (expected {expected!r}, got {actual!r})")
+        _failures += 1
+
+
+def section(title):
+    print(f"\n=== {title} ===")
+
+
+def finish():
+    print(f"\n{'OK' if _failures == 0 else 'FAILED'}  {_passes} passed, {_failures} failed")
+    sys.exit(0 if _failures == 0 else 1)
+
+
+def load_server():
+    """Import firmware-config.py as a module, without starting it."""
+    spec = importlib.util.spec_from_file_location("firmware_config", SERVER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until(predicate, timeout=10, interval=0.05):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(interval)
+    return False
+
+
+def start_server(functions_dir, *args):
+    """Run firmware-config.py on a free local port, returns (process, base_url)."""
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, SERVER_PATH, "--bind", "127.0.0.1", "--port", str(port),
+         "--functions-dir", functions_dir, *args],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def listening():
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return True
+        except OSError:
+            return False
+    if not wait_until(listening):
+        process.kill()
+        raise RuntimeError("firmware-config.py did not start")
+    return process, f"http://127.0.0.1:{port}"
+
+
+def request(url, method="GET", data=None, headers=None, timeout=30):
+    """Returns (status, headers, body), HTTP errors included."""
+    req = urllib.request.Request(url, data=data, method=method, headers=headers or {})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return resp.status, resp.headers, resp.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""JobManager: timeouts kill a command's children, followed jobs are not pruned."""
+
+import os
+import tempfile
+import time
+
+from common import check, section, finish, load_server, wait_until
+
+fc = load_server()
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # A killed child of the test's own process group may linger as a zombie
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def test_timeout(tmp):
+    section("Timeout kills the whole command")
+    jobs = fc.JobManager(os.path.join(tmp, "timeout"), timeout=1)
+    pid_path = os.path.join(tmp, "child.pid")
+    # The child outlives the shell and holds the output pipe
+    cmd = ["sh", "-c", f"sleep 30 & echo $! > {pid_path}; wait"]
+    start = time.monotonic()
+    job, _ = jobs.start("slow", {"label": "Slow", "message": "Running...", "cmd": cmd})
+    check("job ends after the timeout", wait_until(lambda: job.done, timeout=10), True)
+    check("job ends soon after the timeout", time.monotonic() - start < 5, True)
+    check("timeout is reported", b"timed out after 1s" in job.read(0)[0], True)
+    with open(pid_path) as f:
+        pid = int(f.read())
+    check("child is killed", wait_until(lambda: not alive(pid), timeout=5), True)
+
+
+def test_prune(tmp):
+    section("Followed jobs are kept")
+    jobs = fc.JobManager(os.path.join(tmp, "prune"), keep=1)
+
+    def run(action):
+        job, _ = jobs.start(action, {"label": action, "message": "Running...", "cmd": ["echo", action]})
+        wait_until(lambda: job.done)
+        return job
+
+    first = run("first")
+    with jobs.follow(first.id) as followed:
+        check("follow yields the job", followed, first)
+        for action in ("second", "third", "fourth"):
+            run(action)
+        check("followed job is not pruned", jobs.get(first.id), first)
+        check("followed job output is readable", b"first" in followed.read(0)[0], True)
+        check("unfollowed jobs are pruned", [job["action"] for job in jobs.list()], ["first", "third", "fourth"])
+    check("job is pruned once nobody follows it", jobs.get(first.id), None)
+    with jobs.follow(first.id) as followed:
+        check("pruned job cannot be followed", followed, None)
+    with jobs.follow("../etc/passwd") as followed:
+        check("invalid job id cannot be followed", followed, None)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        test_timeout(tmp)
+        test_prune(tmp)
+    finish()
+
+
+if __name__ == "__main__":
+    main()
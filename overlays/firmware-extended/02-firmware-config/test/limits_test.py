@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Server limits: connection cap, request slots, the per-request timeout and the request worker pool."""
+
+import json
+import os
+import socket
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import check, section, finish, start_server, request, wait_until
+
+SETTINGS = """
+settings:
+  tweaks:
+    label: Tweaks
+    items:
+{items}
+"""
+
+SETTING = """
+      setting-{n}:
+        label: Setting {n}
+        get_cmd: [sh, -c, "sleep 0.2; echo on"]
+        options:
+          "on": {{label: "On", set_cmd: ["true"]}}
+"""
+
+
+def connect(base_url):
+    host, port = base_url.rsplit("/", 1)[1].split(":")
+    return socket.create_connection((host, int(port)), timeout=10)
+
+
+def read_all(sock):
+    data = b""
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            return data
+        data += chunk
+
+
+def test_connections(functions_dir):
+    section("Connection cap")
+    server, base_url = start_server(functions_dir, "--moonraker-url", "", "--max-connections", "2")
+    try:
+        # start_server's own probe connection may still hold a slot for a moment
+        wait_until(lambda: request(f"{base_url}/api/status")[0] == 200)
+        idle = [connect(base_url) for _ in range(2)]
+        time.sleep(0.2)
+        over = connect(base_url)
+        check("connection over the cap is answered 503", read_all(over).split(b"\r\n")[0],
+              b"HTTP/1.1 503 Service Unavailable")
+        over.close()
+        idle.pop().close()
+        check("a freed connection is served again", wait_until(lambda: request(f"{base_url}/api/status")[0] == 200),
+              True)
+        for sock in idle:
+            sock.close()
+    finally:
+        server.kill()
+        server.wait()
+
+
+def test_requests(functions_dir):
+    section("Request slots and timeout")
+    server, base_url = start_server(functions_dir, "--moonraker-url", "", "--max-requests", "1",
+                                    "--request-timeout", "2")
+    try:
+        # A request whose body never arrives holds the only slot until it times out
+        stalled = connect(base_url)
+        stalled.sendall(b"POST /api/action/none HTTP/1.1\r\nHost: x\r\nContent-Length: 10\r\n\r\n")
+        time.sleep(0.3)
+
+        events = connect(base_url)
+        events.sendall(b"GET /api/events HTTP/1.1\r\nHost: x\r\n\r\n")
+        check("event stream needs no slot", events.recv(4096).split(b"\r\n")[0], b"HTTP/1.1 200 OK")
+        events.close()
+
+        start = time.monotonic()
+        status, _, _ = request(f"{base_url}/api/status")
+        waited = time.monotonic() - start
+        check("next request answers", status, 200)
+        check("next request waited for the slot", waited > 1, True)
+
+        start = time.monotonic()
+        check("stalled request is closed", read_all(stalled), b"")
+        check("stalled request closed by the request timeout", time.monotonic() - start < 1, True)
+        stalled.close()
+
+        slow = connect(base_url)
+        slow.sendall(b"GET /api/status HTTP/1.1\r\nHost: x\r\n")
+        start = time.monotonic()
+        check("unfinished headers are closed", read_all(slow), b"")
+        check("unfinished headers closed by the request timeout", 1 < time.monotonic() - start < 5, True)
+        slow.close()
+    finally:
+        server.kill()
+        server.wait()
+
+
+def bootstrap(base_url):
+    try:
+        return request(f"{base_url}/api/bootstrap", timeout=10)
+    except OSError as e:
+        return None, None, str(e).encode()
+
+
+def test_bootstrap(tmp):
+    section("Concurrent bootstrap with one request worker")
+    functions_dir = os.path.join(tmp, "settings")
+    os.makedirs(functions_dir)
+    with open(os.path.join(functions_dir, "settings.yaml"), "w") as f:
+        f.write(SETTINGS.format(items="".join(SETTING.format(n=n) for n in range(3))))
+    server, base_url = start_server(functions_dir, "--moonraker-url", "", "--request-workers", "1")
+    try:
+        with ThreadPoolExecutor(4) as pool:
+            responses = list(pool.map(lambda _: bootstrap(base_url), range(4)))
+        check("every bootstrap answers", [status for status, _, _ in responses], [200] * 4)
+        if responses[0][0] == 200:
+            items = json.loads(responses[0][2])["settings"]["tweaks"]["items"]
+            check("bootstrap has the setting values", [item["current"] for item in items], ["on"] * 3)
+        check("bootstrap answers afterwards", bootstrap(base_url)[0], 200)
+    finally:
+        server.kill()
+        server.wait()
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        functions_dir = os.path.join(tmp, "functions")
+        os.makedirs(functions_dir)
+        test_connections(functions_dir)
+        test_requests(functions_dir)
+        test_bootstrap(tmp)
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""PrintStateMonitor and deferral of heavy work while printing, against a stand-in Moonraker."""
+
+import io
+import json
+import os
+import tarfile
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from common import check, section, finish, load_server, free_port, wait_until, start_server, request
+
+fc = load_server()
+
+
+class Moonraker(BaseHTTPRequestHandler):
+    """Answers print_stats queries with whatever `printer` holds."""
+
+    printer = {"state": "standby", "filename": "", "progress": 0.0, "http_status": 200}
+
+    def do_GET(self):
+        if not self.path.startswith("/printer/objects/query"):
+            self.send_error(404)
+            return
+        body = json.dumps({"result": {"status": {
+            "print_stats": {"state": self.printer["state"], "filename": self.printer["filename"]},
+            "virtual_sdcard": {"progress": self.printer["progress"]},
+        }}}).encode()
+        self.send_response(self.printer["http_status"])
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def set_printer(**values):
+    Moonraker.printer.update(values)
+
+
+def test_monitor(moonraker_url):
+    section("PrintStateMonitor")
+    set_printer(state="standby", filename="", progress=0.0, http_status=200)
+    monitor = fc.PrintStateMonitor(moonraker_url, interval=0.05, busy_interval=0.05, timeout=1)
+    monitor.start()
+    check("standby is read", wait_until(lambda: monitor.state == "standby"), True)
+    check("standby is not busy", monitor.busy, False)
+
+    set_printer(state="printing", filename="benchy.gcode", progress=0.5)
+    check("printing is read", wait_until(lambda: monitor.state == "printing"), True)
+    check("printing is busy", monitor.busy, True)
+    check("waiting message", monitor.waiting_message(),
+          "Printer is printing (benchy.gcode, 50% done), waiting until it is idle...\n")
+    check("wait_idle times out while printing", monitor.wait_idle(0.2), False)
+
+    entry_id = monitor.enqueue("action", "collect-logs")
+    queue = monitor.info()["queue"]
+    check("queued work is listed", [(e["id"], e["kind"], e["name"]) for e in queue],
+          [(entry_id, "action", "collect-logs")])
+    monitor.dequeue(entry_id)
+    check("dequeued work is gone", monitor.info()["queue"], [])
+
+    set_printer(state="paused")
+    check("paused is busy", wait_until(lambda: monitor.state == "paused") and monitor.busy, True)
+    idle = threading.Timer(0.2, set_printer, kwargs={"state": "complete"})
+    idle.start()
+    check("wait_idle returns once the print ends", monitor.wait_idle(5), True)
+    idle.join()
+
+    set_printer(state="printing", http_status=500)
+    check("HTTP error is reported", wait_until(lambda: monitor.error == "HTTP 500"), True)
+    check("HTTP error counts as idle", (monitor.state, monitor.busy), (None, False))
+    set_printer(http_status=200)
+
+    section("PrintStateMonitor without Moonraker")
+    monitor = fc.PrintStateMonitor(f"http://127.0.0.1:{free_port()}", interval=0.05, timeout=1)
+    monitor.start()
+    check("connection error is reported", wait_until(lambda: monitor.error is not None), True)
+    check("unreachable Moonraker counts as idle", monitor.busy, False)
+
+
+FUNCTIONS = """
+actions:
+  troubleshooting:
+    items:
+      collect-logs:
+        label: Collect Logs
+        message: Collecting logs...
+        defer_while_printing: true
+        archive:
+          name: logs
+          paths:
+            - {log_path}
+      restart-klipper:
+        label: Restart Klipper
+        message: Restarting Klipper...
+        defer_while_printing: true
+        cmd: [echo, restarted]
+"""
+
+
+def post_in_background(url):
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(response=request(url, method="POST", data=b"")))
+    thread.start()
+    return thread, result
+
+
+def queued(base_url):
+    _, _, body = request(f"{base_url}/api/printer")
+    return [(entry["kind"], entry["name"]) for entry in json.loads(body)["queue"]]
+
+
+def test_deferral(moonraker_url, tmp):
+    section("Deferral while printing")
+    log_path = os.path.join(tmp, "klippy.log")
+    with open(log_path, "w") as f:
+        f.write("klippy log\n")
+    functions_dir = os.path.join(tmp, "functions")
+    os.makedirs(functions_dir)
+    with open(os.path.join(functions_dir, "actions.yaml"), "w") as f:
+        f.write(FUNCTIONS.format(log_path=log_path))
+
+    set_printer(state="printing", filename="benchy.gcode", progress=0.25, http_status=200)
+    server, base_url = start_server(functions_dir, "--moonraker-url", moonraker_url, "--print-state-interval", "0.1",
+                                    "--jobs-dir", os.path.join(tmp, "jobs"))
+    try:
+        check("server sees the print", wait_until(lambda: json.loads(request(f"{base_url}/api/printer")[2])["busy"]),
+              True)
+
+        status, _, _ = request(f"{base_url}/api/action/collect-logs/download")
+        check("direct archive download while printing is refused", status, 409)
+
+        for action in ("collect-logs", "restart-klipper"):
+            thread, result = post_in_background(f"{base_url}/api/action/{action}")
+            check(f"{action} is queued", wait_until(lambda: queued(base_url) == [("action", action)]), True)
+            check(f"{action} waits while printing", thread.is_alive(), True)
+            set_printer(state="standby")
+            thread.join(30)
+            status, _, body = result["response"]
+            text = body.decode()
+            check(f"{action} answers 200", status, 200)
+            check(f"{action} reported the wait", "Printer is printing (benchy.gcode, 25% done)" in text, True)
+            check(f"{action} continued when idle", "Printer is idle, continuing." in text, True)
+            check(f"{action} queue is empty", queued(base_url), [])
+            set_printer(state="printing")
+            wait_until(lambda: json.loads(request(f"{base_url}/api/printer")[2])["busy"])
+        check("restart-klipper ran after the wait", "restarted" in text, True)
+
+        set_printer(state="standby")
+        wait_until(lambda: not json.loads(request(f"{base_url}/api/printer")[2])["busy"])
+        status, _, body = request(f"{base_url}/api/action/collect-logs/download")
+        check("archive downloads when idle", status, 200)
+        with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+            check("archive holds the log", tar.extractfile(f"logs/{log_path.lstrip('/')}").read(), b"klippy log\n")
+    finally:
+        server.kill()
+        server.wait()
+
+
+def main():
+    moonraker = ThreadingHTTPServer(("127.0.0.1", 0), Moonraker)
+    threading.Thread(target=moonraker.serve_forever, daemon=True).start()
+    moonraker_url = f"http://127.0.0.1:{moonraker.server_address[1]}"
+
+    test_monitor(moonraker_url)
+    with tempfile.TemporaryDirectory() as tmp:
+        test_deferral(moonraker_url, tmp)
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Native status providers and their command fallbacks, against a fake /sys and /proc tree."""
+
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from common import check, section, finish, load_server, start_server, request
+
+fc = load_server()
+
+# An interface the host does not have, so its wireless ioctls fail like on a dead driver
+IFACE = "fakewl0"
+
+WIRELESS = """Inter-| sta-|   Quality        |   Discarded packets               | Missed | WE
+ face | tus | link level noise |  nwid  crypt   frag  retry   misc | beacon | 22
+fakewl0: 0000   70.  -42.  -256        0      0      0      0      0        0
+"""
+
+IWCONFIG = f"""{IFACE}    IEEE 802.11  ESSID:"HomeNet"
+          Mode:Managed  Frequency:2.437 GHz  Access Point: 12:34:56:78:9A:BC
+          Link Quality=70/70  Signal level=-40 dBm
+"""
+
+
+def write(root, path, text):
+    path = os.path.join(root, path.lstrip("/"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def make_tree(root):
+    write(root, "/etc/FULLVERSION", "1.2.3\n")
+    write(root, "/etc/BUILD_PROFILE", "")
+    write(root, "/proc/cmdline", "console=ttyFIQ0 androidboot.slot_suffix=_b rootwait\n")
+    write(root, "/proc/net/wireless", WIRELESS)
+    write(root, f"/sys/class/net/{IFACE}/address", "aa:bb:cc:dd:ee:ff\n")
+    os.makedirs(os.path.join(root, f"sys/class/net/{IFACE}/wireless"))
+    write(root, "/sys/class/net/eth9/address", "11:22:33:44:55:66\n")
+
+
+def test_providers(root):
+    section("Providers")
+    check("file", fc.provide_file("/etc/FULLVERSION"), "1.2.3")
+    check("empty file", fc.provide_file("/etc/BUILD_PROFILE"), None)
+    check("missing file", fc.provide_file("/etc/BUILD_VERSION"), None)
+    check("exists", fc.provide_exists(f"/sys/class/net/{IFACE}"), True)
+    check("exists, missing", fc.provide_exists("/sys/class/net/wlan9"), False)
+    check("sysfs_net", fc.provide_sysfs_net(f"{IFACE}/address"), "aa:bb:cc:dd:ee:ff")
+    check("sysfs_net, missing interface", fc.provide_sysfs_net("wlan9/address"), None)
+    check("cmdline_slot _b", fc.provide_cmdline_slot(""), "B")
+    write(root, "/proc/cmdline", "androidboot.slot_suffix=_a\n")
+    check("cmdline_slot _a", fc.provide_cmdline_slot(""), "A")
+    write(root, "/proc/cmdline", "console=ttyFIQ0\n")
+    check("cmdline_slot, no slot", fc.provide_cmdline_slot(""), None)
+    check("wireless signal", fc.provide_wireless(f"{IFACE}/signal"), "-42")
+    check("wireless, not a wireless interface", fc.provide_wireless("eth9/ssid"), None)
+    for field in ("ssid", "bssid"):
+        try:
+            fc.provide_wireless(f"{IFACE}/{field}")
+            check(f"wireless {field} ioctl fails without the interface", "no error", "OSError")
+        except OSError:
+            check(f"wireless {field} ioctl fails without the interface", "OSError", "OSError")
+    check("ipv4, loopback", fc.provide_ipv4("lo"), "127.0.0.1")
+    check("ipv4, missing interface", fc.provide_ipv4("wlan9"), None)
+
+
+def test_status_probe():
+    section("status_probe")
+    check("provider value", fc.status_probe("file:/etc/FULLVERSION", lambda: "fallback")(), "1.2.3")
+    check("provider failure uses the fallback",
+          fc.status_probe(f"wireless:{IFACE}/ssid", lambda: "fallback")(), "fallback")
+    check("unknown provider uses the fallback", fc.status_probe("nope:x", lambda: "fallback")(), "fallback")
+    check("no provider uses the fallback", fc.status_probe(None, lambda: "fallback")(), "fallback")
+    try:
+        fc.status_probe(f"wireless:{IFACE}/ssid", None)()
+        check("provider failure without fallback raises", "no error", "OSError")
+    except OSError:
+        check("provider failure without fallback raises", "OSError", "OSError")
+
+
+def status_config(root):
+    counter = os.path.join(root, "iwconfig-runs")
+    iwconfig = f"echo run >> {counter}; printf '%s' '{IWCONFIG}'"
+    sources = {"iwconfig": {"cmd": iwconfig}}
+    status = {
+        "wlan": {
+            "if_provider": f"exists:/sys/class/net/{IFACE}",
+            "if_cmd": "false",
+            "items": [
+                {"label": "SSID", "provider": f"wireless:{IFACE}/ssid", "source": "iwconfig",
+                 "regex": 'ESSID:"([^"]*)"'},
+                {"label": "BSSID", "provider": f"wireless:{IFACE}/bssid", "source": "iwconfig",
+                 "regex": r"Access Point:\s*(\S+)"},
+                {"label": "Signal", "provider": f"wireless:{IFACE}/signal", "source": "iwconfig",
+                 "regex": r"Signal level=(-?\d+)"},
+                {"label": "MAC", "provider": f"sysfs_net:{IFACE}/address", "cmd": "echo from-cmd"},
+            ],
+        },
+        "missing": {
+            "if_provider": "exists:/sys/class/net/wlan9",
+            "items": [{"label": "MAC", "provider": "sysfs_net:wlan9/address"}],
+        },
+    }
+    return status, sources, counter
+
+
+def values(snapshot, section_key):
+    return {item["label"]: item["value"] for item in snapshot.get(section_key, {}).get("items", [])}
+
+
+def test_refresher(root):
+    section("StatusRefresher fallbacks")
+    status, sources, counter = status_config(root)
+    refresher = fc.StatusRefresher(status, ThreadPoolExecutor(4), sources_config=sources)
+    refresher.start()
+    snapshot = refresher.snapshot()
+    check("failed providers read the fallback command", values(snapshot, "wlan"),
+          {"SSID": "HomeNet", "BSSID": "12:34:56:78:9A:BC", "Signal": "-42", "MAC": "aa:bb:cc:dd:ee:ff"})
+    with open(counter) as f:
+        check("shared fallback command ran once", len(f.read().split()), 1)
+    check("section of a missing interface is hidden", "missing" in snapshot, False)
+
+
+def test_fs_root(root):
+    section("--fs-root")
+    status, sources, _ = status_config(root)
+    functions_dir = os.path.join(root, "functions")
+    os.makedirs(functions_dir)
+    with open(os.path.join(functions_dir, "status.yaml"), "w") as f:
+        json.dump({"status": status, "status_sources": sources}, f)
+    server, base_url = start_server(functions_dir, "--fs-root", root, "--moonraker-url", "",
+                                    "--jobs-dir", os.path.join(root, "jobs"))
+    try:
+        code, _, body = request(f"{base_url}/api/status")
+        check("status answers", code, 200)
+        snapshot = json.loads(body)
+        check("providers read the fake tree", (values(snapshot, "wlan")["Signal"], values(snapshot, "wlan")["MAC"]),
+              ("-42", "aa:bb:cc:dd:ee:ff"))
+        check("if_provider reads the fake tree", sorted(snapshot), ["wlan"])
+    finally:
+        server.kill()
+        server.wait()
+
+
+def main():
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root)
+        fc.FS_ROOT = root
+        test_providers(root)
+        test_status_probe()
+        test_refresher(root)
+        test_fs_root(root)
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""RangeDownloader against a local HTTP server: splitting, resume, a file changing mid-download, no Range support."""
+
+import os
+import re
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from common import check, section, finish, load_server
+
+fc = load_server()
+
+CHUNK_SIZE = 64 * 1024
+
+
+class FileServer(BaseHTTPRequestHandler):
+    """Serves `data` at /fw.bin, honouring Range and If-Range unless told otherwise."""
+
+    protocol_version = "HTTP/1.1"
+    data = b""
+    etag = '"v1"'
+    ranges = True
+    fail_from = None      # ranges starting at or past this offset get a 503
+    swap_after = None     # (requests, data, etag): the file changes after that many range requests
+    requests = []
+
+    def do_GET(self):
+        if self.path == "/old.bin":
+            self.send_response(302)
+            self.send_header("Location", "/fw.bin")
+            self.send_header("Content-Length", 0)
+            self.end_headers()
+            return
+        cls = type(self)
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if match and cls.ranges:
+            start, end = int(match.group(1)), int(match.group(2)) + 1
+            cls.requests.append((start, end))
+            if cls.swap_after and len(cls.requests) > cls.swap_after[0]:
+                _, cls.data, cls.etag = cls.swap_after
+                cls.swap_after = None
+            if_range = self.headers.get("If-Range")
+            if cls.fail_from is not None and start >= cls.fail_from:
+                self._send(503, b"busy")
+            elif if_range and if_range != cls.etag:
+                self._send(200, cls.data)
+            else:
+                self._send(206, cls.data[start:end], {"Content-Range": f"bytes {start}-{end - 1}/{len(cls.data)}"})
+        else:
+            self._send(200, cls.data)
+
+    def _send(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Length", len(body))
+        self.send_header("ETag", type(self).etag)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # The downloader drops connections on purpose when the file changes
+        pass
+
+
+def serve(data, **options):
+    FileServer.data = data
+    FileServer.etag = '"v1"'
+    FileServer.ranges = True
+    FileServer.fail_from = None
+    FileServer.swap_after = None
+    FileServer.requests = []
+    for name, value in options.items():
+        setattr(FileServer, name, value)
+
+
+def downloader(base_url, target, path="/fw.bin", connections=3):
+    dl = fc.RangeDownloader(base_url + path, target, connections=connections, timeout=5)
+    dl.CHUNK_SIZE = CHUNK_SIZE
+    dl.RETRIES = 0
+    return dl
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def fetched(requests):
+    # The first request of every run is the one byte probe of resolve()
+    return sorted(r for r in requests if r != (0, 1))
+
+
+def test_split(base_url, tmp, data):
+    section("Range splitting")
+    target = os.path.join(tmp, "split", "fw.bin")
+    serve(data)
+    dl = downloader(base_url, target, path="/old.bin")
+    check("download returns the size", dl.download(), len(data))
+    check("content matches", read(target), data)
+    check("redirect followed", dl.final_url, base_url + "/fw.bin")
+    check("validator is the ETag", dl.validator, '"v1"')
+    expected = [(start, min(start + CHUNK_SIZE, len(data))) for start in range(0, len(data), CHUNK_SIZE)]
+    check("one request per chunk", fetched(FileServer.requests), expected)
+    check("part file removed", os.listdir(os.path.dirname(target)), ["fw.bin"])
+
+
+def test_resume(base_url, tmp, data):
+    section("Resume")
+    target = os.path.join(tmp, "resume", "fw.bin")
+    half = len(data) // 2 // CHUNK_SIZE * CHUNK_SIZE
+    serve(data, fail_from=half)
+    dl = downloader(base_url, target, connections=1)
+    try:
+        dl.download()
+        check("failing server stops the download", "no error", "RuntimeError")
+    except RuntimeError as e:
+        check("failing server stops the download", "HTTP 503" in str(e), True)
+    check("part file kept", os.path.exists(target + ".part"), True)
+    check("target not written", os.path.exists(target), False)
+
+    serve(data)
+    dl = downloader(base_url, target)
+    check("resumed download returns the size", dl.download(), len(data))
+    check("content matches", read(target), data)
+    check("only the missing part is fetched", min(start for start, _ in fetched(FileServer.requests)), half)
+    check("part files removed", os.listdir(os.path.dirname(target)), ["fw.bin"])
+
+
+def test_changed(base_url, tmp, data):
+    section("File changes mid-download")
+    target = os.path.join(tmp, "changed", "fw.bin")
+    new_data = bytes(reversed(data))
+    serve(data, swap_after=(3, new_data, '"v2"'))
+    dl = downloader(base_url, target, connections=1)
+    try:
+        dl.download()
+        check("If-Range mismatch stops the download", "no error", "RuntimeError")
+    except RuntimeError as e:
+        check("If-Range mismatch stops the download", "HTTP 200" in str(e), True)
+    check("target not written", os.path.exists(target), False)
+
+    FileServer.requests = []
+    dl = downloader(base_url, target)
+    check("next run returns the size", dl.download(), len(new_data))
+    check("next run has the new content", read(target), new_data)
+    check("old ranges are not reused", fetched(FileServer.requests)[0][0], 0)
+
+
+def test_no_ranges(base_url, tmp, data):
+    section("Server without Range support")
+    target = os.path.join(tmp, "noranges", "fw.bin")
+    serve(data, ranges=False)
+    dl = downloader(base_url, target)
+    try:
+        dl.download()
+        check("unsupported is reported", "no error", "RangeDownloadUnsupported")
+    except fc.RangeDownloadUnsupported:
+        check("unsupported is reported", "RangeDownloadUnsupported", "RangeDownloadUnsupported")
+    check("nothing written", os.path.exists(os.path.dirname(target)), False)
+
+
+def main():
+    server = Server(("127.0.0.1", 0), FileServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    data = os.urandom(5 * CHUNK_SIZE + 1234)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        test_split(base_url, tmp, data)
+        test_resume(base_url, tmp, data)
+        test_changed(base_url, tmp, data)
+        test_no_ranges(base_url, tmp, data)
+    finish()
+
+
+if __name__ == "__main__":
+    main()
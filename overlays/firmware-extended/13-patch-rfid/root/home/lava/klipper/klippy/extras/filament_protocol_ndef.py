@@ -1,7 +1,9 @@
+import collections
 import copy
-import io
+import hashlib
 import json
 import logging
+import struct
 from . import filament_protocol
 
 NDEF_OK = 0
@@ -12,7 +14,7 @@ NDEF_NOT_FOUND_ERR = -3
 def xxd_dump(data, max_lines=16):
     if isinstance(data, list):
         data = bytes(data)
-    if not isinstance(data, (bytes, bytearray)):
+    if not isinstance(data, (bytes, bytearray, memoryview)):
         return ""
 
     lines = []
@@ -26,100 +28,243 @@ def xxd_dump(data, max_lines=16):
 
     return '\n'.join(lines)
 
-def ndef_parse(data_buf):
-    if None == data_buf or isinstance(data_buf, (list, bytes, bytearray)) == False:
-        return NDEF_PARAMETER_ERR, [], []
-
-    try:
-        data = bytes(data_buf) if isinstance(data_buf, list) else data_buf
+# NFC Forum Type 2 tag (NTAG/Ultralight) memory layout
+NDEF_T2T_BYTES_PER_PAGE = 4
+NDEF_T2T_CC_PAGE = 3
+NDEF_T2T_DATA_START_PAGE = 4
+
+# TLV blocks in the data area, lock and memory control TLVs are skipped
+NDEF_TLV_NULL = 0x00
+NDEF_TLV_LOCK_CONTROL = 0x01
+NDEF_TLV_MEMORY_CONTROL = 0x02
+NDEF_TLV_MESSAGE = 0x03
+NDEF_TLV_TERMINATOR = 0xFE
+
+# NDEF record header
+NDEF_FLAG_MB = 0x80
+NDEF_FLAG_ME = 0x40
+NDEF_FLAG_CF = 0x20
+NDEF_FLAG_SR = 0x10
+NDEF_FLAG_IL = 0x08
+NDEF_TNF_WELL_KNOWN = 0x01
+NDEF_TNF_MIME = 0x02
+NDEF_TNF_URI = 0x03
+NDEF_TNF_UNCHANGED = 0x06
+
+def ndef_read_plan(data_buf, min_pages=1):
+    """Tell which pages of a Type 2 tag are still needed for its NDEF message.
+
+    data_buf holds the pages read so far, starting at page 0. Returns
+    (NDEF_OK, None) once it holds the whole NDEF message, or (NDEF_OK,
+    (first_page, last_page)) with the inclusive range to read next. Ranges
+    are widened to min_pages but never past the data area from the
+    capability container.
+    """
+    if None == data_buf or isinstance(data_buf, (list, bytes, bytearray, memoryview)) == False:
+        return NDEF_PARAMETER_ERR, None
+
+    have = len(data_buf) // NDEF_T2T_BYTES_PER_PAGE
+    cc_end = (NDEF_T2T_CC_PAGE + 1) * NDEF_T2T_BYTES_PER_PAGE
+    if len(data_buf) < cc_end:
+        return NDEF_OK, (have, max(NDEF_T2T_CC_PAGE, have + min_pages - 1))
+
+    cc = data_buf[NDEF_T2T_CC_PAGE * NDEF_T2T_BYTES_PER_PAGE:cc_end]
+    if cc[0] != 0xE1:
+        return NDEF_PARAMETER_ERR, None
+    data_end = cc_end + cc[2] * 8
+
+    def pages_until(end):
+        end = min(end, data_end)
+        last = (end - 1) // NDEF_T2T_BYTES_PER_PAGE
+        last_limit = (data_end - 1) // NDEF_T2T_BYTES_PER_PAGE
+        return NDEF_OK, (have, max(last, min(have + min_pages - 1, last_limit)))
+
+    found = False
+    offset = cc_end
+    while offset < data_end:
+        if offset >= len(data_buf):
+            return pages_until(offset + 1)
+
+        tag = data_buf[offset]
+        if tag == NDEF_TLV_TERMINATOR or tag == NDEF_TLV_NULL and found:
+            # Unused memory after a message is often zeroed, not terminated
+            break
+        if tag == NDEF_TLV_NULL:
+            offset += 1
+            continue
+
+        # A TLV header cut off by the end of the data area ends the walk
+        if offset + 2 > data_end:
+            break
+        if offset + 2 > len(data_buf):
+            return pages_until(offset + 2)
+        tlv_len = data_buf[offset + 1]
+        header_len = 2
+        if tlv_len == 0xFF:
+            if offset + 4 > data_end:
+                break
+            if offset + 4 > len(data_buf):
+                return pages_until(offset + 4)
+            tlv_len = (data_buf[offset + 2] << 8) | data_buf[offset + 3]
+            header_len = 4
+
+        end = offset + header_len + tlv_len
+        if tag == NDEF_TLV_MESSAGE:
+            if end > len(data_buf) and len(data_buf) < data_end:
+                return pages_until(end)
+            found = True
+        offset = end
+
+    if found:
+        return NDEF_OK, None
+    return NDEF_NOT_FOUND_ERR, None
+
+def ndef_tag_data(data_buf):
+    """Return (data, card_uid, offset) for a tag dump starting at page 0.
+
+    data is a memoryview of the dump and offset points at the first TLV
+    after the capability container, or is None when there is none.
+    """
+    data = memoryview(bytes(data_buf) if isinstance(data_buf, list) else data_buf)
+    data_len = len(data)
+
+    card_uid = []
+    if data_len >= 8:
+        card_uid = [data[0], data[1], data[2], data[4], data[5], data[6], data[7]]
+
+    offset = 0
+    if data_len > 12 and data[0] != 0xE1:
+        for i in range(min(16, data_len - 4)):
+            if data[i] == 0xE1 and (data[i+1] == 0x10 or data[i+1] == 0x11 or data[i+1] == 0x40):
+                offset = i
+                break
 
-        card_uid = []
-        if len(data) >= 8:
-            card_uid = [data[0], data[1], data[2], data[4], data[5], data[6], data[7]]
+    if offset + 4 > data_len or data[offset] != 0xE1:
+        return data, card_uid, None
+    return data, card_uid, offset + 4
+
+def ndef_iter_messages(data, offset):
+    """Yield a memoryview of every NDEF message TLV from offset on."""
+    data_len = len(data)
+    while offset + 2 <= data_len:
+        tag = data[offset]
+        if tag == NDEF_TLV_TERMINATOR:
+            return
+        if tag == NDEF_TLV_NULL:
+            offset += 1
+            continue
+
+        tlv_len = data[offset + 1]
+        offset += 2
+        if tlv_len == 0xFF:
+            if offset + 2 > data_len:
+                return
+            tlv_len = (data[offset] << 8) | data[offset + 1]
+            offset += 2
+
+        if tag == NDEF_TLV_MESSAGE:
+            if offset + tlv_len > data_len:
+                logging.warning("NDEF message truncated: %d of %d bytes", data_len - offset, tlv_len)
+            yield data[offset:offset + tlv_len]
+        offset += tlv_len
+
+def ndef_iter_records(data, offset):
+    """Yield the records of all NDEF messages from offset on, one at a time.
+
+    Records are dicts with tnf, type, id and payload. Chunked records are
+    reassembled into one. The id and payload are copied to bytes, so records
+    neither pin nor change with the caller's buffer. A malformed message is
+    abandoned at the bad record, later messages are still read.
+    """
+    for message in ndef_iter_messages(data, offset):
+        message_len = len(message)
+        pos = 0
+        chunks = None
+        first = True
+
+        while pos < message_len:
+            header = message[pos]
+            tnf = header & 0x07
+            if first and not header & NDEF_FLAG_MB:
+                logging.warning("NDEF record at %d does not begin a message", pos)
+            first = False
+
+            field_len = 2 + (1 if header & NDEF_FLAG_SR else 4) + (1 if header & NDEF_FLAG_IL else 0)
+            if pos + field_len > message_len:
+                logging.warning("NDEF record header truncated at %d", pos)
+                break
+            type_len = message[pos + 1]
+            pos += 2
+            if header & NDEF_FLAG_SR:
+                payload_len = message[pos]
+                pos += 1
+            else:
+                payload_len = int.from_bytes(message[pos:pos + 4], 'big')
+                pos += 4
+            id_len = 0
+            if header & NDEF_FLAG_IL:
+                id_len = message[pos]
+                pos += 1
+
+            if pos + type_len + id_len + payload_len > message_len:
+                logging.warning("NDEF record at %d exceeds the message (%d bytes)", pos, message_len)
+                break
+            record_type = message[pos:pos + type_len]
+            pos += type_len
+            record_id = message[pos:pos + id_len]
+            pos += id_len
+            payload = message[pos:pos + payload_len]
+            pos += payload_len
+
+            if chunks is None and tnf == NDEF_TNF_UNCHANGED:
+                logging.warning("NDEF record chunk without an initial chunk")
+                break
+            if chunks is not None and (tnf != NDEF_TNF_UNCHANGED or type_len != 0):
+                logging.warning("NDEF record chunk with a type, expected TNF unchanged")
+                break
 
-        logging.info("NDEF RFID data:")
-        logging.info("\n" + xxd_dump(data))
+            if header & NDEF_FLAG_CF:
+                if chunks is None:
+                    chunks = [payload]
+                    chunk_head = (tnf, record_type, record_id)
+                else:
+                    chunks.append(payload)
+            else:
+                if chunks is not None:
+                    chunks.append(payload)
+                    tnf, record_type, record_id = chunk_head
+                    payload = b''.join(chunks)
+                    chunks = None
+
+                yield {
+                    'tnf': tnf,
+                    'type': str(record_type, 'ascii', errors='ignore'),
+                    'id': bytes(record_id),
+                    'payload': bytes(payload),
+                }
+
+            if header & NDEF_FLAG_ME:
+                break
 
-        data_io = io.BytesIO(data)
+def ndef_parse(data_buf):
+    if None == data_buf or isinstance(data_buf, (list, bytes, bytearray, memoryview)) == False:
+        return NDEF_PARAMETER_ERR, [], []
 
-        start_offset = 0
-        if len(data) > 12 and data[0] != 0xE1:
-            for i in range(min(16, len(data) - 4)):
-                if data[i] == 0xE1 and (data[i+1] == 0x10 or data[i+1] == 0x11 or data[i+1] == 0x40):
-                    start_offset = i
-                    break
+    try:
+        # The tag is walked through a view, only record payloads are copied
+        data, card_uid, offset = ndef_tag_data(data_buf)
 
-        if start_offset > 0:
-            data_io.seek(start_offset)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("NDEF RFID data:\n%s", xxd_dump(data))
 
-        cc = data_io.read(4)
-        if len(cc) < 4 or cc[0] != 0xE1:
-            return NDEF_PARAMETER_ERR, []
+        if offset is None:
+            return NDEF_PARAMETER_ERR, [], []
 
         records = []
-
-        while True:
-            base_tlv = data_io.read(2)
-            if len(base_tlv) < 2:
-                break
-
-            tag = base_tlv[0]
-            if tag == 0xFE:
-                break
-
-            tlv_len = base_tlv[1]
-            if tlv_len == 0xFF:
-                ext_len = data_io.read(2)
-                if len(ext_len) < 2:
-                    break
-                tlv_len = (ext_len[0] << 8) | ext_len[1]
-
-            if tag == 0x03:
-                ndef_data = data_io.read(tlv_len)
-                ndef_offset = 0
-
-                while ndef_offset < len(ndef_data) - 2:
-                    header = ndef_data[ndef_offset]
-                    ndef_offset += 1
-
-                    tnf = header & 0x07
-                    sr_flag = (header >> 4) & 0x01
-                    il_flag = (header >> 3) & 0x01
-
-                    type_len = ndef_data[ndef_offset]
-                    ndef_offset += 1
-
-                    if sr_flag:
-                        payload_len = ndef_data[ndef_offset]
-                        ndef_offset += 1
-                    else:
-                        if ndef_offset + 4 > len(ndef_data):
-                            break
-                        payload_len = (ndef_data[ndef_offset] << 24) | (ndef_data[ndef_offset + 1] << 16) | (ndef_data[ndef_offset + 2] << 8) | ndef_data[ndef_offset + 3]
-                        ndef_offset += 4
-
-                    id_len = 0
-                    if il_flag:
-                        id_len = ndef_data[ndef_offset]
-                        ndef_offset += 1
-
-                    if ndef_offset + type_len + id_len + payload_len > len(ndef_data):
-                        break
-
-                    mime_type = ndef_data[ndef_offset:ndef_offset + type_len].decode('ascii', errors='ignore')
-                    ndef_offset += type_len
-
-                    if id_len > 0:
-                        ndef_offset += id_len
-
-                    payload = bytes(ndef_data[ndef_offset:ndef_offset + payload_len])
-                    ndef_offset += payload_len
-
-                    if tnf == 0x02:
-                        records.append({'mime_type': mime_type, 'payload': payload})
-                        logging.info(f"NDEF record found: mime_type='{mime_type}', payload_len={len(payload)}")
-            else:
-                data_io.seek(tlv_len, 1)
+        for record in ndef_iter_records(data, offset):
+            if record['tnf'] == NDEF_TNF_MIME:
+                records.append({'mime_type': record['type'], 'payload': record['payload']})
+                logging.info("NDEF record found: mime_type='%s', payload_len=%d", record['type'], len(record['payload']))
 
         if not records:
             return NDEF_NOT_FOUND_ERR, [], card_uid
@@ -140,12 +285,12 @@ def parse_color_hex(value):
         return 0xFFFFFF
 
 def openspool_parse_payload(payload, card_uid=[]):
-    if None == payload or not isinstance(payload, (bytes, bytearray)):
+    if None == payload or not isinstance(payload, (bytes, bytearray, memoryview)):
         logging.error("OpenSpool payload parsing failed: Invalid payload parameter")
         return filament_protocol.FILAMENT_PROTO_PARAMETER_ERR, None
 
     try:
-        payload_str = payload.decode('utf-8')
+        payload_str = str(payload, 'utf-8')
         logging.info(f"OpenSpool JSON payload: {payload_str}")
 
         data = json.loads(payload_str)
@@ -233,33 +378,214 @@ def openspool_parse_payload(payload, card_uid=[]):
         logging.exception("OpenSpool payload parsing failed: %s", str(e))
         return filament_protocol.FILAMENT_PROTO_ERR, None
 
-def ndef_proto_data_parse(data_buf):
-    error, records, card_uid = ndef_parse(data_buf)
+# Compact binary filament record: the OpenSpool fields in a fixed layout,
+# about 50 bytes instead of 150-300 bytes of JSON, so fewer pages to read.
+#   version u8, brand 16s, type 6s, subtype 8s (UTF-8, NUL padded)
+#   ARGB color u32, diameter u16 (0.01 mm), weight u16 (g)
+#   min_temp u16, max_temp u16, bed_temp u16 (C)
+#   followed by up to 4 additional colors as 3 byte RGB
+U1_FILAMENT_MIME_TYPE = 'application/x-u1-filament'
+U1_FILAMENT_VERSION = 1
+U1_FILAMENT_STRUCT = struct.Struct('>B16s6s8sIHHHHH')
+U1_FILAMENT_MAX_COLORS = 5
+
+def u1_filament_string(value):
+    return bytes(value).split(b'\0', 1)[0].decode('utf-8', errors='replace')
+
+def u1_filament_parse_payload(payload, card_uid=[]):
+    if None == payload or not isinstance(payload, (bytes, bytearray, memoryview)):
+        logging.error("U1 filament payload parsing failed: Invalid payload parameter")
+        return filament_protocol.FILAMENT_PROTO_PARAMETER_ERR, None
 
-    if error != NDEF_OK:
-        logging.error(f"NDEF parse failed: NDEF parsing error (code: {error})")
+    if len(payload) < U1_FILAMENT_STRUCT.size:
+        logging.error(f"U1 filament payload parsing failed: {len(payload)} bytes, expected at least {U1_FILAMENT_STRUCT.size}")
         return filament_protocol.FILAMENT_PROTO_ERR, None
 
-    if not records:
-        logging.error("NDEF parse failed: No records found")
+    (version, brand, main_type, sub_type, argb, diameter, weight,
+     min_temp, max_temp, bed_temp) = U1_FILAMENT_STRUCT.unpack_from(payload)
+    if version != U1_FILAMENT_VERSION:
+        logging.error(f"U1 filament payload parsing failed: Unsupported version {version}")
         return filament_protocol.FILAMENT_PROTO_ERR, None
 
-    for record in records:
-        mime_type = record['mime_type']
-        payload = record['payload']
+    info = copy.copy(filament_protocol.FILAMENT_INFO_STRUCT)
+    info['VERSION'] = 1
+    info['VENDOR'] = u1_filament_string(brand) or 'Generic'
+    info['MANUFACTURER'] = info['VENDOR']
+    info['MAIN_TYPE'] = (u1_filament_string(main_type) or 'PLA').upper()
+    info['SUB_TYPE'] = u1_filament_string(sub_type) or 'Basic'
+    info['TRAY'] = 0
+
+    info['ALPHA'] = argb >> 24
+    info['RGB_1'] = argb & 0xFFFFFF
+    info['ARGB_COLOR'] = argb
+    info['COLOR_NUMS'] = 1
+    colors = payload[U1_FILAMENT_STRUCT.size:]
+    for i in range(0, min(len(colors) // 3, U1_FILAMENT_MAX_COLORS - 1) * 3, 3):
+        info['COLOR_NUMS'] += 1
+        info[f"RGB_{info['COLOR_NUMS']}"] = int.from_bytes(colors[i:i + 3], 'big')
+    for i in range(info['COLOR_NUMS'] + 1, 6):
+        info[f'RGB_{i}'] = 0
+
+    info['DIAMETER'] = diameter or 175
+    info['WEIGHT'] = weight
+    info['LENGTH'] = 0
+    info['DRYING_TEMP'] = 0
+    info['DRYING_TIME'] = 0
+    info['HOTEND_MIN_TEMP'] = min_temp
+    info['HOTEND_MAX_TEMP'] = max_temp
+    info['BED_TEMP'] = bed_temp
+    info['BED_TYPE'] = 0
+    info['FIRST_LAYER_TEMP'] = min_temp
+    info['OTHER_LAYER_TEMP'] = min_temp
+
+    info['SKU'] = 0
+    info['MF_DATE'] = '19700101'
+    info['RSA_KEY_VERSION'] = 0
+    info['OFFICIAL'] = True
+    info['CARD_UID'] = card_uid
+
+    return filament_protocol.FILAMENT_PROTO_OK, info
+
+def u1_filament_pack(data):
+    """Encode an OpenSpool JSON dict as a U1 filament payload."""
+    def text(key, default, size):
+        # Cut on a character boundary, a partial UTF-8 sequence would decode as U+FFFD
+        return str(data.get(key) or default).encode('utf-8')[:size].decode('utf-8', errors='ignore').encode('utf-8')
+
+    def number(key, default, scale=1):
+        try:
+            value = float(data.get(key, default))
+        except (ValueError, TypeError):
+            value = default
+        try:
+            return max(0, min(0xFFFF, int(value * scale)))
+        except (ValueError, OverflowError):
+            return int(default * scale)
+
+    try:
+        alpha = max(0x00, min(0xFF, int(data.get('alpha'))))
+    except (ValueError, TypeError, OverflowError):
+        alpha = 0xFF
+    colors = [data.get('color_hex', 'FFFFFF')] + list(data.get('additional_color_hexes') or [])
+
+    payload = U1_FILAMENT_STRUCT.pack(
+        U1_FILAMENT_VERSION, text('brand', 'Generic', 16), text('type', 'PLA', 6),
+        text('subtype', 'Basic', 8), alpha << 24 | parse_color_hex(colors[0]) & 0xFFFFFF,
+        number('diameter', 1.75, 100), number('weight', 0), number('min_temp', 0),
+        number('max_temp', 0), number('bed_min_temp', 0) or number('bed_max_temp', 0))
+    for color in colors[1:U1_FILAMENT_MAX_COLORS]:
+        payload += (parse_color_hex(color) & 0xFFFFFF).to_bytes(3, 'big')
+    return payload
+
+class NdefInfoCache:
+    """LRU of decoded filament info keyed by card UID and payload hash.
+
+    Spools are re-read on every lid close and channel rescan, a hit skips
+    the JSON decode and field conversion. Callers always get their own copy,
+    so the cached info is never changed behind the cache's back.
+    """
+    def __init__(self, size=32):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(card_uid, record_type, payload):
+        return tuple(card_uid), record_type, hashlib.sha1(payload).digest()
+
+    def get(self, key):
+        info = self.entries.get(key)
+        if info is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return NdefInfoCache.copy(info)
+
+    def put(self, key, info):
+        self.entries[key] = NdefInfoCache.copy(info)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def get_status(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+    @staticmethod
+    def copy(info):
+        info = copy.copy(info)
+        info['CARD_UID'] = list(info['CARD_UID'])
+        return info
+
+ndef_info_cache = NdefInfoCache()
+
+# Record decoders by (TNF, type), MIME types are matched in lower case.
+# A decoder is called as decoder(payload, card_uid) -> (error, info).
+ndef_decoders = {}
+
+def ndef_register_decoder(tnf, record_type, decoder):
+    if tnf == NDEF_TNF_MIME:
+        record_type = record_type.lower()
+    ndef_decoders[(tnf, record_type)] = decoder
+
+ndef_register_decoder(NDEF_TNF_MIME, 'application/json', openspool_parse_payload)
+ndef_register_decoder(NDEF_TNF_MIME, U1_FILAMENT_MIME_TYPE, u1_filament_parse_payload)
+
+def ndef_proto_data_parse(data_buf):
+    if None == data_buf or isinstance(data_buf, (list, bytes, bytearray, memoryview)) == False:
+        logging.error("NDEF parse failed: Invalid data parameter")
+        return filament_protocol.FILAMENT_PROTO_ERR, None
+
+    try:
+        data, card_uid, offset = ndef_tag_data(data_buf)
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("NDEF RFID data:\n%s", xxd_dump(data))
+
+        if offset is None:
+            logging.error("NDEF parse failed: No capability container")
+            return filament_protocol.FILAMENT_PROTO_ERR, None
 
-        if mime_type == 'application/json':
-            logging.info(f"Detected OpenSpool format, parsing payload ({len(payload)} bytes)")
-            error_code, info = openspool_parse_payload(payload, card_uid)
+        # Records are decoded as they are found, the first supported one wins
+        record_count = 0
+        for record in ndef_iter_records(data, offset):
+            record_count += 1
+            tnf = record['tnf']
+            record_type = record['type'].lower() if tnf == NDEF_TNF_MIME else record['type']
+            payload = record['payload']
+
+            decoder = ndef_decoders.get((tnf, record_type))
+            if decoder is None:
+                logging.warning(f"Skipping unsupported NDEF record: TNF {tnf}, type '{record_type}'")
+                continue
+
+            cache_key = NdefInfoCache.key(card_uid, record_type, payload)
+            info = ndef_info_cache.get(cache_key)
+            if info is not None:
+                logging.info(f"NDEF '{record_type}' parse cached: vendor={info.get('VENDOR')}, type={info.get('MAIN_TYPE')}")
+                return filament_protocol.FILAMENT_PROTO_OK, info
+
+            logging.info(f"Decoding NDEF '{record_type}' record ({len(payload)} bytes)")
+            error_code, info = decoder(payload, card_uid)
             if error_code != filament_protocol.FILAMENT_PROTO_OK:
-                logging.error(f"OpenSpool parse failed: Payload parsing error (code: {error_code})")
+                logging.error(f"NDEF '{record_type}' parse failed: Payload parsing error (code: {error_code})")
                 continue
-            else:
-                logging.info(f"OpenSpool parse success: vendor={info.get('VENDOR')}, type={info.get('MAIN_TYPE')}")
-                return error_code, info
 
-        else:
-            logging.warning(f"Skipping unsupported MIME type '{mime_type}'")
+            logging.info(f"NDEF '{record_type}' parse success: vendor={info.get('VENDOR')}, type={info.get('MAIN_TYPE')}")
+            ndef_info_cache.put(cache_key, info)
+            return error_code, info
+
+    except Exception as e:
+        logging.exception("NDEF parsing failed: %s", str(e))
+        return filament_protocol.FILAMENT_PROTO_ERR, None
+
+    if not record_count:
+        logging.error("NDEF parse failed: No records found")
+        return filament_protocol.FILAMENT_PROTO_ERR, None
 
     logging.error("NDEF parse failed: No supported records found")
     return filament_protocol.FILAMENT_PROTO_SIGN_CHECK_ERR, None
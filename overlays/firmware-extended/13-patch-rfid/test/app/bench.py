@@ -0,0 +1,88 @@
+import os
+import sys
+import glob
+import json
+import argparse
+import logging
+import timeit
+
+from . import filament_protocol
+from . import filament_protocol_ndef
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def ntag215_image(payload, mime_type=b'application/json'):
+    if len(payload) < 256:
+        record = bytes([0xD2, len(mime_type), len(payload)]) + mime_type + payload
+    else:
+        record = bytes([0xC2, len(mime_type)]) + len(payload).to_bytes(4, 'big') + mime_type + payload
+    if len(record) < 0xFF:
+        tlv = bytes([0x03, len(record)])
+    else:
+        tlv = bytes([0x03, 0xFF]) + len(record).to_bytes(2, 'big')
+
+    uid = bytes([0x04, 0xA1, 0xB2, 0x9F, 0xC3, 0xD4, 0xE5, 0xF6])
+    image = uid + bytes([0xA8, 0x48, 0x00, 0x00]) + bytes([0xE1, 0x10, 0x3E, 0x00]) + tlv + record + b'\xFE'
+    return image + bytes(540 - len(image))
+
+def read_cost(image, pages_per_transfer):
+    """Pages and transfers fm175xx_reader needs for image, READ returning 4 pages and FAST_READ up to 15."""
+    read = b''
+    transfers = 0
+    error, pages = filament_protocol_ndef.ndef_read_plan(read, pages_per_transfer)
+    while pages is not None:
+        page, last = pages
+        while page <= last:
+            count = min(last - page + 1, pages_per_transfer)
+            read += image[page * 4:(page + count) * 4]
+            page += count
+            transfers += 1
+        error, pages = filament_protocol_ndef.ndef_read_plan(read, pages_per_transfer)
+    return len(read) // 4, transfers
+
+def bench(name, func, data, number):
+    seconds = min(timeit.repeat(lambda: func(data), number=number, repeat=5))
+    print(f'{name:<44} {seconds / number * 1e6:9.1f} us/tag')
+
+def parse_uncached(data):
+    filament_protocol_ndef.ndef_info_cache.clear()
+    return filament_protocol_ndef.ndef_proto_data_parse(data)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure NDEF parse cost per tag')
+    parser.add_argument('files', nargs='*', help='OpenSpool JSON payloads (default: test/openspool-*.json)')
+    parser.add_argument('--number', type=int, default=2000, help='Parses per measurement')
+    parser.add_argument('--log-level', default='INFO', help='Log level while parsing, as in klippy.log')
+    args = parser.parse_args()
+
+    # Log records are formatted and written like in Klipper, just not shown
+    logging.basicConfig(level=args.log_level.upper(), stream=open(os.devnull, 'w'))
+
+    files = args.files or sorted(glob.glob(os.path.join(TEST_DIR, 'openspool-*.json')))
+    for path in files:
+        with open(path, 'rb') as f:
+            payload = f.read()
+        image = ntag215_image(payload)
+
+        error, info = filament_protocol_ndef.ndef_proto_data_parse(image)
+        if error != filament_protocol.FILAMENT_PROTO_OK:
+            print(f'{path}: parse failed ({error})')
+            sys.exit(1)
+
+        binary = filament_protocol_ndef.u1_filament_pack(json.loads(payload))
+        binary_image = ntag215_image(binary, filament_protocol_ndef.U1_FILAMENT_MIME_TYPE.encode())
+        error, binary_info = filament_protocol_ndef.ndef_proto_data_parse(binary_image)
+        if error != filament_protocol.FILAMENT_PROTO_OK:
+            print(f'{path}: binary parse failed ({error})')
+            sys.exit(1)
+
+        print(f'{os.path.basename(path)} ({len(payload)} byte JSON, {len(binary)} byte binary payload)')
+        for name, data in (('JSON', image), ('binary', binary_image)):
+            for command, pages_per_transfer in (('READ', 4), ('FAST_READ', 15)):
+                pages, transfers = read_cost(data, pages_per_transfer)
+                print(f"{'  ' + name + ' tag, ' + command:<44} {pages:9d} pages {transfers:3d} transfers")
+        bench('  ndef_parse (list from reader)', filament_protocol_ndef.ndef_parse, list(image), args.number)
+        bench('  ndef_parse (bytes)', filament_protocol_ndef.ndef_parse, image, args.number)
+        bench('  ndef_proto_data_parse (new spool)', parse_uncached, list(image), args.number)
+        bench('  ndef_proto_data_parse (cached)', filament_protocol_ndef.ndef_proto_data_parse, list(image), args.number)
+        bench('  ndef_proto_data_parse (binary, new spool)', parse_uncached, list(binary_image), args.number)
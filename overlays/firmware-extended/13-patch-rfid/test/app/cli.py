@@ -12,12 +12,17 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Parse NDEF data or JSON payload from file')
     parser.add_argument('file', help='File containing NDEF data or OpenSpool JSON payload')
+    parser.add_argument('--pack', action='store_true', help='Print the U1 binary payload of an OpenSpool JSON file as hex')
     args = parser.parse_args()
 
     try:
         with open(args.file, 'rb') as f:
             data = f.read()
 
+        if args.pack:
+            print(filament_protocol_ndef.u1_filament_pack(json.loads(data.decode('utf-8'))).hex())
+            sys.exit(0)
+
         if args.file.endswith('.json'):
             try:
                 json.loads(data.decode('utf-8'))
@@ -0,0 +1,153 @@
+import os
+import sys
+import glob
+import json
+import logging
+
+from . import filament_protocol
+from . import filament_protocol_ndef
+from .bench import ntag215_image
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Fields both the JSON and the binary decoder fill from the payload
+FIELDS = ('VENDOR', 'MANUFACTURER', 'MAIN_TYPE', 'SUB_TYPE', 'ALPHA', 'ARGB_COLOR', 'COLOR_NUMS',
+          'RGB_1', 'RGB_2', 'RGB_3', 'RGB_4', 'RGB_5', 'DIAMETER', 'WEIGHT', 'HOTEND_MIN_TEMP',
+          'HOTEND_MAX_TEMP', 'BED_TEMP', 'FIRST_LAYER_TEMP', 'OTHER_LAYER_TEMP')
+
+_passes   = 0
+_failures = 0
+
+
+def check(desc, actual, expected):
+    global _passes, _failures
+    if actual == expected:
+        print(f"  PASS  {desc}")
+        _passes += 1
+    else:
+        print(f"  FAIL  {desc}  (expected {expected!r}, got {actual!r})")
+        _failures += 1
+
+
+def section(title):
+    print(f"\n=== {title} ===")
+
+
+def round_trip(data):
+    """Pack an OpenSpool dict and parse it back, returns the info dict or None."""
+    try:
+        payload = filament_protocol_ndef.u1_filament_pack(data)
+    except Exception as e:
+        return f'pack failed: {e!r}'
+    error, info = filament_protocol_ndef.u1_filament_parse_payload(payload)
+    return info if error == filament_protocol.FILAMENT_PROTO_OK else None
+
+
+def test_samples():
+    section("Sample payloads: binary decodes like JSON")
+    for path in sorted(glob.glob(os.path.join(TEST_DIR, 'openspool-*.json'))):
+        with open(path, 'rb') as f:
+            payload = f.read()
+        error, expected = filament_protocol_ndef.openspool_parse_payload(payload)
+        info = round_trip(json.loads(payload))
+        name = os.path.basename(path)
+        check(f"{name} parses", isinstance(info, dict), True)
+        if isinstance(info, dict):
+            check(f"{name} fields", {k: info[k] for k in FIELDS}, {k: expected[k] for k in FIELDS})
+
+
+def test_numbers():
+    section("Numbers fall back to their scaled default")
+    base = {'protocol': 'openspool', 'type': 'PLA'}
+    for value in (None, 'abc', 'inf', 'nan', [1]):
+        info = round_trip({**base, 'diameter': value})
+        check(f"diameter {value!r}", info['DIAMETER'] if isinstance(info, dict) else info, 175)
+    for value in (None, 'abc', 'inf'):
+        info = round_trip({**base, 'weight': value})
+        check(f"weight {value!r}", info['WEIGHT'] if isinstance(info, dict) else info, 0)
+    info = round_trip({**base, 'min_temp': -20, 'max_temp': 70000, 'diameter': '2.85'})
+    check("clamped and string values", (info['HOTEND_MIN_TEMP'], info['HOTEND_MAX_TEMP'], info['DIAMETER']),
+          (0, 0xFFFF, 285))
+    info = round_trip({**base, 'alpha': float('inf'), 'color_hex': 'FFFFFFFFFF'})
+    check("oversized alpha and color", (info['ALPHA'], info['RGB_1']) if isinstance(info, dict) else info,
+          (0xFF, 0xFFFFFF))
+
+
+def test_text():
+    section("Text is cut on a UTF-8 character boundary")
+    cases = (
+        ('brand', 'VENDOR', 'Kunststoff-Größe', 'Kunststoff-Grö'),     # ß would straddle byte 16
+        ('brand', 'VENDOR', '易生打印耗材料', '易生打印耗'),
+        ('brand', 'VENDOR', 'Prusament Galaxy Black', 'Prusament Galaxy'),
+        ('type', 'MAIN_TYPE', 'PETG-ÇF', 'PETG-'),
+        ('subtype', 'SUB_TYPE', 'Glänzend', 'Glänzen'),
+    )
+    for key, field, value, expected in cases:
+        info = round_trip({'protocol': 'openspool', key: value})
+        actual = info[field] if isinstance(info, dict) else info
+        check(f"{key} {value!r}", actual, expected.upper() if field == 'MAIN_TYPE' else expected)
+        check(f"{key} {value!r} has no U+FFFD", '�' in str(actual), False)
+
+
+def read_plans(image, min_pages, max_plans=64):
+    """Follow ndef_read_plan over image like fm175xx_reader, returns the plans and the final status."""
+    read = b''
+    plans = []
+    error, pages = filament_protocol_ndef.ndef_read_plan(read, min_pages)
+    while pages is not None and len(plans) < max_plans:
+        plans.append(pages)
+        if pages[1] < pages[0]:
+            break
+        read += image[pages[0] * 4:(pages[1] + 1) * 4]
+        error, pages = filament_protocol_ndef.ndef_read_plan(read, min_pages)
+    return plans, error
+
+
+def test_read_plan():
+    section("Read plans end at the data area")
+    # 64 byte tag, a lock control TLV filling the data area and a stray TLV in its last byte
+    image = bytearray(64)
+    image[12:16] = bytes([0xE1, 0x10, 0x06, 0x00])
+    image[16:18] = bytes([0x01, 0x2D])
+    image[63] = 0x01
+    for min_pages in (1, 4, 15):
+        plans, error = read_plans(bytes(image), min_pages)
+        check(f"TLV in the last byte, {min_pages} pages per read: plans advance",
+              all(first <= last for first, last in plans), True)
+        check(f"TLV in the last byte, {min_pages} pages per read: ends without a message",
+              (plans[-1][1] if plans else None, error), (15, filament_protocol_ndef.NDEF_NOT_FOUND_ERR))
+    check("TLV header past the data area", filament_protocol_ndef.ndef_read_plan(bytes(image)),
+          (filament_protocol_ndef.NDEF_NOT_FOUND_ERR, None))
+
+
+def test_buffer_reuse():
+    section("Records do not keep the reader's buffer")
+    with open(os.path.join(TEST_DIR, 'openspool-pla-basic.json'), 'rb') as f:
+        payload = f.read()
+    buf = bytearray(ntag215_image(payload))
+    error, records, _ = filament_protocol_ndef.ndef_parse(buf)
+    check("record parsed", (error, len(records)), (filament_protocol_ndef.NDEF_OK, 1))
+    check("payload is bytes", type(records[0]['payload']) if records else None, bytes)
+    error, info = filament_protocol_ndef.ndef_proto_data_parse(buf)
+    check("filament info parsed", error, filament_protocol.FILAMENT_PROTO_OK)
+    try:
+        buf[:] = bytes(len(buf) // 2)
+        check("buffer can be resized", True, True)
+    except BufferError:
+        check("buffer can be resized", False, True)
+    check("payload unchanged after the buffer is reused", records[0]['payload'] if records else None, payload)
+    error, cached = filament_protocol_ndef.ndef_proto_data_parse(ntag215_image(payload))
+    check("cached info unchanged after the buffer is reused", cached == info, True)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s: %(message)s')
+
+    test_samples()
+    test_numbers()
+    test_text()
+    test_read_plan()
+    test_buffer_reuse()
+
+    print(f"\n{'OK' if _failures == 0 else 'FAILED'}  {_passes} passed, {_failures} failed")
+    sys.exit(0 if _failures == 0 else 1)